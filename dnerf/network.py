@@ -2,9 +2,12 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import raymarching
 from encoding import get_encoder
 from activation import trunc_exp
 from .renderer import NeRFRenderer
+from .occupancy import unpack_bits
+from .utils import custom_meshgrid, query_bitfield
 
 
 class NeRFNetwork(NeRFRenderer):
@@ -23,6 +26,8 @@ class NeRFNetwork(NeRFRenderer):
                  hidden_dim_bg=64,
                  num_layers_deform=5, # a deeper MLP is very necessary for performance.
                  hidden_dim_deform=128,
+                 cache_deform=False, # at inference, sample the deformation from a grid baked once per time (see bake_deform)
+                 deform_resolution=128,
                  bound=1,
                  **kwargs,
                  ):
@@ -51,6 +56,11 @@ class NeRFNetwork(NeRFRenderer):
 
         self.deform_net = nn.ModuleList(deform_net)
 
+        # deformation grid cache for rendering at a fixed time
+        self.cache_deform = cache_deform
+        self.deform_resolution = deform_resolution
+        self.deform_cache = None # (key, enc_t, grid)
+
 
         # sigma network
         self.num_layers = num_layers
@@ -120,22 +130,100 @@ class NeRFNetwork(NeRFRenderer):
             self.bg_net = None
 
 
-    def forward(self, x, d, t):
+    def deform_mlp(self, enc_ori_x, enc_t):
+        # enc_ori_x: [N, C], enc_t: [N, C']
+        # return: [N, 3]
+        deform = torch.cat([enc_ori_x, enc_t], dim=1) # [N, C + C']
+        for l in range(self.num_layers_deform):
+            deform = self.deform_net[l](deform)
+            if l != self.num_layers_deform - 1:
+                deform = F.relu(deform, inplace=True)
+        return deform
+
+    def deform(self, x, t):
         # x: [N, 3], in [-bound, bound]
-        # d: [N, 3], nomalized in [-1, 1]
-        # t: [1, 1], in [0, 1]
+        # t: [1, 1] or [N, 1], in [0, 1]
+        # return: enc_ori_x [N, C], enc_t [N, C'], deform [N, 3]
 
-        # deform
         enc_ori_x = self.encoder_deform(x, bound=self.bound) # [N, C]
+
+        # fixed time at inference: trilinear lookup in the baked deformation grid instead of the deformation network.
+        if self.cache_deform and not self.training and t.shape[0] == 1:
+            enc_t, grid = self.bake_deform(t)
+            coords = (x / self.bound).flip(-1).view(1, 1, 1, -1, 3).to(grid.dtype) # grid_sample takes (z, y, x) for a [D=x, H=y, W=z] grid
+            deform = F.grid_sample(grid, coords, mode='bilinear', align_corners=True).view(3, -1).t().to(enc_ori_x.dtype) # [N, 3]
+            return enc_ori_x, enc_t.expand(x.shape[0], -1), deform
+
         enc_t = self.encoder_time(t) # [1, 1] --> [1, C']
         if enc_t.shape[0] == 1:
             enc_t = enc_t.repeat(x.shape[0], 1) # [1, C'] --> [N, C']
 
-        deform = torch.cat([enc_ori_x, enc_t], dim=1) # [N, C + C']
-        for l in range(self.num_layers_deform):
-            deform = self.deform_net[l](deform)
-            if l != self.num_layers_deform - 1:
-                deform = F.relu(deform, inplace=True)
+        return enc_ori_x, enc_t, self.deform_mlp(enc_ori_x, enc_t)
+
+    @torch.no_grad()
+    def bake_deform(self, t, chunk=2**18):
+        # t: [1, 1], in [0, 1]
+        # return: enc_t [1, C'], grid [1, 3, R, R, R], the deformation at time t on the vertices of a R^3 grid over [-bound, bound]^3.
+        # With cuda_ray only the vertices around the cells occupied at t are evaluated (0 elsewhere, never marched).
+        # Kept until the time, the deformation weights or the occupancy change.
+
+        params = list(self.encoder_deform.parameters()) + list(self.encoder_time.parameters()) + list(self.deform_net.parameters())
+        key = (t.item(), self.deform_resolution, tuple(p._version for p in params), self.occupancy.version if self.cuda_ray else None)
+        if self.deform_cache is not None and self.deform_cache[0] == key:
+            return self.deform_cache[1:]
+        self.deform_cache = None
+
+        R = self.deform_resolution
+        device = t.device
+
+        enc_t = self.encoder_time(t) # [1, C']
+
+        coords = torch.stack(custom_meshgrid(*[torch.arange(R, device=device)] * 3), dim=-1).view(-1, 3) # [R^3, 3]
+        xyzs = (2 * coords.float() / (R - 1) - 1) * self.bound # [R^3, 3], vertices
+
+        if self.cuda_ray:
+            # deformation grid cells overlapping an occupied density grid cell at t: the ones whose center is in an occupied cell
+            # (coarse cascades), and the ones holding the center of an occupied cell (fine cascades), dilated by one cell.
+            time = torch.floor(t[0][0] * self.time_size).clamp(min=0, max=self.time_size - 1).long().item()
+            bitfield = self.occupancy.slice(time)
+
+            cells = torch.stack(custom_meshgrid(*[torch.arange(R - 1, device=device)] * 3), dim=-1).view(-1, 3) # [(R-1)^3, 3]
+            centers = (2 * (cells.float() + 0.5) / (R - 1) - 1) * self.bound
+            occupied = query_bitfield(bitfield, centers, self.bound, self.cascade, self.grid_size) # [(R-1)^3]
+
+            occ_indices = unpack_bits(bitfield).nonzero(as_tuple=True)[0] # [M]
+            cas = occ_indices // self.grid_size ** 3
+            occ_coords = raymarching.morton3D_invert((occ_indices % self.grid_size ** 3).int()).float() # [M, 3]
+            mip_bound = torch.clamp(2.0 ** cas.float(), max=self.bound).unsqueeze(-1) # [M, 1]
+            occ_xyzs = (2 * (occ_coords + 0.5) / self.grid_size - 1) * mip_bound
+            occ_cells = ((occ_xyzs / self.bound + 1) / 2 * (R - 1)).long().clamp(0, R - 2) # [M, 3]
+            occupied[(occ_cells[:, 0] * (R - 1) + occ_cells[:, 1]) * (R - 1) + occ_cells[:, 2]] = True
+
+            occupied = occupied.float().view(1, 1, R - 1, R - 1, R - 1)
+            occupied = F.max_pool3d(occupied, kernel_size=3, stride=1, padding=1)
+            needed = F.max_pool3d(occupied, kernel_size=2, stride=1, padding=1).view(-1) > 0 # [R^3], vertices of these cells
+        else:
+            needed = torch.ones(R ** 3, dtype=torch.bool, device=device)
+
+        grid = torch.zeros(R ** 3, 3, device=device)
+        inds = needed.nonzero(as_tuple=True)[0]
+        for head in range(0, inds.shape[0], chunk):
+            batch = inds[head:head + chunk]
+            enc_ori_x = self.encoder_deform(xyzs[batch], bound=self.bound)
+            grid[batch] = self.deform_mlp(enc_ori_x, enc_t.repeat(batch.shape[0], 1)).float()
+
+        grid = grid.view(R, R, R, 3).permute(3, 0, 1, 2).unsqueeze(0).contiguous() # [1, 3, R, R, R]
+
+        self.deform_cache = (key, enc_t, grid)
+        return enc_t, grid
+
+    def forward(self, x, d, t):
+        # x: [N, 3], in [-bound, bound]
+        # d: [N, 3], nomalized in [-1, 1]
+        # t: [1, 1], in [0, 1]
+
+        # deform
+        enc_ori_x, enc_t, deform = self.deform(x, t)
         
         x = x + deform
 
@@ -171,16 +259,7 @@ class NeRFNetwork(NeRFRenderer):
         results = {}
 
         # deformation
-        enc_ori_x = self.encoder_deform(x, bound=self.bound) # [N, C]
-        enc_t = self.encoder_time(t) # [1, 1] --> [1, C']
-        if enc_t.shape[0] == 1:
-            enc_t = enc_t.repeat(x.shape[0], 1) # [1, C'] --> [N, C']
-
-        deform = torch.cat([enc_ori_x, enc_t], dim=1) # [N, C + C']
-        for l in range(self.num_layers_deform):
-            deform = self.deform_net[l](deform)
-            if l != self.num_layers_deform - 1:
-                deform = F.relu(deform, inplace=True)
+        enc_ori_x, enc_t, deform = self.deform(x, t)
         
         x = x + deform
         results['deform'] = deform
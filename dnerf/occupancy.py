@@ -0,0 +1,99 @@
+import torch
+import torch.nn as nn
+
+
+def pack_bits(occupied):
+    # [N] bool --> [N // 8] uint8, bit i of byte n is cell 8 * n + i (same layout as raymarching.packbits).
+    shifts = torch.arange(8, dtype=torch.uint8, device=occupied.device)
+    return (occupied.view(-1, 8).to(torch.uint8) << shifts).sum(-1).to(torch.uint8)
+
+
+def unpack_bits(bitfield):
+    # [N // 8] uint8 --> [N] bool
+    shifts = torch.arange(8, dtype=torch.uint8, device=bitfield.device)
+    return ((bitfield.unsqueeze(-1) >> shifts) & 1).bool().view(-1)
+
+
+class TemporalOccupancy(nn.Module):
+    ''' occupancy bitfields of the time slices of a dynamic scene, stored as the union of all refreshed slices (the static occupancy,
+    shared by every slice) plus per slice sparse deltas: the bytes where the slice differs from the union.
+    Memory grows with the moving part of the scene instead of time_size full bitfields, a slice that was never refreshed decodes to the union.
+    slice(t) decodes one slice into the [CAS * H * H * H // 8] bitfield the ray marcher expects (cached until the next update).
+    '''
+    def __init__(self, time_size, num_bytes):
+        super().__init__()
+
+        self.time_size = time_size
+        self.num_bytes = num_bytes
+
+        self.register_buffer('static', torch.zeros(num_bytes, dtype=torch.uint8)) # [B], union of the refreshed slices
+        self.register_buffer('delta_index', torch.zeros(0, dtype=torch.int64)) # [M], sorted, t * B + byte
+        self.register_buffer('delta_value', torch.zeros(0, dtype=torch.uint8)) # [M], byte of slice t
+        self.register_buffer('refreshed', torch.zeros(time_size, dtype=torch.bool)) # [T]
+
+        self.cache = None # (t, bitfield)
+        self.version = 0 # bumped on every change, for caches built on the occupancy
+
+    def reset(self):
+        self.static.zero_()
+        self.delta_index = self.delta_index[:0]
+        self.delta_value = self.delta_value[:0]
+        self.refreshed.zero_()
+        self.cache = None
+        self.version += 1
+
+    def nbytes(self):
+        return sum(b.numel() * b.element_size() for b in [self.static, self.delta_index, self.delta_value])
+
+    def slice(self, t):
+        # t: int, time slice
+        # return: [B] uint8 bitfield
+        if self.cache is not None and self.cache[0] == t:
+            return self.cache[1]
+
+        bounds = torch.tensor([t * self.num_bytes, (t + 1) * self.num_bytes], device=self.delta_index.device)
+        head, tail = torch.searchsorted(self.delta_index, bounds).tolist()
+
+        bitfield = self.static.clone()
+        bitfield[self.delta_index[head:tail] - t * self.num_bytes] = self.delta_value[head:tail]
+
+        self.cache = (t, bitfield)
+        return bitfield
+
+    @torch.no_grad()
+    def update(self, bitfields):
+        # bitfields: dict of t --> [B] uint8, the new bitfields of some slices. The union and the deltas of every slice are rebuilt
+        # against it, one slice decoded at a time.
+        refreshed = self.refreshed.clone()
+        refreshed[list(bitfields.keys())] = True
+        slices = refreshed.nonzero(as_tuple=True)[0].tolist()
+
+        get = lambda t: bitfields[t] if t in bitfields else self.slice(t)
+
+        static = torch.zeros_like(self.static)
+        for t in slices:
+            static |= get(t)
+
+        index = [self.delta_index[:0]]
+        value = [self.delta_value[:0]]
+        for t in slices:
+            bitfield = get(t)
+            changed = (bitfield != static).nonzero(as_tuple=True)[0] # [m]
+            index.append(changed + t * self.num_bytes)
+            value.append(bitfield[changed])
+
+        self.static = static
+        self.delta_index = torch.cat(index)
+        self.delta_value = torch.cat(value)
+        self.refreshed = refreshed
+        self.cache = None
+        self.version += 1
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the number of deltas changes with the scene, take the size of the saved ones.
+        for name in ['delta_index', 'delta_value']:
+            if prefix + name in state_dict:
+                setattr(self, name, torch.empty_like(state_dict[prefix + name], device=self.static.device))
+        self.cache = None
+        self.version += 1
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
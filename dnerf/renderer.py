@@ -8,6 +8,7 @@ import torch.nn.functional as F
 
 import raymarching
 from .utils import custom_meshgrid
+from .occupancy import TemporalOccupancy, pack_bits, unpack_bits
 
 def sample_pdf(bins, weights, n_samples, det=False):
     # This implementation is from NeRF
@@ -88,13 +89,15 @@ class NeRFRenderer(nn.Module):
         # extra state for cuda raymarching
         self.cuda_ray = cuda_ray
         if cuda_ray:
-            # density grid (with an extra time dimension)
-            density_grid = torch.zeros(self.time_size, self.cascade, self.grid_size ** 3) # [T, CAS, H * H * H]
-            density_bitfield = torch.zeros(self.time_size, self.cascade * self.grid_size ** 3 // 8, dtype=torch.uint8) # [T, CAS * H * H * H // 8]
+            # density grid, shared by all times: the max density of a cell over the refreshed time slices (ema).
+            density_grid = torch.zeros(self.cascade, self.grid_size ** 3) # [CAS, H * H * H]
             self.register_buffer('density_grid', density_grid)
-            self.register_buffer('density_bitfield', density_bitfield)
+            # occupancy bitfield of each time slice, as their union + sparse per slice deltas.
+            self.occupancy = TemporalOccupancy(self.time_size, self.cascade * self.grid_size ** 3 // 8)
             self.mean_density = 0
             self.iter_density = 0
+            self.time_cursor = 0 # next time slice to refresh
+            self.slice_density = {} # t --> (cells [M] int32, density [M] fp16), decayed density of the occupied cells of each slice
             # time stamps for density grid
             times = ((torch.arange(self.time_size, dtype=torch.float32) + 0.5) / self.time_size).view(-1, 1, 1) # [T, 1, 1]
             self.register_buffer('times', times)
@@ -119,13 +122,30 @@ class NeRFRenderer(nn.Module):
             return 
         # density grid
         self.density_grid.zero_()
+        self.occupancy.reset()
         self.mean_density = 0
         self.iter_density = 0
+        self.time_cursor = 0
+        self.slice_density = {}
         # step counter
         self.step_counter.zero_()
         self.mean_count = 0
         self.local_step = 0
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the compact occupancy: [T, CAS, H * H * H] density grid and [T, CAS * H * H * H // 8] bitfields.
+        if self.cuda_ray and prefix + 'density_bitfield' in state_dict:
+            bitfield = state_dict.pop(prefix + 'density_bitfield').to(self.density_grid.device)
+            self.occupancy.reset()
+            self.occupancy.update({t: bitfield[t] for t in range(bitfield.shape[0])})
+            for name, buffer in self.occupancy.named_buffers():
+                state_dict[prefix + 'occupancy.' + name] = buffer
+        if self.cuda_ray and prefix + 'density_grid' in state_dict and state_dict[prefix + 'density_grid'].dim() == 3:
+            state_dict[prefix + 'density_grid'] = state_dict[prefix + 'density_grid'].amax(dim=0)
+        if self.cuda_ray:
+            self.slice_density = {}
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def run(self, rays_o, rays_d, time, num_steps=128, upsample_steps=128, bg_color=None, perturb=False, **kwargs):
         # rays_o, rays_d: [B, N, 3], assumes B == 1
         # time: [B, 1]
@@ -282,7 +302,8 @@ class NeRFRenderer(nn.Module):
             bg_color = 1
 
         # determine the correct frame of density grid to use
-        t = torch.floor(time[0][0] * self.time_size).clamp(min=0, max=self.time_size - 1).long()
+        t = torch.floor(time[0][0] * self.time_size).clamp(min=0, max=self.time_size - 1).long().item()
+        density_bitfield = self.occupancy.slice(t)
 
         results = {}
 
@@ -292,7 +313,7 @@ class NeRFRenderer(nn.Module):
             counter.zero_() # set to 0
             self.local_step += 1
 
-            xyzs, dirs, deltas, rays = raymarching.march_rays_train(rays_o, rays_d, self.bound, self.density_bitfield[t], self.cascade, self.grid_size, nears, fars, counter, self.mean_count, perturb, 128, force_all_rays, dt_gamma, max_steps)
+            xyzs, dirs, deltas, rays = raymarching.march_rays_train(rays_o, rays_d, self.bound, density_bitfield, self.cascade, self.grid_size, nears, fars, counter, self.mean_count, perturb, 128, force_all_rays, dt_gamma, max_steps)
 
             #plot_pointcloud(xyzs.reshape(-1, 3).detach().cpu().numpy())
             
@@ -359,7 +380,7 @@ class NeRFRenderer(nn.Module):
                 # decide compact_steps
                 n_step = max(min(N // n_alive, 8), 1)
 
-                xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, self.bound, self.density_bitfield[t], self.cascade, self.grid_size, nears, fars, 128, perturb, dt_gamma, max_steps)
+                xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, self.bound, density_bitfield, self.cascade, self.grid_size, nears, fars, 128, perturb, dt_gamma, max_steps)
 
                 sigmas, rgbs, _ = self(xyzs, dirs, time)
                 # density_outputs = self.density(xyzs) # [M,], use a dict since it may include extra things, like geo_feat for rgb.
@@ -400,11 +421,11 @@ class NeRFRenderer(nn.Module):
         
         fx, fy, cx, cy = intrinsic
         
-        X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-        Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-        Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
+        X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_grid.device).split(S)
+        Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_grid.device).split(S)
+        Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_grid.device).split(S)
 
-        count = torch.zeros_like(self.density_grid[0])
+        count = torch.zeros_like(self.density_grid)
         poses = poses.to(count.device)
 
         # 5-level loop, forgive me...
@@ -446,29 +467,37 @@ class NeRFRenderer(nn.Module):
                             head += S
     
         # mark untrained grid as -1
-        self.density_grid[count.unsqueeze(0).expand_as(self.density_grid) == 0] = -1
+        self.density_grid[count == 0] = -1
 
         #print(f'[mark untrained grid] {(count == 0).sum()} from {resolution ** 3 * self.cascade}')
 
     @torch.no_grad()
-    def update_extra_state(self, decay=0.95, S=128):
+    def update_extra_state(self, decay=0.95, S=128, time_slices=8):
         # call before each epoch to update extra states.
+        # time_slices: number of time slices refreshed per call (in turn), so the cost of a call does not grow with time_size.
 
         if not self.cuda_ray:
             return 
         
         ### update density grid
 
-        tmp_grid = - torch.ones_like(self.density_grid)
+        slices = [(self.time_cursor + i) % self.time_size for i in range(min(time_slices, self.time_size))]
+        self.time_cursor = (self.time_cursor + len(slices)) % self.time_size
+        # calls per refresh of every slice, the schedule below counts refreshes of a slice (16 full, then partial up to 100).
+        rounds = math.ceil(self.time_size / len(slices))
+
+        tmp_grids = {} # t --> [CAS, H * H * H], density of the cells sampled at time t, -1 for the others
 
         # full update.
-        if self.iter_density < 16:
+        if self.iter_density < 16 * rounds:
         #if True:
-            X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-            Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-            Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
+            X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_grid.device).split(S)
+            Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_grid.device).split(S)
+            Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_grid.device).split(S)
 
-            for t, time in enumerate(self.times):
+            for t in slices:
+                time = self.times[t]
+                tmp_grid = - torch.ones_like(self.density_grid)
                 for xs in X:
                     for ys in Y:
                         for zs in Z:
@@ -494,20 +523,24 @@ class NeRFRenderer(nn.Module):
                                 sigmas = self.density(cas_xyzs, time_perturb)['sigma'].reshape(-1).detach()
                                 sigmas *= self.density_scale
                                 # assign 
-                                tmp_grid[t, cas, indices] = sigmas
+                                tmp_grid[cas, indices] = sigmas
+                tmp_grids[t] = tmp_grid
 
         # partial update (half the computation)
         # just update 100 times should be enough... too time consuming.
-        elif self.iter_density < 100:
-            N = self.grid_size ** 3 // 4 # T * C * H * H * H / 4
-            for t, time in enumerate(self.times):
+        elif self.iter_density < 100 * rounds:
+            N = self.grid_size ** 3 // 4 # C * H * H * H / 4
+            for t in slices:
+                time = self.times[t]
+                tmp_grid = - torch.ones_like(self.density_grid)
+                occupied = unpack_bits(self.occupancy.slice(t)).view(self.cascade, -1) # [CAS, H * H * H]
                 for cas in range(self.cascade):
                     # random sample some positions
-                    coords = torch.randint(0, self.grid_size, (N, 3), device=self.density_bitfield.device) # [N, 3], in [0, 128)
+                    coords = torch.randint(0, self.grid_size, (N, 3), device=self.density_grid.device) # [N, 3], in [0, 128)
                     indices = raymarching.morton3D(coords).long() # [N]
                     # random sample occupied positions
-                    occ_indices = torch.nonzero(self.density_grid[t, cas] > 0).squeeze(-1) # [Nz]
-                    rand_mask = torch.randint(0, occ_indices.shape[0], [N], dtype=torch.long, device=self.density_bitfield.device)
+                    occ_indices = torch.nonzero(occupied[cas]).squeeze(-1) # [Nz]
+                    rand_mask = torch.randint(0, occ_indices.shape[0], [N], dtype=torch.long, device=self.density_grid.device)
                     occ_indices = occ_indices[rand_mask] # [Nz] --> [N], allow for duplication
                     occ_coords = raymarching.morton3D_invert(occ_indices) # [N, 3]
                     # concat
@@ -528,23 +561,47 @@ class NeRFRenderer(nn.Module):
                     sigmas = self.density(cas_xyzs, time_perturb)['sigma'].reshape(-1).detach()
                     sigmas *= self.density_scale
                     # assign 
-                    tmp_grid[t, cas, indices] = sigmas
+                    tmp_grid[cas, indices] = sigmas
+                tmp_grids[t] = tmp_grid
 
         ## max-pool on tmp_grid for less aggressive culling [No significant improvement...]
         # invalid_mask = tmp_grid < 0
         # tmp_grid = F.max_pool3d(tmp_grid.view(self.cascade, 1, self.grid_size, self.grid_size, self.grid_size), kernel_size=3, stride=1, padding=1).view(self.cascade, -1)
         # tmp_grid[invalid_mask] = -1
 
-        # ema update
-        valid_mask = (self.density_grid >= 0) & (tmp_grid >= 0)
-        self.density_grid[valid_mask] = torch.maximum(self.density_grid[valid_mask] * decay, tmp_grid[valid_mask])
-        self.mean_density = torch.mean(self.density_grid.clamp(min=0)).item() # -1 non-training regions are viewed as 0 density.
+        # ema update of the max over time
+        if len(tmp_grids) > 0:
+            tmp_grid = - torch.ones_like(self.density_grid)
+            for grid in tmp_grids.values():
+                tmp_grid = torch.maximum(tmp_grid, grid)
+            valid_mask = (self.density_grid >= 0) & (tmp_grid >= 0)
+            self.density_grid[valid_mask] = torch.maximum(self.density_grid[valid_mask] * decay, tmp_grid[valid_mask])
+            self.mean_density = torch.mean(self.density_grid.clamp(min=0)).item() # -1 non-training regions are viewed as 0 density.
         self.iter_density += 1
 
-        # convert to bitfield
+        # convert to bitfield: the same ema as the shared grid per slice, max(density * decay, new density) on the sampled cells,
+        # so an occupied cell is only dropped once its decayed density falls below the threshold, not at its first low sample.
+        # only the occupied cells keep their density (slice_density), the others are 0.
         density_thresh = min(self.mean_density, self.density_thresh)
-        for t in range(self.time_size):
-            raymarching.packbits(self.density_grid[t], density_thresh, self.density_bitfield[t])
+        untrained = (self.density_grid < 0).view(-1)
+        bitfields = {}
+        for t, tmp_grid in tmp_grids.items():
+            density = torch.zeros_like(self.density_grid).view(-1) # [CAS * H * H * H]
+            if t in self.slice_density:
+                cells, values = self.slice_density[t]
+                density[cells.long()] = values.float()
+            else:
+                # no density kept yet (e.g. loaded from a checkpoint): the occupied cells start from the shared grid.
+                occupied = unpack_bits(self.occupancy.slice(t))
+                density[occupied] = self.density_grid.view(-1)[occupied].clamp(min=0)
+            sampled = (tmp_grid >= 0).view(-1)
+            density[sampled] = torch.maximum(density[sampled] * decay, tmp_grid.view(-1)[sampled])
+            occupied = (density > density_thresh) & ~untrained
+            cells = occupied.nonzero(as_tuple=True)[0]
+            self.slice_density[t] = (cells.int(), density[cells].half())
+            bitfields[t] = pack_bits(occupied)
+        if len(bitfields) > 0:
+            self.occupancy.update(bitfields)
 
         ### update step counter
         total_step = min(16, self.local_step)
@@ -552,7 +609,7 @@ class NeRFRenderer(nn.Module):
             self.mean_count = int(self.step_counter[:total_step, 0].sum().item() / total_step)
         self.local_step = 0
 
-        #print(f'[density grid] min={self.density_grid.min().item():.4f}, max={self.density_grid.max().item():.4f}, mean={self.mean_density:.4f}, occ_rate={(self.density_grid > 0.01).sum() / (128**3 * self.cascade):.3f} | [step counter] mean={self.mean_count}')
+        #print(f'[density grid] min={self.density_grid.min().item():.4f}, max={self.density_grid.max().item():.4f}, mean={self.mean_density:.4f}, occ_rate={(self.density_grid > 0.01).sum() / (128**3 * self.cascade):.3f} | [occupancy] {self.occupancy.nbytes() / 2**20:.1f} MB | [step counter] mean={self.mean_count}')
 
 
     def render(self, rays_o, rays_d, time, staged=False, max_ray_batch=4096, **kwargs):
@@ -1,8 +1,8 @@
 import math
-from turtle import backward, forward
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.autograd import Function
 from torch.cuda.amp import custom_bwd, custom_fwd 
 import atexit
@@ -10,7 +10,10 @@ import atexit
 try:
     import _ffmlp as _backend
 except ImportError:
-    from .backend import _backend
+    try:
+        from .backend import _backend
+    except Exception: # no cuda toolkit on this host, only the cpu path is available.
+        _backend = None
 
 class _ffmlp_forward(Function):
 
@@ -86,6 +89,103 @@ class _ffmlp_forward(Function):
 ffmlp_forward = _ffmlp_forward.apply
 
 
+K_ACT = 10.0 # as in src/utils.h
+
+
+def split_weights(weights, input_dim, output_dim, hidden_dim, num_layers):
+    # views of the packed (row-major) weights, same layout as the cuda kernels:
+    # [hidden_dim, input_dim], [num_layers - 1, hidden_dim, hidden_dim], [output_dim, hidden_dim]
+    first = hidden_dim * input_dim
+    hidden = first + hidden_dim * hidden_dim * (num_layers - 1)
+    return weights[:first].view(hidden_dim, input_dim), \
+           weights[first:hidden].view(num_layers - 1, hidden_dim, hidden_dim), \
+           weights[hidden:].view(output_dim, hidden_dim)
+
+
+def activation_(x, activation):
+    # in-place activation of a [B, C] buffer (ids from convert_activation).
+    if activation == 0: return x.relu_()
+    elif activation == 1: return x.exp_()
+    elif activation == 2: return x.sin_()
+    elif activation == 3: return x.sigmoid_()
+    elif activation == 4: return x.mul_(K_ACT).copy_(0.5 * (x + torch.sqrt(x * x + 4))).div_(K_ACT)
+    elif activation == 5: return x.copy_(F.softplus(x, beta=K_ACT))
+    else: return x
+
+
+def activation_backward_(grad, outputs, activation):
+    # grad w.r.t. the pre-activations given the post-activations (what the forward buffer keeps), in-place except for relu.
+    if activation == 0: return torch.ops.aten.threshold_backward(grad, outputs, 0) # much faster than a masked multiply
+    elif activation == 1: return grad.mul_(outputs)
+    elif activation == 2: raise NotImplementedError('FFMLP: sine needs the pre-activations, it cannot be trained (same as the cuda backend)')
+    elif activation == 3: return grad.mul_(outputs * (1 - outputs))
+    elif activation == 4: return grad.mul_((outputs * K_ACT) ** 2 / ((outputs * K_ACT) ** 2 + 1))
+    elif activation == 5: return grad.mul_(1 - torch.exp(-outputs * K_ACT))
+    else: return grad
+
+
+class _ffmlp_forward_cpu(Function):
+    ''' cpu counterpart of _ffmlp_forward, on the same packed weights.
+    Each layer is one matmul written into a preallocated buffer, followed by an in-place activation,
+    and the backward reuses the post-activations kept in the forward buffer (no autograd graph per layer).
+    '''
+    @staticmethod
+    def forward(ctx, inputs, weights, input_dim, output_dim, hidden_dim, num_layers, activation, output_activation, inference=False, calc_grad_inputs=False):
+
+        B = inputs.shape[0]
+
+        inputs = inputs.contiguous().to(weights.dtype)
+        w_first, w_hidden, w_last = split_weights(weights, input_dim, output_dim, hidden_dim, num_layers)
+
+        if not inference:
+            buffer = torch.empty(num_layers, B, hidden_dim, device=inputs.device, dtype=inputs.dtype)
+            layers = [buffer[k] for k in range(num_layers)]
+        else:
+            buffer = torch.empty(2, B, hidden_dim, device=inputs.device, dtype=inputs.dtype) # ping-pong
+            layers = [buffer[k % 2] for k in range(num_layers)]
+
+        activation_(torch.mm(inputs, w_first.t(), out=layers[0]), activation)
+        for k in range(num_layers - 1):
+            activation_(torch.mm(layers[k], w_hidden[k].t(), out=layers[k + 1]), activation)
+        outputs = activation_(torch.mm(layers[-1], w_last.t()), output_activation)
+
+        if not inference:
+            ctx.save_for_backward(inputs, weights, outputs, buffer)
+            ctx.dims = (input_dim, output_dim, hidden_dim, num_layers, activation, output_activation, calc_grad_inputs)
+
+        return outputs
+
+    @staticmethod
+    def backward(ctx, grad):
+        # grad: [B, output_dim]
+
+        inputs, weights, outputs, buffer = ctx.saved_tensors
+        input_dim, output_dim, hidden_dim, num_layers, activation, output_activation, calc_grad_inputs = ctx.dims
+
+        w_first, w_hidden, w_last = split_weights(weights, input_dim, output_dim, hidden_dim, num_layers)
+        grad_weights = torch.empty_like(weights)
+        g_first, g_hidden, g_last = split_weights(grad_weights, input_dim, output_dim, hidden_dim, num_layers)
+
+        grad = grad.to(weights.dtype)
+        if output_activation != convert_activation('none'):
+            grad = activation_backward_(grad.clone(), outputs, output_activation) # [B, output_dim]
+        torch.mm(grad.t(), buffer[-1], out=g_last)
+        grad = activation_backward_(torch.mm(grad, w_last), buffer[-1], activation) # [B, hidden_dim]
+
+        for k in reversed(range(num_layers - 1)):
+            torch.mm(grad.t(), buffer[k], out=g_hidden[k])
+            grad = activation_backward_(torch.mm(grad, w_hidden[k]), buffer[k], activation)
+
+        torch.mm(grad.t(), inputs, out=g_first)
+
+        grad_inputs = torch.mm(grad, w_first) if calc_grad_inputs else None
+
+        return grad_inputs, grad_weights, None, None, None, None, None, None, None, None
+
+
+ffmlp_forward_cpu = _ffmlp_forward_cpu.apply
+
+
 def convert_activation(act):
     if act == 'relu': return 0
     elif act == 'exponential': return 1
@@ -122,8 +222,9 @@ class FFMLP(nn.Module):
         self.weights = nn.Parameter(torch.zeros(self.num_parameters))
         self.reset_parameters()
 
-        # allocate streams
-        _backend.allocate_splitk(self.num_layers + 1)
+        # allocate streams (the cpu path needs none)
+        if _backend is not None:
+            _backend.allocate_splitk(self.num_layers + 1)
 
         # register destructor
         #atexit.register(self.cleanup) # how to correctly clean? this gives CUDA Error: cudaEventDestroy(events[i]) failed with error context is destroyed
@@ -151,6 +252,12 @@ class FFMLP(nn.Module):
         #print('inputs', inputs.shape, inputs.dtype, inputs.min().item(), inputs.max().item(), inputs.requires_grad)
 
         B, C = inputs.shape
+
+        # cpu: fp32 matmuls on the packed weights, no padding needed.
+        if not inputs.is_cuda:
+            outputs = ffmlp_forward_cpu(inputs, self.weights, self.input_dim, self.padded_output_dim, self.hidden_dim, self.num_layers, self.activation, self.output_activation, not (torch.is_grad_enabled() and (self.weights.requires_grad or inputs.requires_grad)), inputs.requires_grad)
+            return outputs[:, :self.output_dim]
+
         #assert B >= 128 and B % 128 == 0, f"ffmlp batch size must be 128 * m (m > 0), but got {B}."
 
         # pad input
@@ -1 +1,3 @@
-from .grid import GridEncoder
\ No newline at end of file
+from .grid import GridEncoder
+from .stats import GridStats
+from .compact import CompactGridEncoder, compact_grid
@@ -0,0 +1,231 @@
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+from .stats import grid_index
+
+_popcount8 = torch.tensor([bin(i).count('1') for i in range(256)], dtype=torch.int64)
+
+
+def popcount64(x):
+    # [N] int64 -> [N] number of set bits, byte by byte.
+    return _popcount8.to(x.device)[x.contiguous().view(torch.uint8).view(-1, 8).long()].sum(-1)
+
+
+def build_index(keep):
+    ''' rank / select index of the kept entries of a table.
+    Args:
+        keep: [T] bool
+    Returns:
+        bitmap: [ceil(T / 64)] int64, bit i % 64 of word i // 64 is set if entry i is kept.
+        prefix: [ceil(T / 64)] int32, number of kept entries before each word.
+    '''
+    T = keep.shape[0]
+    W = -(-T // 64)
+    bits = torch.zeros(W * 64, dtype=torch.int64, device=keep.device)
+    bits[:T] = keep.long()
+    bits = bits.view(W, 64)
+
+    powers = torch.ones(64, dtype=torch.int64, device=keep.device) << torch.arange(64, device=keep.device) # wraps to the sign bit
+    bitmap = (bits * powers).sum(dim=1)
+    counts = bits.sum(dim=1)
+    prefix = (torch.cumsum(counts, dim=0) - counts).int()
+    return bitmap, prefix
+
+
+def lookup_index(bitmap, prefix, index):
+    # [M] slot of the table entries index ([M] int64) in the compact storage, -1 for the dropped ones.
+    word = bitmap[index >> 6]
+    r = index & 63
+    present = ((word >> r) & 1).bool()
+    below = word & ((torch.ones_like(r) << r) - 1) # kept entries before index within its word
+    slot = prefix[index >> 6].long() + popcount64(below)
+    return torch.where(present, slot, torch.full_like(slot, -1))
+
+
+@torch.no_grad()
+def kmeans(x, K, iters=10, chunk=2**16):
+    # [K, C] centroids and [N] assignments of x ([N, C]) after iters Lloyd iterations.
+    K = min(K, x.shape[0])
+    centroids = x[torch.randperm(x.shape[0], device=x.device)[:K]].clone()
+    codes = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+    for _ in range(iters):
+        for head in range(0, x.shape[0], chunk):
+            codes[head:head + chunk] = torch.cdist(x[head:head + chunk], centroids).argmin(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, codes, x)
+        counts = torch.bincount(codes, minlength=K).unsqueeze(-1)
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+    return centroids, codes
+
+
+@torch.no_grad()
+def compact_grid(encoder, mode='int8', threshold=1e-4, keep=None, codebook_bits=8):
+    ''' compact storage of a trained GridEncoder table, served by CompactGridEncoder.
+    The entries that training never moved out of the initialization range (|e| <= threshold, as GridEncoder.reset_parameters
+    draws them in [-1e-4, 1e-4]) are dropped behind a bitmap / rank index and decode to 0, the others are stored as
+    fp16, int8 with per level and channel scales, or codes into a per level k-means codebook of 2^codebook_bits entries.
+    Args:
+        keep: [sO] bool, entries to keep, e.g. GridStats.hits > 0, instead of the threshold.
+    Returns:
+        dict of tensors and encoder hyper parameters (torch.save-able).
+    '''
+    assert mode in ['fp16', 'int8', 'codebook'], f'unknown compact mode {mode}'
+
+    embeddings = encoder.embeddings.detach().float().cpu() # [sO, C]
+    offsets = encoder.offsets.cpu().long()
+    L = offsets.shape[0] - 1
+    C = embeddings.shape[1]
+
+    if keep is None:
+        keep = embeddings.abs().amax(dim=1) > threshold
+    keep = keep.cpu()
+    bitmap, prefix = build_index(keep)
+
+    inds = keep.nonzero(as_tuple=True)[0] # [K], kept entries in table order
+    values = embeddings[inds] # [K, C]
+    levels = torch.searchsorted(offsets, inds, right=True) - 1 # [K]
+
+    state = {
+        'mode': mode,
+        'input_dim': encoder.input_dim,
+        'num_levels': encoder.num_levels,
+        'level_dim': encoder.level_dim,
+        'per_level_scale': float(encoder.per_level_scale),
+        'base_resolution': encoder.base_resolution,
+        'gridtype_id': encoder.gridtype_id,
+        'align_corners': encoder.align_corners,
+        'offsets': offsets.int(),
+        'bitmap': bitmap,
+        'prefix': prefix,
+    }
+
+    if mode == 'fp16':
+        state['values'] = values.half()
+
+    elif mode == 'int8':
+        scales = torch.full((L, C), 1e-12)
+        for l in range(L):
+            mask = levels == l
+            if mask.any():
+                scales[l] = values[mask].abs().amax(dim=0) / 127 # [L, C], symmetric per level and channel
+        state['values'] = torch.round(values / scales[levels]).clamp(-127, 127).to(torch.int8)
+        state['scales'] = scales
+
+    else:
+        K = 2 ** codebook_bits
+        codebook = torch.zeros(L, K, C)
+        codes = torch.zeros(inds.shape[0], dtype=torch.long)
+        for l in range(L):
+            mask = levels == l
+            if mask.any():
+                centroids, codes[mask] = kmeans(values[mask], K)
+                codebook[l, :centroids.shape[0]] = centroids
+        state['values'] = codes.to(torch.uint8 if codebook_bits <= 8 else torch.int16)
+        state['codebook'] = codebook # [L, K, C]
+
+    return state
+
+
+def compact_size(state):
+    # bytes of the tensors of a compact state.
+    return sum(v.numel() * v.element_size() for v in state.values() if torch.is_tensor(v))
+
+
+class CompactGridEncoder(nn.Module):
+    ''' inference-only GridEncoder that interpolates straight from a compact_grid state.
+    Same inputs, outputs and indexing as the cuda kernel (in pytorch, so it also runs without the extension),
+    every lookup goes through the bitmap rank and reads one fp16 / int8 / code entry instead of a fp32 row.
+    '''
+    def __init__(self, state, chunk=2**16):
+        super().__init__()
+
+        self.mode = state['mode']
+        self.input_dim = state['input_dim']
+        self.num_levels = state['num_levels']
+        self.level_dim = state['level_dim']
+        self.per_level_scale = state['per_level_scale']
+        self.base_resolution = state['base_resolution']
+        self.gridtype_id = state['gridtype_id']
+        self.align_corners = state['align_corners']
+        self.output_dim = self.num_levels * self.level_dim
+        self.chunk = chunk
+
+        for name in ['offsets', 'bitmap', 'prefix', 'values', 'scales', 'codebook']:
+            if name in state:
+                self.register_buffer(name, state[name])
+
+        self.stats = None
+
+    def __repr__(self):
+        return f"CompactGridEncoder: mode={self.mode} input_dim={self.input_dim} num_levels={self.num_levels} level_dim={self.level_dim} kept={self.values.shape[0]}/{int(self.offsets[-1])}"
+
+    def state(self):
+        # the compact_grid dict back, e.g. to save it again.
+        state = {k: getattr(self, k) for k in ['mode', 'input_dim', 'num_levels', 'level_dim', 'per_level_scale', 'base_resolution', 'gridtype_id', 'align_corners']}
+        state.update({k: v for k, v in self.named_buffers()})
+        return state
+
+    def decode(self, index, level):
+        # [M, C] float values of the entries index ([M], in the table of level), 0 where dropped.
+        slot = lookup_index(self.bitmap, self.prefix, index + int(self.offsets[level]))
+        found = slot >= 0
+        slot = slot.clamp(min=0)
+        if self.mode == 'fp16':
+            values = self.values[slot].float()
+        elif self.mode == 'int8':
+            values = self.values[slot].float() * self.scales[level]
+        else:
+            values = self.codebook[level][self.values[slot].long()]
+        return values * found.unsqueeze(-1)
+
+    @torch.no_grad()
+    def decompress(self):
+        # [sO, C] dense table, e.g. to load into GridEncoder.embeddings for the cuda kernel.
+        T = int(self.offsets[-1])
+        index = torch.arange(T, device=self.bitmap.device)
+        table = torch.zeros(T, self.level_dim, device=self.bitmap.device)
+        for l in range(self.num_levels):
+            lo, hi = int(self.offsets[l]), int(self.offsets[l + 1])
+            table[lo:hi] = self.decode(index[lo:hi] - lo, l)
+        return table
+
+    @torch.no_grad()
+    def encode(self, inputs):
+        # inputs: [B, D] in [0, 1], return [B, L * C]
+        B, D = inputs.shape
+        outputs = torch.zeros(B, self.num_levels, self.level_dim, device=inputs.device)
+        corners = torch.tensor([[(i >> d) & 1 for d in range(D)] for i in range(2 ** D)], device=inputs.device) # [2^D, D]
+
+        for l in range(self.num_levels):
+            size = int(self.offsets[l + 1] - self.offsets[l])
+            scale = np.exp2(l * np.log2(self.per_level_scale)) * self.base_resolution - 1.0
+            resolution = int(np.ceil(scale)) + 1
+
+            pos = inputs * scale + (0 if self.align_corners else 0.5)
+            pos_grid = torch.floor(pos)
+            frac = pos - pos_grid # [B, D]
+
+            vertices = (pos_grid.long().unsqueeze(1) + corners).view(-1, D) # [B * 2^D, D]
+            weights = torch.where(corners.bool(), frac.unsqueeze(1), 1 - frac.unsqueeze(1)).prod(dim=-1) # [B, 2^D]
+
+            index, _ = grid_index(vertices, resolution, size, self.gridtype_id, self.align_corners)
+            values = self.decode(index, l).view(B, 2 ** D, self.level_dim)
+            outputs[:, l] = (weights.unsqueeze(-1) * values).sum(dim=1)
+
+        # out of [0, 1] inputs encode to 0, as in the kernel.
+        inside = ((inputs >= 0) & (inputs <= 1)).all(dim=-1, keepdim=True)
+        return outputs.view(B, -1) * inside
+
+    def forward(self, inputs, bound=1):
+        # inputs: [..., input_dim], normalized real world positions in [-bound, bound]
+        # return: [..., num_levels * level_dim]
+        inputs = (inputs + bound) / (2 * bound) # map to [0, 1]
+
+        prefix_shape = list(inputs.shape[:-1])
+        inputs = inputs.reshape(-1, self.input_dim).float()
+
+        outputs = torch.cat([self.encode(inputs[head:head + self.chunk]) for head in range(0, inputs.shape[0], self.chunk)], dim=0) \
+            if inputs.shape[0] > 0 else torch.zeros(0, self.output_dim, device=inputs.device)
+
+        return outputs.view(prefix_shape + [self.output_dim])
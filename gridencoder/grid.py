@@ -129,6 +129,9 @@ class GridEncoder(nn.Module):
         self.embeddings = nn.Parameter(torch.empty(offset, level_dim))
 
         self.reset_parameters()
+
+        # optional GridStats, records the table entries used by every forward.
+        self.stats = None
     
     def reset_parameters(self):
         std = 1e-4
@@ -148,6 +151,9 @@ class GridEncoder(nn.Module):
         prefix_shape = list(inputs.shape[:-1])
         inputs = inputs.view(-1, self.input_dim)
 
+        if self.stats is not None and self.training:
+            self.stats.update(inputs)
+
         outputs = grid_encode(inputs, self.embeddings, self.offsets, self.per_level_scale, self.base_resolution, inputs.requires_grad, self.gridtype_id, self.align_corners)
         outputs = outputs.view(prefix_shape + [self.output_dim])
 
@@ -0,0 +1,185 @@
+import numpy as np
+
+import torch
+
+# same primes as fast_hash in src/gridencoder.cu
+PRIMES = [1, 2654435761, 805459861, 3674653429, 2097192037, 1434869437, 2165219737]
+
+
+def grid_index(pos_grid, resolution, hashmap_size, gridtype=0, align_corners=False):
+    # pytorch copy of get_grid_index in src/gridencoder.cu (without the channel).
+    # pos_grid: [M, D], int64 grid vertices of one level
+    # return: [M] entry of each vertex in the level's table, and whether the level is hashed.
+    D = pos_grid.shape[1]
+    stride = 1
+    index = torch.zeros_like(pos_grid[:, 0])
+    for d in range(D):
+        if stride > hashmap_size:
+            break
+        index += pos_grid[:, d] * stride
+        stride *= resolution if align_corners else resolution + 1
+
+    hashed = gridtype == 0 and stride > hashmap_size
+    if hashed:
+        index = torch.zeros_like(pos_grid[:, 0])
+        for d in range(D):
+            index ^= (pos_grid[:, d] * PRIMES[d]) & 0xFFFFFFFF # uint32 arithmetic
+
+    return index % hashmap_size, hashed
+
+
+def collision_rate(load):
+    # expected fraction of vertices sharing their entry when N vertices are hashed uniformly into T entries (load = N / T).
+    load = np.maximum(load, 1e-12)
+    return 1 - (1 - np.exp(-load)) / load
+
+
+class GridStats:
+    ''' opt-in occupancy / collision counters of a GridEncoder, accumulated over the lookups of a training run.
+    Set encoder.stats = GridStats(encoder), every interval-th forward then records the table entries hit by (a subset of)
+    its inputs, per level. Each entry remembers the first grid vertex that used it, a lookup from another vertex is a collision.
+    '''
+    def __init__(self, encoder, max_points=2**14, interval=1):
+        # max_points: inputs recorded per forward (randomly subsampled), bounds the overhead.
+        # interval: record every interval-th forward only.
+        self.encoder = encoder
+        self.max_points = max_points
+        self.interval = interval
+
+        offsets = encoder.offsets.cpu().numpy().astype(np.int64)
+        self.offsets = offsets
+        self.sizes = offsets[1:] - offsets[:-1] # [L], entries per level
+        self.resolutions = [int(np.ceil(encoder.base_resolution * encoder.per_level_scale ** l - 1)) + 1 for l in range(encoder.num_levels)] # as in the kernel
+        self.dense = [(r if encoder.align_corners else r + 1) ** encoder.input_dim for r in self.resolutions] # vertices of the full grid
+
+        self.clear()
+
+    def clear(self):
+        device = self.encoder.embeddings.device
+        self.hits = torch.zeros(int(self.offsets[-1]), dtype=torch.int32, device=device) # [sO], lookups per entry
+        self.owner = torch.full((int(self.offsets[-1]),), -1, dtype=torch.int64, device=device) # [sO], first vertex seen
+        self.collided = torch.zeros(int(self.offsets[-1]), dtype=torch.bool, device=device) # [sO], shared by >= 2 vertices
+        self.lookups = np.zeros(len(self.sizes), dtype=np.int64)
+        self.conflicts = np.zeros(len(self.sizes), dtype=np.int64)
+        self.hashed = [False] * len(self.sizes)
+        self.calls = 0
+
+    @torch.no_grad()
+    def update(self, inputs):
+        # inputs: [B, D], in [0, 1], as given to grid_encode.
+        self.calls += 1
+        if (self.calls - 1) % self.interval != 0 or inputs.shape[0] == 0:
+            return
+
+        if inputs.shape[0] > self.max_points:
+            inputs = inputs[torch.randint(0, inputs.shape[0], (self.max_points,), device=inputs.device)]
+        inputs = inputs.detach().float()
+        if self.hits.device != inputs.device: # follow the model to its device
+            self.hits, self.owner, self.collided = self.hits.to(inputs.device), self.owner.to(inputs.device), self.collided.to(inputs.device)
+
+        D = inputs.shape[1]
+        align_corners = self.encoder.align_corners
+        corners = torch.tensor([[(i >> d) & 1 for d in range(D)] for i in range(2 ** D)], dtype=torch.int64, device=inputs.device) # [2^D, D]
+
+        for l, (size, resolution) in enumerate(zip(self.sizes, self.resolutions)):
+            scale = np.exp2(l * np.log2(self.encoder.per_level_scale)) * self.encoder.base_resolution - 1
+            pos_grid = torch.floor(inputs * scale + (0 if align_corners else 0.5)).long() # [B, D]
+            vertices = (pos_grid.unsqueeze(1) + corners).view(-1, D) # [B * 2^D, D]
+
+            index, self.hashed[l] = grid_index(vertices, resolution, int(size), self.encoder.gridtype_id, align_corners)
+            index = index + int(self.offsets[l])
+
+            key = torch.zeros_like(index)
+            for d in range(D):
+                key = key * (resolution + 2) + vertices[:, d]
+
+            self.hits.index_add_(0, index, torch.ones_like(index, dtype=torch.int32))
+
+            # first vertex claims the entry, any other vertex on it later is a collision.
+            free = self.owner[index] < 0
+            self.owner[index[free]] = key[free]
+            conflict = self.owner[index] != key
+            self.collided[index[conflict]] = True
+
+            self.lookups[l] += index.shape[0]
+            self.conflicts[l] += int(conflict.sum().item())
+
+    def measure(self):
+        # per level dict: resolution, size, hashed, touched (entries), utilization, collided (fraction of the touched entries),
+        # conflict (fraction of the lookups that landed on an entry owned by another vertex), vertices (estimated distinct vertices).
+        levels = []
+        for l, size in enumerate(self.sizes):
+            lo, hi = int(self.offsets[l]), int(self.offsets[l + 1])
+            touched = int((self.hits[lo:hi] > 0).sum().item())
+            utilization = touched / size
+            if self.hashed[l]:
+                # balls into bins: touched = T * (1 - exp(-N / T)), a lower bound once the table is saturated.
+                vertices = -size * np.log(max(1 - utilization, 1 / size))
+            else:
+                vertices = touched
+            levels.append({
+                'resolution': self.resolutions[l],
+                'size': int(size),
+                'hashed': self.hashed[l],
+                'touched': touched,
+                'utilization': utilization,
+                'collided': int(self.collided[lo:hi].sum().item()) / max(touched, 1),
+                'conflict': self.conflicts[l] / max(self.lookups[l], 1),
+                'vertices': float(vertices),
+            })
+        return levels
+
+    def recommend(self, target=0.1, max_conflict=0.5, min_log2=12, max_log2=24):
+        ''' table size and number of levels for this scene.
+        log2_hashmap_size: smallest table that keeps the expected collision rate of every kept level under target.
+        num_levels: the finest levels that are saturated (more than max_conflict of their lookups collide) and would need
+                    a table larger than 2^max_log2 are dropped, keeping per_level_scale, i.e. with desired_resolution set to
+                    the finest kept level.
+        '''
+        levels = self.measure()
+
+        # load factor giving the target collision rate
+        lo, hi = 1e-6, 10.0
+        for _ in range(60):
+            mid = (lo + hi) / 2
+            lo, hi = (mid, hi) if collision_rate(mid) < target else (lo, mid)
+        load = lo
+
+        need = lambda n: max(level['vertices'] for level in levels[:n]) / load # entries needed by the first n levels
+        saturated = lambda level: level['conflict'] > max_conflict and level['utilization'] > 0.9
+
+        num_levels = len(levels)
+        while num_levels > 1 and saturated(levels[num_levels - 1]) and need(num_levels) > 2 ** max_log2:
+            num_levels -= 1
+
+        log2 = int(np.clip(np.ceil(np.log2(max(need(num_levels), 1))), min_log2, max_log2))
+
+        level_dim = self.encoder.level_dim
+        params = sum(min(2 ** log2, dense) for dense in self.dense[:num_levels]) * level_dim
+
+        return {
+            'log2_hashmap_size': log2,
+            'num_levels': num_levels,
+            'desired_resolution': int(round(self.encoder.base_resolution * self.encoder.per_level_scale ** (num_levels - 1))),
+            'params': int(params),
+            'current_params': int(self.offsets[-1]) * level_dim,
+            'saturated_levels': [l for l, level in enumerate(levels) if level['utilization'] > 0.9],
+            'target_collision': target,
+        }
+
+    def write(self, writer, global_step, prefix=""):
+        for l, level in enumerate(self.measure()):
+            writer.add_scalar(f"{prefix}/grid_utilization/level_{l}", level['utilization'], global_step)
+            writer.add_scalar(f"{prefix}/grid_conflict/level_{l}", level['conflict'], global_step)
+
+    def report(self):
+        levels = self.measure()
+        lines = ['level  resolution      size  hashed  utilization  collided  conflict  ~vertices']
+        for l, level in enumerate(levels):
+            lines.append(f"{l:5d}  {level['resolution']:10d}  {level['size']:8d}  {str(level['hashed']):>6s}  {level['utilization']:11.3f}  {level['collided']:8.3f}  {level['conflict']:8.3f}  {level['vertices']:9.0f}")
+
+        touched = sum(level['touched'] for level in levels)
+        rec = self.recommend()
+        lines.append(f"effective capacity: {touched} / {int(self.offsets[-1])} entries touched ({100 * touched / self.offsets[-1]:.1f}%), {int(sum(self.lookups))} lookups recorded")
+        lines.append(f"recommended: log2_hashmap_size = {rec['log2_hashmap_size']}, num_levels = {rec['num_levels']}, desired_resolution = {rec['desired_resolution']} ({rec['params']} params instead of {rec['current_params']}, {100 * rec['target_collision']:.0f}% expected collisions)")
+        return '\n'.join(lines)
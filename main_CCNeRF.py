@@ -57,6 +57,12 @@ if __name__ == '__main__':
     parser.add_argument('--fovy', type=float, default=50, help="default GUI camera fovy")
     parser.add_argument('--max_spp', type=int, default=64, help="GUI rendering max sample per pixel")
 
+    ### level of detail options (single model)
+    parser.add_argument('--lod', type=str, default='', choices=['', 'footprint', 'latency'], help="rank groups evaluated at test time: per sample from the pixel footprint, or per frame from --lod_target_ms")
+    parser.add_argument('--lod_bias', type=float, default=1, help="footprint LOD: voxels a pixel may cover before dropping a rank group")
+    parser.add_argument('--lod_target_ms', type=float, default=33, help="latency LOD: target render time per frame (ms)")
+    parser.add_argument('--lod_benchmark', action='store_true', help="report PSNR and time per frame of every rank level and of the LOD modes on the test set")
+
     ### experimental
     parser.add_argument('--error_map', action='store_true', help="use error map to sample rays")
     parser.add_argument('--clip_text', type=str, default='', help="text input for CLIP guidance")
@@ -151,6 +157,10 @@ if __name__ == '__main__':
 
         trainer = Trainer('ngp', opt, model, device=device, workspace=opt.workspace, criterion=criterion, fp16=opt.fp16, metrics=[PSNRMeter()], use_checkpoint=opt.ckpt)
 
+        if opt.lod and not opt.compose:
+            from tensoRF.lod import RankLOD
+            trainer.lod = RankLOD(model, opt.lod, bias=opt.lod_bias, target_ms=opt.lod_target_ms)
+
         if opt.gui:
             gui = NeRFGUI(opt, trainer)
             gui.render()
@@ -166,6 +176,9 @@ if __name__ == '__main__':
             else:
                 trainer.test(test_loader) # colmap doesn't have gt, so just test.
 
+            if opt.lod_benchmark and not opt.compose:
+                trainer.benchmark_lod(test_loader, target_ms=opt.lod_target_ms)
+
             #trainer.save_mesh(resolution=256, threshold=0.1)
     
     else:
@@ -48,6 +48,8 @@ if __name__ == '__main__':
     parser.add_argument('--min_near', type=float, default=0.2, help="minimum near distance for camera")
     parser.add_argument('--density_thresh', type=float, default=10, help="threshold for density grid to be occupied")
     parser.add_argument('--bg_radius', type=float, default=-1, help="if positive, use a background model at sphere(bg_radius)")
+    parser.add_argument('--cache_deform', action='store_true', help="(test only) bake the deformation at the rendered time into a grid and sample it, instead of running the deformation network per sample")
+    parser.add_argument('--deform_resolution', type=int, default=128, help="resolution of the baked deformation grid")
 
     ### GUI options
     parser.add_argument('--gui', action='store_true', help="start a GUI")
@@ -82,6 +84,8 @@ if __name__ == '__main__':
         min_near=opt.min_near,
         density_thresh=opt.density_thresh,
         bg_radius=opt.bg_radius,
+        cache_deform=opt.cache_deform and opt.test,
+        deform_resolution=opt.deform_resolution,
     )
     
     print(model)
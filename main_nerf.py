@@ -1,3 +1,4 @@
+import json
 import torch
 #import lietorch
 import argparse
@@ -6,11 +7,13 @@ from nerf.rgb_provider import NeRFDataset
 from nerf.depth_provider import NeRFDepthDataset
 from nerf.touch_provider import NeRFTouchDataset
 from nerf.gui import NeRFGUI
+from nerf.bounds import auto_bounds, backproject, depth_priors
 from nerf.utils import *
 
 
 from functools import partial
 from loss import huber_loss
+from optimizer import RowAdam
 
 #torch.autograd.set_detect_anomaly(True)
 
@@ -27,6 +30,7 @@ if __name__ == '__main__':
     ### training options
     parser.add_argument('--iters', type=int, default=30000, help="training iters")
     parser.add_argument('--lr', type=float, default=1e-3, help="initial learning rate")
+    parser.add_argument('--sparse_adam', action='store_true', help="update only the hash grid rows touched by each step (lazy row-wise Adam), the MLPs keep dense Adam")
     parser.add_argument('--ckpt', type=str, default='latest')
     parser.add_argument('--num_rays', type=int, default=4096, help="num rays sampled per image for each training step")
     parser.add_argument('--cuda_ray', action='store_true', help="use CUDA raymarching instead of pytorch")
@@ -35,6 +39,7 @@ if __name__ == '__main__':
     parser.add_argument('--upsample_steps', type=int, default=0, help="num steps up-sampled per ray (only valid when NOT using --cuda_ray)")
     parser.add_argument('--update_extra_interval', type=int, default=16, help="iter interval to update extra status (only valid when using --cuda_ray)")
     parser.add_argument('--max_ray_batch', type=int, default=4096, help="batch size of rays at inference to avoid OOM (only valid when NOT using --cuda_ray)")
+    parser.add_argument('--render_budget', type=float, default=0, help="if > 0, target peak memory (MB) at inference, overrides --max_ray_batch and backs off on OOM (also stages --cuda_ray)")
     parser.add_argument('--image_type', type=str, nargs='*', default=['color'], help="What type of image used. options are: color, depth, touch")
 
     ### network backbone options
@@ -45,10 +50,22 @@ if __name__ == '__main__':
     ### dataset options
     parser.add_argument('--color_space', type=str, default='srgb', help="Color space, supports (linear, srgb)")
     parser.add_argument('--preload', action='store_true', help="preload all data into GPU, accelerate training but use more GPU memory")
+    parser.add_argument('--cache_frames', type=int, default=0, help="if > 0 and not preloading, decode frames on demand and keep at most this many in host memory (0 decodes and keeps all frames)")
+    parser.add_argument('--prefetch_frames', type=int, default=2, help="number of upcoming frames decoded ahead on a background thread when --cache_frames > 0")
+    parser.add_argument('--prefetch_batches', type=int, default=0, help="if > 0, prepare this many training batches ahead on a side thread / cuda stream (2 is double buffering), 0 prepares them inline")
     # (the default value is for the fox dataset)
     parser.add_argument('--bound', type=float, default=2, help="assume the scene is bounded in box[-bound, bound]^3, if > 1, will invoke adaptive ray marching.")
     parser.add_argument('--scale', type=float, default=0.33, help="scale camera location into box[-bound, bound]^3")
     parser.add_argument('--offset', type=float, nargs='*', default=[0, 0, 0], help="offset of camera location")
+    parser.add_argument('--auto_bounds', action='store_true', help="compute a tight aabb and --scale / --offset from the depth / touch frames (cached in <path>/bounds.json)")
+    parser.add_argument('--depth_guided', action='store_true', help="concentrate the samples of the color rays around a prior projected from the depth frames (allows a much lower --num_steps). GUI and novel views have no prior and sample uniformly")
+    parser.add_argument('--prior_window', type=float, default=0.05, help="relative half width of the sampling window around the depth prior (--depth_guided)")
+    parser.add_argument('--prior_uniform', type=float, default=0.25, help="fraction of the samples kept uniform along the ray when a depth prior is used (--depth_guided)")
+    parser.add_argument('--num_levels', type=int, default=16, help="number of hash grid levels")
+    parser.add_argument('--log2_hashmap_size', type=int, default=19, help="log2 of the max number of hash grid entries per level")
+    parser.add_argument('--desired_resolution', type=int, default=None, help="finest hash grid resolution (default 2048 * bound)")
+    parser.add_argument('--grid_stats', type=int, default=0, help="if > 0, record the hash grid entries used by every grid_stats-th training forward, report per level occupancy / collisions each epoch and recommend --log2_hashmap_size / --num_levels / --desired_resolution (saved to <workspace>/grid_stats.json)")
+    parser.add_argument('--seed_occupancy', action='store_true', help="cull the density grid cells observed empty by the depth / touch frames before training (needs --cuda_ray)")
     parser.add_argument('--dt_gamma', type=float, default=1/128, help="dt_gamma (>=0) for adaptive ray marching. set to 0 to disable, >0 to accelerate rendering (but usually with worse quality)")
     # parser.add_argument('--min_near', type=float, default=0.2, help="minimum near distance for camera")
     # parser.add_argument('--max_far', type=float, default=100, help="maximum far distance for camera")
@@ -67,6 +84,17 @@ if __name__ == '__main__':
     parser.add_argument('--fovy', type=float, default=50, help="default GUI camera fovy")
     parser.add_argument('--max_spp', type=int, default=64, help="GUI rendering max sample per pixel")
 
+    ### baking options
+    parser.add_argument('--bake', action='store_true', help="bake the trained model into a sparse grid (saved under workspace/baked) for MLP-free rendering")
+    parser.add_argument('--bake_resolution', type=int, default=256, help="voxels per axis of the baked grid")
+    parser.add_argument('--baked', type=str, default='', help="render the GUI / test views from this baked grid (.npz) instead of the network")
+
+    ### cpu inference options
+    parser.add_argument('--cpu_precision', type=str, default='fp32', choices=['fp32', 'bf16', 'int8', 'bf16_int8'], help="inference precision on CPU: bf16 autocast and/or int8 dynamic quantization of the MLPs")
+    parser.add_argument('--cpu_benchmark', action='store_true', help="report PSNR / depth error vs fp32 and throughput of every cpu precision on the test set")
+    parser.add_argument('--compact', type=str, default='', choices=['', 'fp16', 'int8', 'codebook'], help="save a compact checkpoint (workspace/compact): untouched hash grid entries pruned, the others stored as fp16 / int8 / per level codebook codes")
+    parser.add_argument('--compact_ckpt', type=str, default='', help="test from this compact checkpoint, the hash grids are then interpolated straight from the compact tables")
+
     ### experimental
     parser.add_argument('--error_map', action='store_true', help="use error map to sample rays")
     parser.add_argument('--clip_text', type=str, default='', help="text input for CLIP guidance")
@@ -96,6 +124,12 @@ if __name__ == '__main__':
     seed_everything(opt.seed)
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # tight scene bounds from the depth / touch frames, the datasets are then loaded with the fitted scale / offset.
+    bounds = None
+    if opt.auto_bounds:
+        bounds = auto_bounds(opt, device)
+        opt.scale, opt.offset = bounds['scale'], bounds['offset']
     
     # load data either training or test depending on what mode is set to
     loaders = []
@@ -120,6 +154,12 @@ if __name__ == '__main__':
             tst_loaders.append(NeRFTouchDataset(opt, device=device, type='test', downscale=1).dataloader())
             val_loaders.append(NeRFTouchDataset(opt, device=device, type='val', downscale=1).dataloader())
 
+    # per pixel depth priors of the color frames, projected once from the depth frames of the same split.
+    if opt.depth_guided:
+        for split in [loaders, val_loaders, tst_loaders]:
+            datasets = {loader._data.datatype: loader._data for loader in split}
+            if 'rgb' in datasets and 'depth' in datasets:
+                datasets['rgb'].depth_prior = depth_priors(datasets['rgb'], datasets['depth'], cell=datasets['rgb'].prior_cell)
 
     # # get closest near plane to help define the hashgrid for nerf training
     # min_val = torch.inf
@@ -135,8 +175,25 @@ if __name__ == '__main__':
         # min_near=min_val,
         density_thresh=opt.density_thresh,
         bg_radius=opt.bg_radius,
+        num_levels=opt.num_levels,
+        log2_hashmap_size=opt.log2_hashmap_size,
+        desired_resolution=opt.desired_resolution,
     )
     
+    if bounds is not None:
+        model.aabb_train.copy_(torch.FloatTensor(bounds['aabb']))
+        model.aabb_infer.copy_(torch.FloatTensor(bounds['aabb']))
+
+    if opt.seed_occupancy and opt.mode == 'train':
+        measured = [backproject(loader._data) for loader in loaders if loader._data.datatype in ['depth', 'touch']]
+        if len(measured) > 0:
+            model.seed_occupancy(torch.cat([m[0] for m in measured]), torch.cat([m[1] for m in measured]))
+
+    # opt-in hash grid instrumentation
+    if opt.grid_stats > 0 and opt.mode == 'train' and hasattr(model.encoder, 'offsets'):
+        from gridencoder import GridStats
+        model.encoder.stats = GridStats(model.encoder, interval=opt.grid_stats)
+
     print(model)
 
     #criterion = torch.nn.L1Loss()
@@ -150,7 +207,10 @@ if __name__ == '__main__':
         trainer = Trainer('ngp', opt, model, device=device, workspace=opt.workspace, criterion=criterion, fp16=opt.fp16, metrics=[PSNRMeter()], use_checkpoint=opt.ckpt)
     
     elif opt.mode == 'train':
-        optimizer = lambda model: torch.optim.Adam(model.get_params(opt.lr), betas=(0.9, 0.99), eps=1e-15)
+        if opt.sparse_adam:
+            optimizer = lambda model: RowAdam(model.get_params(opt.lr), betas=(0.9, 0.99), eps=1e-15)
+        else:
+            optimizer = lambda model: torch.optim.Adam(model.get_params(opt.lr), betas=(0.9, 0.99), eps=1e-15)
         scheduler = lambda optimizer: optim.lr_scheduler.LambdaLR(optimizer, lambda iter: 0.1 ** min(iter / opt.iters, 1))
 
         trainer = Trainer('ngp', opt, model, device=device, workspace=opt.workspace, 
@@ -161,6 +221,16 @@ if __name__ == '__main__':
         print("incorrect mode given! Exiting...")
         exit()
 
+    if opt.baked:
+        trainer.load_baked(opt.baked)
+
+    if opt.compact_ckpt:
+        trainer.load_compact(opt.compact_ckpt)
+
+    # quantize the trained weights (in train mode this happens after training).
+    if opt.mode == 'test' and opt.cpu_precision != 'fp32':
+        trainer.set_cpu_precision(opt.cpu_precision)
+
     if opt.gui:
         if opt.mode == 'test':
             gui = NeRFGUI(opt, trainer)
@@ -177,10 +247,26 @@ if __name__ == '__main__':
             
             trainer.save_mesh(resolution=256, threshold=10)
 
+            if opt.bake:
+                trainer.save_baked(resolution=opt.bake_resolution)
+
+            if opt.compact:
+                trainer.save_compact(opt.compact)
+
+            if opt.cpu_benchmark:
+                trainer.benchmark_cpu_inference(loaders)
+
         elif opt.mode == 'train':
             max_epoch = np.ceil(opt.iters / len(loaders)).astype(np.int32)
             trainer.train(loaders, val_loaders, max_epoch)
 
+            if getattr(model.encoder, 'stats', None) is not None:
+                with open(os.path.join(opt.workspace, 'grid_stats.json'), 'w') as f:
+                    json.dump({'levels': model.encoder.stats.measure(), 'recommended': model.encoder.stats.recommend()}, f, indent=2)
+
+            if opt.cpu_precision != 'fp32':
+                trainer.set_cpu_precision(opt.cpu_precision)
+
             if tst_loaders[0].has_gt:
                 trainer.evaluate(tst_loaders) # blender has gt, so evaluate it.
             else:
@@ -188,6 +274,15 @@ if __name__ == '__main__':
             
             trainer.save_mesh(resolution=256, threshold=10)
 
+            if opt.bake:
+                trainer.save_baked(resolution=opt.bake_resolution)
+
+            if opt.compact:
+                trainer.save_compact(opt.compact)
+
+            if opt.cpu_benchmark:
+                trainer.benchmark_cpu_inference(tst_loaders)
+
 
 
 
@@ -0,0 +1,292 @@
+import math
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+from .utils import custom_meshgrid, query_bitfield, near_far_from_aabb
+
+
+# real spherical harmonics, same constants and ordering as shencoder (degree ** 2 coefficients).
+SH_C0 = 0.28209479177387814
+SH_C1 = 0.4886025119029199
+SH_C2 = [1.0925484305920792, -1.0925484305920792, 0.31539156525252005, -1.0925484305920792, 0.5462742152960396]
+
+
+def sh_basis(dirs, degree):
+    # dirs: [N, 3], normalized
+    # return: [N, degree ** 2]
+    assert 1 <= degree <= 3, 'baked grids only support SH degree in [1, 3]'
+
+    x, y, z = dirs.unbind(-1)
+    basis = [torch.full_like(x, SH_C0)]
+    if degree > 1:
+        basis += [-SH_C1 * y, SH_C1 * z, -SH_C1 * x]
+    if degree > 2:
+        xx, yy, zz = x * x, y * y, z * z
+        basis += [
+            SH_C2[0] * x * y,
+            SH_C2[1] * y * z,
+            SH_C2[2] * (3.0 * zz - 1),
+            SH_C2[3] * x * z,
+            SH_C2[4] * (xx - yy),
+        ]
+    return torch.stack(basis, dim=-1)
+
+
+def fibonacci_sphere(n, device=None):
+    # n roughly uniform unit directions, used to fit SH coefficients to the color network.
+    i = torch.arange(n, dtype=torch.float32, device=device) + 0.5
+    phi = torch.acos(1 - 2 * i / n)
+    theta = math.pi * (1 + 5 ** 0.5) * i
+    return torch.stack([torch.cos(theta) * torch.sin(phi), torch.sin(theta) * torch.sin(phi), torch.cos(phi)], dim=-1)
+
+
+@torch.no_grad()
+def bake_sparse_grid(model, resolution=256, block_size=8, sh_degree=2, num_dirs=64, chunk=2**16, occ_samples=4):
+    ''' bake a trained NeRFNetwork into a sparse block grid (no MLP needed for rendering).
+    Args:
+        model: NeRFNetwork, trained.
+        resolution: voxels per axis over model.aabb_infer, rounded up to a multiple of block_size.
+        block_size: voxels per block side. Only blocks touching occupied density grid cells are stored.
+        sh_degree: view-dependent color is stored as degree ** 2 SH coefficients per channel.
+        num_dirs: directions used to fit the SH coefficients to the color network.
+        chunk: number of points evaluated by the network at once.
+        occ_samples: samples per block side used to test block occupancy.
+    Returns:
+        dict of numpy arrays, see BakedGrid.
+    '''
+    device = model.aabb_infer.device
+    aabb = model.aabb_infer.float()
+    B = block_size
+    NB = math.ceil(resolution / B) # blocks per axis
+    resolution = NB * B
+    voxel = (aabb[3:] - aabb[:3]) / resolution # [3]
+    K = sh_degree ** 2
+
+    def occupied(xyzs):
+        if model.cuda_ray:
+            return query_bitfield(model.density_bitfield, xyzs, model.bound, model.cascade, model.grid_size)
+        sigmas = model.density(xyzs)['sigma'].reshape(-1).float() * model.density_scale
+        return sigmas > model.density_thresh
+
+    ### find occupied blocks
+    blocks = torch.arange(NB, dtype=torch.int32, device=device)
+    bx, by, bz = custom_meshgrid(blocks, blocks, blocks)
+    blocks = torch.stack([bx.reshape(-1), by.reshape(-1), bz.reshape(-1)], dim=-1) # [NB^3, 3]
+
+    offsets = (torch.arange(occ_samples, dtype=torch.float32, device=device) + 0.5) / occ_samples * B
+    ox, oy, oz = custom_meshgrid(offsets, offsets, offsets)
+    offsets = torch.stack([ox.reshape(-1), oy.reshape(-1), oz.reshape(-1)], dim=-1) # [S, 3], in voxels
+    S = offsets.shape[0]
+
+    block_mask = torch.zeros(blocks.shape[0], dtype=torch.bool, device=device)
+    step = max(1, chunk // S)
+    for head in range(0, blocks.shape[0], step):
+        tail = min(head + step, blocks.shape[0])
+        xyzs = aabb[:3] + (blocks[head:tail].float().unsqueeze(1) * B + offsets.unsqueeze(0)) * voxel # [b, S, 3]
+        block_mask[head:tail] = occupied(xyzs.reshape(-1, 3)).view(-1, S).any(dim=-1)
+
+    blocks = blocks[block_mask] # [M, 3]
+    M = blocks.shape[0]
+
+    ### evaluate density and fit SH at block vertices ((B + 1) ^ 3 per block, so lookups never cross blocks)
+    verts = torch.arange(B + 1, dtype=torch.float32, device=device)
+    vx, vy, vz = custom_meshgrid(verts, verts, verts)
+    verts = torch.stack([vx.reshape(-1), vy.reshape(-1), vz.reshape(-1)], dim=-1) # [V, 3]
+    V = verts.shape[0]
+
+    dirs = fibonacci_sphere(num_dirs, device=device) # [D, 3]
+    basis_pinv = torch.linalg.pinv(sh_basis(dirs, sh_degree)) # [K, D]
+
+    density = torch.zeros(M, V, dtype=torch.float16, device=device)
+    sh = torch.zeros(M, V, K, 3, dtype=torch.float16, device=device)
+
+    step = max(1, chunk // (V * num_dirs))
+    for head in range(0, M, step):
+        tail = min(head + step, M)
+        xyzs = aabb[:3] + (blocks[head:tail].float().unsqueeze(1) * B + verts.unsqueeze(0)) * voxel # [b, V, 3]
+        xyzs = xyzs.reshape(-1, 3)
+        P = xyzs.shape[0]
+
+        outputs = model.density(xyzs)
+        sigmas = outputs['sigma'].reshape(-1).float() * model.density_scale
+        geo_feat = outputs['geo_feat']
+
+        rgbs = model.color(xyzs.repeat_interleave(num_dirs, dim=0), dirs.repeat(P, 1),
+                           geo_feat=geo_feat.repeat_interleave(num_dirs, dim=0)) # [P * D, 3]
+        coeffs = torch.einsum('kd,pdc->pkc', basis_pinv, rgbs.float().view(P, num_dirs, 3)) # [P, K, 3]
+
+        density[head:tail] = sigmas.view(-1, V).half()
+        sh[head:tail] = coeffs.view(-1, V, K, 3).half()
+
+    return {
+        'aabb': aabb.cpu().numpy(),
+        'resolution': np.int32(resolution),
+        'block_size': np.int32(B),
+        'sh_degree': np.int32(sh_degree),
+        'block_coords': blocks.cpu().numpy().astype(np.int16),
+        'density': density.view(M, B + 1, B + 1, B + 1).cpu().numpy(),
+        'sh': sh.view(M, B + 1, B + 1, B + 1, K, 3).cpu().numpy(),
+    }
+
+
+def save_baked_grid(path, baked):
+    np.savez_compressed(path, **baked)
+
+
+class BakedGrid:
+    ''' MLP-free renderer over a sparse block grid produced by bake_sparse_grid.
+    Every sample is a trilinear lookup of density and SH coefficients, so it runs fine on CPU.
+    render() follows NeRFRenderer.render, so it can replace the model in Trainer.test_step / test_gui.
+    '''
+    def __init__(self, baked, device='cpu'):
+        if isinstance(baked, str):
+            baked = dict(np.load(baked))
+
+        self.device = torch.device(device)
+        self.aabb = torch.from_numpy(np.asarray(baked['aabb'], dtype=np.float32)).to(self.device)
+        self.resolution = int(baked['resolution'])
+        self.block_size = int(baked['block_size'])
+        self.sh_degree = int(baked['sh_degree'])
+        self.bg_radius = -1 # no background model, keeps the Trainer checks happy.
+
+        B = self.block_size
+        NB = self.resolution // B
+        K = self.sh_degree ** 2
+        block_coords = torch.from_numpy(baked['block_coords'].astype(np.int64)).to(self.device) # [M, 3]
+        M = block_coords.shape[0]
+        self.num_blocks = M
+
+        # dense block index, -1 means empty. NB^3 int32 is tiny compared to the voxels themselves.
+        self.block_index = torch.full((NB, NB, NB), -1, dtype=torch.int32, device=self.device)
+        self.block_index[block_coords[:, 0], block_coords[:, 1], block_coords[:, 2]] = torch.arange(M, dtype=torch.int32, device=self.device)
+
+        # features per vertex: [sigma, K * 3 SH coefficients], plus an all-zero block for empty space.
+        density = torch.from_numpy(baked['density']).float().view(M, -1, 1)
+        sh = torch.from_numpy(baked['sh']).float().view(M, -1, K * 3)
+        features = torch.cat([density, sh], dim=-1) # [M, V, C]
+        features = torch.cat([features, torch.zeros_like(features[:1])], dim=0) # [M + 1, V, C]
+        self.features = features.view(-1, 1 + K * 3).to(self.device) # [(M + 1) * V, C]
+        self.empty_block = M
+
+        self.voxel = (self.aabb[3:] - self.aabb[:3]) / self.resolution
+
+        # corner offsets for trilinear interpolation
+        corners = torch.tensor([[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)], dtype=torch.long, device=self.device)
+        self.corners = corners # [8, 3]
+
+    def query(self, xyzs, dirs=None, chunk=2**18):
+        # xyzs: [N, 3], dirs: [N, 3] or None
+        # return: sigmas [N], rgbs [N, 3] (None if dirs is None)
+        B = self.block_size
+        NB = self.resolution // B
+        V1 = B + 1
+        N = xyzs.shape[0]
+
+        sigmas = torch.zeros(N, device=self.device)
+        rgbs = torch.zeros(N, 3, device=self.device) if dirs is not None else None
+
+        for head in range(0, N, chunk):
+            tail = min(head + chunk, N)
+
+            u = (xyzs[head:tail] - self.aabb[:3]) / self.voxel # [n, 3], in voxels
+            inside = ((u >= 0) & (u <= self.resolution)).all(dim=-1)
+            u = u.clamp(0, self.resolution - 1e-4)
+            block = (u / B).long().clamp(max=NB - 1) # [n, 3]
+            slot = self.block_index[block[:, 0], block[:, 1], block[:, 2]].long() # [n]
+            valid = inside & (slot >= 0)
+            if not valid.any():
+                continue
+
+            # only gather the samples that actually fall inside a stored block.
+            u, block, slot = u[valid], block[valid], slot[valid]
+            local = u - block.float() * B # [n, 3], in [0, B]
+            base = local.floor().long().clamp(max=B - 1)
+            frac = local - base.float()
+
+            pos = base.unsqueeze(1) + self.corners.unsqueeze(0) # [n, 8, 3]
+            index = slot.unsqueeze(1) * V1 ** 3 + (pos[..., 0] * V1 + pos[..., 1]) * V1 + pos[..., 2] # [n, 8]
+            w = torch.where(self.corners.unsqueeze(0).bool(), frac.unsqueeze(1), 1 - frac.unsqueeze(1)).prod(dim=-1) # [n, 8]
+            feats = (self.features[index] * w.unsqueeze(-1)).sum(dim=1) # [n, C]
+
+            inds = torch.nonzero(valid).squeeze(-1) + head
+            sigmas[inds] = F.relu(feats[:, 0])
+            if dirs is not None:
+                basis = sh_basis(dirs[inds], self.sh_degree) # [n, K]
+                coeffs = feats[:, 1:].view(-1, self.sh_degree ** 2, 3)
+                rgbs[inds] = torch.einsum('nk,nkc->nc', basis, coeffs).clamp(0, 1)
+
+        return sigmas, rgbs
+
+    @torch.no_grad()
+    def run(self, rays_o, rays_d, num_steps=128, bg_color=None, perturb=False, max_far=5, min_near=.2, **kwargs):
+        # rays_o, rays_d: [B, N, 3], assumes B == 1
+        # return: image: [B, N, 3], depth: [B, N]
+        prefix = rays_o.shape[:-1]
+        rays_o = rays_o.contiguous().view(-1, 3).to(self.device).float()
+        rays_d = rays_d.contiguous().view(-1, 3).to(self.device).float()
+        N = rays_o.shape[0]
+
+        nears, fars = near_far_from_aabb(rays_o, rays_d, self.aabb)
+        fars = fars.clamp(min_near, max_far)
+        nears = nears.clamp(min_near, max_far)
+        nears, fars = nears.unsqueeze(-1), fars.unsqueeze(-1)
+
+        z_vals = torch.linspace(0.0, 1.0, num_steps, device=self.device).unsqueeze(0)
+        z_vals = nears + (fars - nears) * z_vals # [N, T]
+        sample_dist = (fars - nears) / num_steps
+        if perturb:
+            z_vals = z_vals + (torch.rand(z_vals.shape, device=self.device) - 0.5) * sample_dist
+
+        xyzs = rays_o.unsqueeze(-2) + rays_d.unsqueeze(-2) * z_vals.unsqueeze(-1) # [N, T, 3]
+        dirs = rays_d.unsqueeze(-2).expand_as(xyzs)
+
+        sigmas, rgbs = self.query(xyzs.reshape(-1, 3), dirs.reshape(-1, 3))
+        sigmas = sigmas.view(N, num_steps)
+        rgbs = rgbs.view(N, num_steps, 3)
+
+        deltas = z_vals[..., 1:] - z_vals[..., :-1]
+        deltas = torch.cat([deltas, sample_dist], dim=-1)
+        alphas = 1 - torch.exp(-deltas * sigmas)
+        alphas_shifted = torch.cat([torch.ones_like(alphas[..., :1]), 1 - alphas + 1e-15], dim=-1)
+        weights = alphas * torch.cumprod(alphas_shifted, dim=-1)[..., :-1] # [N, T]
+
+        weights_sum = weights.sum(dim=-1)
+        depth = torch.sum(weights * z_vals, dim=-1) + (1 - weights_sum) * fars.squeeze(-1)
+        image = torch.sum(weights.unsqueeze(-1) * rgbs, dim=-2)
+
+        if bg_color is None:
+            bg_color = 1
+        elif torch.is_tensor(bg_color):
+            bg_color = bg_color.to(self.device)
+        image = image + (1 - weights_sum).unsqueeze(-1) * bg_color
+
+        return {
+            'depth': depth.view(*prefix),
+            'image': image.view(*prefix, 3),
+            'weights_sum': weights_sum.view(*prefix),
+        }
+
+    def render(self, rays_o, rays_d, staged=False, max_ray_batch=4096, **kwargs):
+        # rays_o, rays_d: [B, N, 3]
+        # return: pred_rgb: [B, N, 3], results stay on the device the rays came from.
+        device = rays_o.device
+        B, N = rays_o.shape[:2]
+
+        if not staged:
+            results = self.run(rays_o, rays_d, **kwargs)
+        else:
+            depth = torch.empty((B, N), device=self.device)
+            image = torch.empty((B, N, 3), device=self.device)
+            for b in range(B):
+                head = 0
+                while head < N:
+                    tail = min(head + max_ray_batch, N)
+                    results_ = self.run(rays_o[b:b+1, head:tail], rays_d[b:b+1, head:tail], **kwargs)
+                    depth[b:b+1, head:tail] = results_['depth']
+                    image[b:b+1, head:tail] = results_['image']
+                    head += max_ray_batch
+            results = {'depth': depth, 'image': image}
+
+        return {k: v.to(device) for k, v in results.items()}
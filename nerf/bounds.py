@@ -0,0 +1,167 @@
+import os
+import copy
+import json
+import numpy as np
+
+import torch
+
+from .utils import get_rays
+
+
+@torch.no_grad()
+def backproject(dataset, stride=4, frames=None):
+    ''' back-project the valid pixels of a depth / touch training set into points.
+    Poses, intrinsics and depths are the dataset's, i.e. already in the normalized space (m2mm, scale and offset applied).
+    Args:
+        dataset: NeRFDepthDataset or NeRFTouchDataset with images.
+        stride: keep one valid pixel every stride.
+        frames: indices of the frames to use, all by default.
+    Returns:
+        points: [P, 3], measured surface points.
+        origins: [P, 3], origin of the ray of each point (the space in between is observed empty).
+    '''
+    camera_model = 'touch' if dataset.datatype == 'touch' else 'pinhole'
+    points, origins = [], []
+    for i in (range(len(dataset.images)) if frames is None else frames):
+        H, W = int(dataset.H[i]), int(dataset.W[i])
+        depth = dataset.images[i].reshape(-1).float().cpu() # [H * W], distance along the ray
+        inds = dataset.valid_inds[i].long().cpu()[::stride]
+        inds = inds[depth[inds] < dataset.far[i]] # far is "no return"
+
+        rays = get_rays(dataset.poses[i:i+1].float().cpu(), dataset.intrinsics[i], H, W, -1, camera_model=camera_model)
+        rays_o = rays['rays_o'][0][inds] # [n, 3]
+        rays_d = rays['rays_d'][0][inds] # [n, 3]
+
+        points.append(rays_o + rays_d * depth[inds].unsqueeze(-1))
+        origins.append(rays_o)
+
+    return torch.cat(points, dim=0), torch.cat(origins, dim=0)
+
+
+def robust_aabb(points, percentile=0.5, margin=0.05):
+    # [6] aabb of the points, ignoring the percentile % outliers on each side, padded by margin * extent.
+    points = points.cpu().numpy()
+    lo = np.percentile(points, percentile, axis=0)
+    hi = np.percentile(points, 100 - percentile, axis=0)
+    pad = margin * (hi - lo)
+    return np.concatenate([lo - pad, hi + pad])
+
+
+def fit_bounds(aabb, scale, offset, bound, fill=0.9):
+    ''' scale and offset that center the aabb and make its longest side fill a fraction of [-bound, bound]^3.
+    Points transform as p' = k * (p - center), so scale' = k * scale and offset' = k * (offset - center).
+    Returns:
+        scale: float, offset: [3], aabb: [6] in the new normalized space.
+    '''
+    lo, hi = aabb[:3], aabb[3:]
+    center = (lo + hi) / 2
+    k = fill * bound / max((hi - lo).max() / 2, 1e-8)
+    new_aabb = np.concatenate([k * (lo - center), k * (hi - center)])
+    return float(scale * k), (k * (np.asarray(offset, dtype=np.float64) - center)).tolist(), new_aabb.tolist()
+
+
+def auto_bounds(opt, device, stride=4, fill=0.9):
+    ''' tight scene bounds from the depth / touch training frames, cached in <path>/bounds.json.
+    The frames are read with the --scale / --offset given on the command line, and the sidecar is reused
+    as long as those (and --bound) do not change.
+    Returns:
+        dict with scale, offset and aabb (in the space given by the new scale and offset).
+    '''
+    # imported here, the providers import nerf.utils too.
+    from .depth_provider import NeRFDepthDataset
+    from .touch_provider import NeRFTouchDataset
+
+    path = os.path.join(opt.path, 'bounds.json')
+    source = {'scale': opt.scale, 'offset': list(opt.offset), 'bound': opt.bound, 'image_type': sorted(t for t in ['depth', 'touch'] if t in opt.image_type)}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            bounds = json.load(f)
+        if bounds['source'] == source:
+            print(f'[INFO] loaded scene bounds from {path}')
+            return bounds
+
+    if len(source['image_type']) == 0:
+        raise RuntimeError('automatic bounds need depth or touch frames (--image_type)')
+
+    # read the frames lazily, one at a time.
+    tmp_opt = copy.copy(opt)
+    tmp_opt.preload = False
+    tmp_opt.error_map = False
+    tmp_opt.cache_frames = 1
+    datasets = []
+    if 'depth' in opt.image_type:
+        datasets.append(NeRFDepthDataset(tmp_opt, device='cpu', type='train'))
+    if 'touch' in opt.image_type:
+        datasets.append(NeRFTouchDataset(tmp_opt, device='cpu', type='train'))
+
+    points = torch.cat([backproject(dataset, stride)[0] for dataset in datasets], dim=0)
+    aabb = robust_aabb(points)
+    scale, offset, new_aabb = fit_bounds(aabb, opt.scale, opt.offset, opt.bound, fill)
+
+    bounds = {
+        'scale': scale,
+        'offset': offset,
+        'aabb': new_aabb,
+        'num_points': points.shape[0],
+        'source': source,
+    }
+    with open(path, 'w') as f:
+        json.dump(bounds, f, indent=2)
+
+    print(f'[INFO] scene bounds from {points.shape[0]} points: scale = {scale:.6f}, offset = {offset}, aabb = {new_aabb}, saved to {path}')
+    return bounds
+
+
+@torch.no_grad()
+def project_min_depth(points, pose, intrinsics, H, W, cell=4):
+    # [ceil(H / cell), ceil(W / cell)] z-buffer of the distance from the camera to the closest points seen in each cell (inf if none).
+    fx, fy, cx, cy = intrinsics[:4]
+    Hc, Wc = -(-H // cell), -(-W // cell)
+
+    offsets = points - pose[:3, 3] # [P, 3]
+    cam = offsets @ pose[:3, :3] # [P, 3], world to camera (rotation transposed)
+    z = cam[:, 2]
+    front = z > 0
+    u = fx * cam[:, 0] / z.clamp(min=1e-8) + cx
+    v = fy * cam[:, 1] / z.clamp(min=1e-8) + cy
+    inside = front & (u >= 0) & (u < W) & (v >= 0) & (v < H)
+
+    cells = (v[inside].long() // cell) * Wc + (u[inside].long() // cell)
+    zbuf = torch.full((Hc * Wc,), float('inf'))
+    zbuf.scatter_reduce_(0, cells, offsets[inside].norm(dim=-1), reduce='amin')
+    return zbuf.view(Hc, Wc)
+
+
+def depth_priors(color, depth, cell=4, neighbours=4, stride=2):
+    ''' per pixel depth prior of the color frames, from the depth frames projected into each color view.
+    Each color frame takes the points of its nearest depth cameras and keeps the closest one per cell of cell x cell pixels
+    (the distance along the ray, as rendered). Computed once and kept in memory, the result is reused for every batch.
+    Args:
+        color: NeRFDataset (pinhole), depth: NeRFDepthDataset, in the same normalized space.
+        neighbours: number of depth frames projected into each color frame.
+    Returns:
+        [F, Hc, Wc] float tensor (inf where no depth was seen), to be set as color.depth_prior with color.prior_cell = cell.
+    '''
+    points = [backproject(depth, stride, frames=[k])[0] for k in range(len(depth.images))]
+    depth_centers = depth.poses[:, :3, 3].float().cpu() # [D, 3]
+
+    Hc, Wc = -(-int(color.H.max()) // cell), -(-int(color.W.max()) // cell)
+    priors = torch.full((len(color.poses), Hc, Wc), float('inf'))
+    for i in range(len(color.poses)):
+        pose = color.poses[i].float().cpu()
+        H, W = int(color.H[i]), int(color.W[i])
+        nearest = (depth_centers - pose[:3, 3]).norm(dim=-1).argsort()[:neighbours]
+        P = torch.cat([points[k] for k in nearest.tolist()], dim=0)
+        prior = project_min_depth(P, pose, color.intrinsics[i], H, W, cell)
+        priors[i, :prior.shape[0], :prior.shape[1]] = prior
+
+    found = torch.isfinite(priors).float().mean().item()
+    print(f'[INFO] depth priors for {len(color.poses)} color frames from {len(depth.images)} depth frames, {found * 100:.1f}% of the cells covered')
+    return priors
+
+
+def prior_at(priors, index, inds, W, cell=4):
+    # [B, N] depth prior of the pixels inds ([B, N] flat indices) of frame index.
+    rows = torch.div(inds, W * cell, rounding_mode='floor') # (inds // W) // cell
+    cols = torch.div(inds % W, cell, rounding_mode='floor')
+    return priors[index][rows, cols]
@@ -2,6 +2,7 @@ import os
 import cv2
 import glob
 import json
+from functools import partial
 from cv2 import transform
 import tqdm
 import numpy as np
@@ -12,7 +13,7 @@ import trimesh
 import torch
 from torch.utils.data import DataLoader
 
-from .utils import get_rays, srgb_to_linear, torch_vis_2d
+from .utils import image_size, to_device, ErrorMap, LazyFrames, PrefetchSampler, get_rays, srgb_to_linear, torch_vis_2d
 import matplotlib.pyplot as plt
 import pprint
 
@@ -133,6 +134,7 @@ class NeRFDepthDataset:
         self.offset = opt.offset # camera offset
         self.bound = opt.bound # bounding box half length, also used as the radius to random sample poses.
         self.fp16 = opt.fp16 # if preload, load into fp16.
+        self.lazy = not self.preload and opt.cache_frames > 0 # decode frames on demand into a bounded cache.
         self.config = None 
 
         self.training = self.type in ['train', 'all', 'trainval']
@@ -246,7 +248,12 @@ class NeRFDepthDataset:
                 pose[:3,3] = m2mm*pose[:3,3]
                 pose = nerf_matrix_to_ngp(pose, scale=self.scale, offset=self.offset)
 
-                image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
+                if self.lazy:
+                    image = None
+                    shape = image_size(f_path) # header only, the frame is decoded when first sampled.
+                else:
+                    image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
+                    shape = image.shape
 
                 # check if we have multiple cameras in use
                 if "cameras" in transform:
@@ -269,8 +276,8 @@ class NeRFDepthDataset:
                         self.H.append(transform[f['camera']]["H"] // downscale)
                         self.W.append(transform[f['camera']]["W"] // downscale)
                     else:
-                        self.H.append(image.shape[0] // downscale)
-                        self.W.append(image.shape[1] // downscale)
+                        self.H.append(shape[0] // downscale)
+                        self.W.append(shape[1] // downscale)
 
                 # only one camera in use
                 else:
@@ -293,22 +300,29 @@ class NeRFDepthDataset:
                         self.W.append(transform["W"] // downscale)
 
                     else: #self.H is None or self.W is None:
-                        self.H.append(image.shape[0] // downscale)
-                        self.W.append(image.shape[1] // downscale)
-
-                # check if image matches with expected dimensions, if not interpolate to make it fit
-                if image.shape[0] != self.H[-1] or image.shape[1] != self.W[-1]:
-                    image = cv2.resize(image, (self.W[-1], self.H[-1]), interpolation=cv2.INTER_AREA)
+                        self.H.append(shape[0] // downscale)
+                        self.W.append(shape[1] // downscale)
 
-                # convert images into raw distance based on camera intrinics
-                image = image.astype(np.float32) / (255.)*(self.far[-1] - self.near[-1]) + self.near[-1] # [H, W, 3/4]
-                image = torch.unsqueeze(torch.from_numpy(image),dim=-1)
 
                 self.poses.append(pose)
-                self.images.append(image)
+                if self.lazy:
+                    self.images.append(partial(self.load_image, f_path, self.H[-1], self.W[-1], self.near[-1], self.far[-1]))
+                else:
+                    self.images.append(self.load_image(f_path, self.H[-1], self.W[-1], self.near[-1], self.far[-1], image))
         
 
 
+        if self.lazy and self.images is not None:
+            self.images = LazyFrames(self.images, capacity=opt.cache_frames)
+
+        # flat indices of the pixels with a valid depth, rays are only sampled among them.
+        if self.images is None:
+            self.valid_inds = None
+        elif self.lazy:
+            self.valid_inds = LazyFrames([partial(self.load_valid, i) for i in range(len(self.images))], capacity=opt.cache_frames) # computed once the frame is decoded
+        else:
+            self.valid_inds = [self.valid_pixels(image, near) for image, near in zip(self.images, self.near)]
+
         self.H = np.asarray(self.H)
         self.W = np.asarray(self.W)
         self.near = np.asarray(self.near)
@@ -321,7 +335,7 @@ class NeRFDepthDataset:
 
         # initialize error_map
         if self.training and self.opt.error_map:
-            self.error_map = torch.ones([len(self.images), 128 * 128], dtype=torch.float) # [B, 128 * 128], flattened for easy indexing, fixed resolution...
+            self.error_map = ErrorMap(len(self.images), int(self.H.max()), int(self.W.max())) # importance sampling on a coarse grid, one per frame.
         else:
             self.error_map = None
 
@@ -340,6 +354,7 @@ class NeRFDepthDataset:
                 else:
                     dtype = torch.float
                 self.images = self.images.to(dtype).to(self.device)
+                self.valid_inds = [inds.to(self.device) for inds in self.valid_inds]
             if self.error_map is not None:
                 self.error_map = self.error_map.to(self.device)
 
@@ -446,6 +461,26 @@ class NeRFDepthDataset:
         print(self.intrinsics)
 
 
+    def load_image(self, f_path, H, W, near, far, image=None):
+        # decode one frame into a [H, W, 1] float tensor of raw distances.
+        if image is None:
+            image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED)
+
+        # check if image matches with expected dimensions, if not interpolate to make it fit
+        if image.shape[0] != H or image.shape[1] != W:
+            image = cv2.resize(image, (W, H), interpolation=cv2.INTER_AREA)
+
+        # convert images into raw distance based on camera intrinics
+        image = image.astype(np.float32) / (255.)*(far - near) + near # [H, W, 3/4]
+        return torch.unsqueeze(torch.from_numpy(image),dim=-1)
+
+    def valid_pixels(self, image, near):
+        # [M] flat indices of the pixels with a valid depth (invalid / zero depth is decoded to near).
+        return torch.nonzero(image.view(-1) > near, as_tuple=True)[0].int()
+
+    def load_valid(self, index):
+        return self.valid_pixels(self.images[index], self.near[index])
+
     def collate(self, index):
 
         B = len(index) # a list of length 1
@@ -472,11 +507,12 @@ class NeRFDepthDataset:
                 'far': float(self.far[index])
             }
 
-        poses = self.poses[index].to(self.device) # [B, 4, 4]
+        poses = to_device(self.poses[index], self.device) # [B, 4, 4]
 
         error_map = None if self.error_map is None else self.error_map[index]
+        valid_inds = None if self.valid_inds is None else to_device(self.valid_inds[index], self.device)
 
-        rays = get_rays(torch.unsqueeze(poses,0), self.intrinsics[index], int(self.H[index]), int(self.W[index]), self.num_rays, error_map)
+        rays = get_rays(torch.unsqueeze(poses,0), self.intrinsics[index], int(self.H[index]), int(self.W[index]), self.num_rays, error_map, valid_inds=valid_inds)
         
         results = {
             'type': 'depth',
@@ -489,7 +525,7 @@ class NeRFDepthDataset:
         }
 
         if self.images is not None:
-            images = self.images[index].to(self.device) # [B, H, W, 3/4]
+            images = to_device(self.images[index], self.device) # [B, H, W, 3/4]
             if self.training:
                 C = images.shape[-1]
                 images = torch.gather(images.view(B, -1, C), 1, torch.stack(C * [rays['inds']], -1)) # [B, N, 3/4]
@@ -507,7 +543,8 @@ class NeRFDepthDataset:
         size = len(self.poses)
         if self.training and self.rand_pose > 0:
             size += size // self.rand_pose # index >= size means we use random pose.
-        loader = DataLoader(list(range(size)), batch_size=1, collate_fn=self.collate, shuffle=self.training, num_workers=0)
+        sampler = PrefetchSampler(size, [self.images, self.valid_inds], shuffle=self.training, depth=self.opt.prefetch_frames) if isinstance(self.images, LazyFrames) else None
+        loader = DataLoader(list(range(size)), batch_size=1, collate_fn=self.collate, shuffle=self.training and sampler is None, sampler=sampler, num_workers=0)
         loader._data = self # an ugly fix... we need to access error_map & poses in trainer.
         loader.has_gt = self.images is not None
         
@@ -18,6 +18,9 @@ class NeRFNetwork(NeRFRenderer):
                  num_layers_color=3,
                  hidden_dim_color=64,
                  bound=1,
+                 num_levels=16,
+                 log2_hashmap_size=19,
+                 desired_resolution=None,
                  **kwargs
                  ):
         super().__init__(bound, **kwargs)
@@ -26,7 +29,9 @@ class NeRFNetwork(NeRFRenderer):
         self.num_layers = num_layers
         self.hidden_dim = hidden_dim
         self.geo_feat_dim = geo_feat_dim
-        self.encoder, self.in_dim = get_encoder(encoding, desired_resolution=2048 * bound)
+        # finest resolution 2048 * bound unless given (e.g. as recommended by --grid_stats)
+        desired_resolution = desired_resolution or 2048 * bound
+        self.encoder, self.in_dim = get_encoder(encoding, num_levels=num_levels, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution)
 
         self.sigma_net = FFMLP(
             input_dim=self.in_dim, 
@@ -137,13 +142,13 @@ class NeRFNetwork(NeRFRenderer):
     def get_params(self, lr):
 
         params = [
-            {'params': self.encoder.parameters(), 'lr': lr},
+            {'params': self.encoder.parameters(), 'lr': lr, 'sparse': True}, # embedding tables, row-wise with RowAdam
             {'params': self.sigma_net.parameters(), 'lr': lr},
             {'params': self.encoder_dir.parameters(), 'lr': lr},
             {'params': self.color_net.parameters(), 'lr': lr}, 
         ]
         if self.bg_radius > 0:
-            params.append({'params': self.encoder_bg.parameters(), 'lr': lr})
+            params.append({'params': self.encoder_bg.parameters(), 'lr': lr, 'sparse': True})
             params.append({'params': self.bg_net.parameters(), 'lr': lr})
         
         return params
\ No newline at end of file
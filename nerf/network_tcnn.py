@@ -19,6 +19,9 @@ class NeRFNetwork(NeRFRenderer):
                  num_layers_color=3,
                  hidden_dim_color=64,
                  bound=1,
+                 num_levels=16,
+                 log2_hashmap_size=19,
+                 desired_resolution=None,
                  **kwargs
                  ):
         super().__init__(bound, **kwargs)
@@ -28,22 +31,23 @@ class NeRFNetwork(NeRFRenderer):
         self.hidden_dim = hidden_dim
         self.geo_feat_dim = geo_feat_dim
 
-        per_level_scale = np.exp2(np.log2(2048 * bound / 16) / (16 - 1))
+        desired_resolution = desired_resolution or 2048 * bound
+        per_level_scale = np.exp2(np.log2(desired_resolution / 16) / (num_levels - 1))
 
         self.encoder = tcnn.Encoding(
             n_input_dims=3,
             encoding_config={
                 "otype": "HashGrid",
-                "n_levels": 16,
+                "n_levels": num_levels,
                 "n_features_per_level": 2,
-                "log2_hashmap_size": 19,
+                "log2_hashmap_size": log2_hashmap_size,
                 "base_resolution": 16,
                 "per_level_scale": per_level_scale,
             },
         )
 
         self.sigma_net = tcnn.Network(
-            n_input_dims=32,
+            n_input_dims=num_levels * 2,
             n_output_dims=1 + self.geo_feat_dim,
             network_config={
                 "otype": "FullyFusedMLP",
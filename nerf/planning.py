@@ -0,0 +1,144 @@
+import torch
+
+from .utils import get_rays, grid_indices, query_bitfield, near_far_from_aabb
+
+
+class CandidateScorer:
+    ''' batched scoring of candidate camera / touch sensor poses for active view and touch planning.
+    Each sensor caches its subsampled camera-space ray directions once (pinhole or touch fisheye, as in get_rays).
+    Candidates are scored by a density-only volume render (the color network is never queried),
+    and with cuda_ray the samples in empty density grid cells are skipped before the density network.
+    '''
+    def __init__(self, model, num_steps=64, chunk=2**18, unknown_weight=1):
+        # model: trained NeRFRenderer, used read-only.
+        # num_steps: samples per ray between the sensor near and far planes.
+        # chunk: max samples per round, bounds the memory and latency of one network call.
+        # unknown_weight: weight of the untrained-space term in the combined score.
+        self.model = model
+        self.num_steps = num_steps
+        self.chunk = chunk
+        self.unknown_weight = unknown_weight
+        self.sensors = {}
+
+    @torch.no_grad()
+    def add_sensor(self, name, intrinsics, H, W, camera_model='pinhole', near=0.2, far=5, stride=8):
+        # intrinsics: [fx, fy, cx, cy, sensor_size], as in the providers.
+        # stride: keep one pixel every stride rows / columns (reduced ray density).
+        device = self.model.aabb_infer.device
+
+        pose = torch.eye(4, dtype=torch.float32, device=device).unsqueeze(0)
+        rays = get_rays(pose, intrinsics, H, W, -1, camera_model=camera_model)
+        dirs = rays['rays_d'][0] # [H*W, 3], in camera space since the pose is identity
+
+        keep = torch.zeros(H, W, dtype=torch.bool, device=device)
+        keep[stride // 2::stride, stride // 2::stride] = True
+        keep = keep.view(-1)
+        if camera_model == 'touch':
+            keep &= rays['mask'][0] # only pixels inside the fisheye fov
+
+        self.sensors[name] = {
+            'dirs': dirs[keep].contiguous(), # [R, 3]
+            'near': near,
+            'far': far,
+        }
+
+    @torch.no_grad()
+    def score(self, poses, sensor):
+        # poses: [C, 4, 4], candidate sensor poses (same convention as the dataset poses)
+        # sensor: name given to add_sensor, or a list of C names to mix sensors in one call.
+        # return: dict of [C] tensors
+        #   coverage: fraction of rays that hit a surface (opacity > 0.5) within [near, far].
+        #   depth_std: mean depth standard deviation of the rays that hit, relative to (far - near).
+        #   unknown: mean transmittance-weighted fraction of samples in untrained grid cells (cuda_ray only).
+        #   score: coverage * depth_std + unknown_weight * unknown, larger is more informative.
+        C = poses.shape[0]
+        device = poses.device
+
+        if isinstance(sensor, str):
+            sensor = [sensor] * C
+
+        results = {k: torch.zeros(C, device=device) for k in ['coverage', 'depth_std', 'unknown', 'score']}
+
+        for name in set(sensor):
+            inds = torch.tensor([i for i, s in enumerate(sensor) if s == name], dtype=torch.long, device=device)
+            outputs = self.score_sensor(poses[inds], self.sensors[name])
+            for k in results:
+                results[k][inds] = outputs[k]
+
+        return results
+
+    @torch.no_grad()
+    def score_sensor(self, poses, sensor):
+        # poses: [C, 4, 4], all candidates of one sensor.
+        model = self.model
+        T = self.num_steps
+        near, far = sensor['near'], sensor['far']
+
+        C = poses.shape[0]
+        dirs = sensor['dirs'] # [R, 3]
+        R = dirs.shape[0]
+
+        rays_d = (dirs @ poses[:, :3, :3].transpose(-1, -2)).reshape(-1, 3) # [C * R, 3]
+        rays_o = poses[:, None, :3, 3].expand(C, R, 3).reshape(-1, 3) # [C * R, 3]
+
+        nears, fars = near_far_from_aabb(rays_o, rays_d, model.aabb_infer, near)
+        fars = fars.clamp(max=far)
+        valid = fars > nears # [C * R]
+
+        N = rays_o.shape[0]
+        weights_sum = torch.zeros(N, device=rays_o.device)
+        depth_var = torch.zeros(N, device=rays_o.device)
+        unknown = torch.zeros(N, device=rays_o.device)
+
+        steps = torch.linspace(0, 1, T, device=rays_o.device) # [T]
+        ray_batch = max(1, self.chunk // T)
+
+        valid_rays = valid.nonzero(as_tuple=True)[0]
+        for head in range(0, valid_rays.shape[0], ray_batch):
+            rays = valid_rays[head:head + ray_batch] # [n]
+            n = rays.shape[0]
+
+            z_vals = nears[rays, None] + (fars - nears)[rays, None] * steps # [n, T]
+            deltas = ((fars - nears)[rays] / (T - 1)).unsqueeze(-1).expand(n, T) # [n, T]
+            xyzs = (rays_o[rays, None] + rays_d[rays, None] * z_vals.unsqueeze(-1)).view(-1, 3) # [n * T, 3]
+
+            sigmas = torch.zeros(n * T, device=xyzs.device)
+            if model.cuda_ray:
+                cells = grid_indices(xyzs, model.bound, model.cascade, model.grid_size)
+                occupied = query_bitfield(model.density_bitfield, xyzs, model.bound, model.cascade, model.grid_size)
+                untrained = (model.density_grid.view(-1)[cells] == -1).float().view(n, T) # marked by mark_untrained_grid, not the observed empty cells (-2)
+            else:
+                occupied = torch.ones(n * T, dtype=torch.bool, device=xyzs.device)
+                untrained = None
+
+            occupied = occupied.nonzero(as_tuple=True)[0]
+            if occupied.shape[0] > 0:
+                sigmas[occupied] = model.density_scale * model.density(xyzs[occupied])['sigma'].reshape(-1).float()
+            sigmas = sigmas.view(n, T)
+
+            alphas = 1 - torch.exp(-deltas * sigmas) # [n, T]
+            transmittance = torch.cumprod(torch.cat([torch.ones_like(alphas[:, :1]), 1 - alphas + 1e-15], dim=-1), dim=-1)[:, :-1] # [n, T]
+            weights = alphas * transmittance # [n, T]
+
+            wsum = weights.sum(dim=-1) # [n]
+            depth = (weights * z_vals).sum(dim=-1) / wsum.clamp(min=1e-8)
+            weights_sum[rays] = wsum
+            depth_var[rays] = (weights * (z_vals - depth.unsqueeze(-1)) ** 2).sum(dim=-1) / wsum.clamp(min=1e-8)
+
+            if untrained is not None:
+                unknown[rays] = (transmittance * untrained).mean(dim=-1)
+
+        weights_sum = weights_sum.view(C, R)
+        hits = (weights_sum > 0.5).float()
+        depth_std = depth_var.view(C, R).sqrt() / (far - near)
+
+        coverage = hits.mean(dim=-1)
+        depth_std = (depth_std * hits).sum(dim=-1) / hits.sum(dim=-1).clamp(min=1)
+        unknown = unknown.view(C, R).mean(dim=-1)
+
+        return {
+            'coverage': coverage,
+            'depth_std': depth_std,
+            'unknown': unknown,
+            'score': coverage * depth_std + self.unknown_weight * unknown,
+        }
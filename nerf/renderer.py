@@ -7,7 +7,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import raymarching
-from .utils import custom_meshgrid
+from .utils import custom_meshgrid, grid_indices, query_bitfield, near_far_from_aabb
 import matplotlib.pyplot as plt
 
 def sample_pdf(bins, weights, n_samples, det=False):
@@ -47,6 +47,15 @@ def sample_pdf(bins, weights, n_samples, det=False):
     return samples
 
 
+def is_out_of_memory(e):
+    # allocation failures of cuda (torch.cuda.OutOfMemoryError, 'CUDA out of memory') and of the cpu allocator
+    # ('DefaultCPUAllocator: not enough memory'), both raised as RuntimeError.
+    oom = getattr(torch.cuda, 'OutOfMemoryError', None) # torch >= 1.13
+    if oom is not None and isinstance(e, oom):
+        return True
+    return any(m in str(e) for m in ['out of memory', 'not enough memory', 'DefaultCPUAllocator'])
+
+
 def plot_pointcloud(pc, color=None):
     # pc: [N, 3]
     # color: [N, 3/4]
@@ -79,6 +88,7 @@ class NeRFRenderer(nn.Module):
         # self.max_far = max_far
         self.density_thresh = density_thresh
         self.bg_radius = bg_radius # radius of the background sphere.
+        self.oom_ray_batch = None # largest staged ray batch known to fit, set when a budgeted render runs out of memory.
 
         # prepare aabb with a 6D tensor (xmin, ymin, zmin, xmax, ymax, zmax)
         # NOTE: aabb (can be rectangular) is only used to generate points, we still rely on bound (always cubic) to calculate density grid and hashing.
@@ -125,11 +135,42 @@ class NeRFRenderer(nn.Module):
         self.mean_count = 0
         self.local_step = 0
 
+    def prior_z_vals(self, nears, fars, prior, num_steps, window=0.05, uniform=0.25, perturb=False):
+        # sample positions concentrated around a depth prior.
+        # nears, fars, prior: [N, 1]; rays with a finite prior inside [near, far] get (1 - uniform) of the samples
+        # in prior * [1 - window, 1 + window] and the rest uniformly in [near, far] (so occluders in front are still found),
+        # rays without a prior are sampled uniformly.
+        # return: [N, T], sorted.
+        N = nears.shape[0]
+        device = nears.device
+        T_u = min(num_steps, max(2, round(num_steps * uniform)))
+        T_p = num_steps - T_u
+
+        has_prior = torch.isfinite(prior) & (prior > nears) & (prior < fars) # [N, 1]
+        prior = torch.where(has_prior, prior, nears)
+        lo = torch.max(prior * (1 - window), nears)
+        hi = torch.min(prior * (1 + window), fars)
+
+        t = torch.linspace(0.0, 1.0, num_steps, device=device).expand(N, num_steps) # [N, T]
+        t_u = torch.linspace(0.0, 1.0, T_u, device=device).expand(N, T_u) # [N, T_u]
+        t_p = torch.linspace(0.0, 1.0, T_p, device=device).expand(N, T_p) # [N, T_p]
+        if perturb: # jitter every sample within its own spacing
+            t = t + (torch.rand(N, num_steps, device=device) - 0.5) / num_steps
+            t_u = t_u + (torch.rand(N, T_u, device=device) - 0.5) / T_u
+            t_p = t_p + (torch.rand(N, T_p, device=device) - 0.5) / max(T_p, 1)
+
+        z_uniform = nears + (fars - nears) * t # [N, T]
+        z_prior = torch.cat([nears + (fars - nears) * t_u, lo + (hi - lo) * t_p], dim=-1) # [N, T]
+        z_prior = torch.sort(z_prior, dim=-1)[0]
+
+        return torch.where(has_prior, z_prior, z_uniform)
+
     def run(self, rays_o, rays_d, num_steps=128, upsample_steps=128, 
             bg_color=None, perturb=False, datatype='rgb',
-            max_far=5, min_near=.2, **kwargs):
+            max_far=5, min_near=.2, depth_prior=None, prior_window=0.05, prior_uniform=0.25, **kwargs):
         # rays_o, rays_d: [B, N, 3], assumes B == 1
         # bg_color: [3] in range [0, 1]
+        # depth_prior: [B, N], expected distance along each ray (inf if unknown), see prior_z_vals.
         # return: image: [B, N, 3], depth: [B, N]
 
 
@@ -168,9 +209,12 @@ class NeRFRenderer(nn.Module):
 
         #print(f'nears = {nears.min().item()} ~ {nears.max().item()}, fars = {fars.min().item()} ~ {fars.max().item()}')
 
-        z_vals = torch.linspace(0.0, 1.0, num_steps, device=device).unsqueeze(0) # [1, T]
-        z_vals = z_vals.expand((N, num_steps)) # [N, T]
-        z_vals = nears + (fars - nears) * z_vals # [N, T], in [nears, fars]
+        if depth_prior is not None:
+            z_vals = self.prior_z_vals(nears, fars, depth_prior.reshape(-1, 1), num_steps, prior_window, prior_uniform, perturb) # [N, T]
+        else:
+            z_vals = torch.linspace(0.0, 1.0, num_steps, device=device).unsqueeze(0) # [1, T]
+            z_vals = z_vals.expand((N, num_steps)) # [N, T]
+            z_vals = nears + (fars - nears) * z_vals # [N, T], in [nears, fars]
 
         #if datatype == 'rgb' or datatype == 'depth':
         #    print("Z VALS")
@@ -213,7 +257,7 @@ class NeRFRenderer(nn.Module):
         #    print("sample dist")
         #    print(sample_dist)
         #    print(torch.any(torch.isnan(sample_dist)))
-        if perturb:
+        if perturb and depth_prior is None:
             z_vals = z_vals + (torch.rand(z_vals.shape, device=device) - 0.5) * sample_dist
             #z_vals = z_vals.clamp(nears, fars) # avoid out of bounds xyzs.
 
@@ -851,8 +895,9 @@ class NeRFRenderer(nn.Module):
 
     def run_cuda(self, rays_o, rays_d, dt_gamma=0, 
                  bg_color=None, perturb=False, force_all_rays=False, 
-                 max_steps=1024, datatype='rgb', max_far=5, min_near=.2, **kwargs):
+                 max_steps=1024, datatype='rgb', max_far=5, min_near=.2, depth_prior=None, prior_window=0.05, **kwargs):
         # rays_o, rays_d: [B, N, 3], assumes B == 1
+        # depth_prior: [B, N], expected distance along each ray (inf if unknown), the march stops prior_window behind it.
         # return: image: [B, N, 3], depth: [B, N]
 
         prefix = rays_o.shape[:-1]
@@ -865,6 +910,11 @@ class NeRFRenderer(nn.Module):
         # pre-calculate near far
         nears, fars = raymarching.near_far_from_aabb(rays_o, rays_d, self.aabb_train if self.training else self.aabb_infer, min_near)
 
+        # the density grid already skips the empty space in front of the surface, the prior cuts the march behind it.
+        if depth_prior is not None:
+            prior = depth_prior.reshape(-1) * (1 + prior_window)
+            fars = torch.where(torch.isfinite(prior) & (prior > nears), torch.min(fars, prior), fars)
+
         #print("OI MATE")
         #print(nears)
         #print(fars)
@@ -885,7 +935,7 @@ class NeRFRenderer(nn.Module):
             self.local_step += 1
 
             xyzs, dirs, deltas, rays = raymarching.march_rays_train(rays_o, rays_d, self.bound, self.density_bitfield, 
-                                                                    self.cascade, self.grid_size, nears, ray_far, counter, 
+                                                                    self.cascade, self.grid_size, nears, fars, counter, 
                                                                     self.mean_count, perturb, 128, force_all_rays, dt_gamma, 
                                                                     max_steps)
 
@@ -1062,11 +1112,50 @@ class NeRFRenderer(nn.Module):
                                 count[cas, indices] += mask
                                 head += S
     
-        # mark untrained grid as -1
-        self.density_grid[count == 0] = -1
+        # mark untrained grid as -1 (cells culled by seed_occupancy keep their -2, they were observed empty)
+        self.density_grid[(count == 0) & (self.density_grid > -2)] = -1
 
         #print(f'[mark untrained grid] {(count == 0).sum()} from {resolution ** 3 * self.cascade}')
 
+    @torch.no_grad()
+    def seed_occupancy(self, points, origins, min_free=2, num_steps=128, chunk=2**16):
+        # cull the density grid cells that depth / touch rays observed as empty before training.
+        # points: [P, 3], measured surface points, origins: [P, 3], origins of their rays (see nerf.bounds.backproject).
+        # min_free: a cell is culled if at least min_free rays pass through it and no measured point falls in it.
+        # culled cells are marked -2: like untrained cells (-1) they are never sampled nor updated, but they count as observed.
+
+        if not self.cuda_ray:
+            return
+
+        device = self.density_grid.device
+        points = points.to(device)
+        origins = origins.to(device)
+
+        occupied = torch.zeros(self.density_grid.numel(), dtype=torch.bool, device=device)
+        occupied[grid_indices(points, self.bound, self.cascade, self.grid_size)] = True
+        free = torch.zeros(self.density_grid.numel(), dtype=torch.int32, device=device)
+
+        # stop two finest cells short of the surface, so noisy depth does not cull the surface itself.
+        margin = 2 * 2 * min(1, self.bound) / self.grid_size
+        steps = torch.linspace(0, 1, num_steps, device=device) # [T]
+        ray_batch = max(1, chunk // num_steps)
+        for head in range(0, points.shape[0], ray_batch):
+            o = origins[head:head + ray_batch]
+            d = points[head:head + ray_batch] - o
+            length = d.norm(dim=-1, keepdim=True) # [n, 1]
+            t = steps * (1 - margin / length.clamp(min=1e-8)).clamp(min=0) # [n, T]
+            xyzs = (o.unsqueeze(1) + d.unsqueeze(1) * t.unsqueeze(-1)).view(-1, 3) # [n * T, 3]
+            rays = torch.arange(o.shape[0], device=device).repeat_interleave(num_steps) # [n * T]
+            inside = (xyzs.abs() <= self.bound).all(dim=-1)
+            cells = grid_indices(xyzs[inside], self.bound, self.cascade, self.grid_size)
+            pairs = torch.unique(rays[inside] * free.numel() + cells) # count each ray once per cell
+            free.index_add_(0, pairs % free.numel(), torch.ones_like(pairs, dtype=torch.int32))
+
+        culled = (free >= min_free) & ~occupied & (self.density_grid.view(-1) >= 0)
+        self.density_grid.view(-1)[culled] = -2
+
+        print(f'[INFO] seeded occupancy: culled {culled.sum().item()} / {culled.numel()} grid cells')
+
     @torch.no_grad()
     def update_extra_state(self, decay=0.95, S=128):
         # call before each epoch to update extra states.
@@ -1163,9 +1252,144 @@ class NeRFRenderer(nn.Module):
         #print(f'[density grid] min={self.density_grid.min().item():.4f}, max={self.density_grid.max().item():.4f}, mean={self.mean_density:.4f}, occ_rate={(self.density_grid > 0.01).sum() / (128**3 * self.cascade):.3f} | [step counter] mean={self.mean_count}')
 
 
-    def render(self, rays_o, rays_d, staged=False, max_ray_batch=4096, 
-               datatype='rgb', max_far=5, min_near=.2, **kwargs):
+    @torch.no_grad()
+    def query_occupancy(self, points, thresh=None, chunk=2**16):
+        # points: [N, 3], world coordinates (same space as the rays).
+        # thresh: density threshold (on density_scale * sigma), defaults to the one used to pack density_bitfield.
+        # chunk: max points per density network call, bounds the latency and memory of one call.
+        # return: [N], bool, True if occupied.
+        # cells empty in density_bitfield are answered without the network, only the rest query density().
+
+        if thresh is None:
+            thresh = min(self.mean_density, self.density_thresh) if self.cuda_ray else self.density_thresh
+
+        points = points.reshape(-1, 3)
+        aabb = self.aabb_infer
+        occupied = ((points >= aabb[:3]) & (points <= aabb[3:])).all(dim=-1) # [N]
+
+        if self.cuda_ray:
+            candidates = occupied.nonzero(as_tuple=True)[0]
+            occupied[candidates] = query_bitfield(self.density_bitfield, points[candidates], self.bound, self.cascade, self.grid_size)
+
+        candidates = occupied.nonzero(as_tuple=True)[0]
+        for head in range(0, candidates.shape[0], chunk):
+            inds = candidates[head:head + chunk]
+            sigmas = self.density(points[inds])['sigma'].reshape(-1).float()
+            occupied[inds] = self.density_scale * sigmas > thresh
+
+        return occupied
+
+    @torch.no_grad()
+    def raycast(self, origins, dirs, max_dist=5, num_steps=256, bisect_steps=8, step_block=32, thresh=None, chunk=2**16):
+        # first hit distance along rays, by occupancy-guided marching and bisection on density.
+        # origins, dirs: [N, 3], dirs need not be normalized (distances are along the normalized direction).
+        # max_dist: float or [N], marching stops there.
+        # num_steps: uniform marching steps between the ray entry into the aabb and min(exit, max_dist).
+        # step_block: steps marched per round, rays that hit are dropped before the next round.
+        # return: dict with hit: [N] bool, dist: [N] (max_dist where nothing is hit), points: [N, 3].
+
+        origins = origins.reshape(-1, 3).float()
+        dirs = F.normalize(dirs.reshape(-1, 3).float(), dim=-1)
+        N = origins.shape[0]
+        device = origins.device
+
+        if thresh is None:
+            thresh = min(self.mean_density, self.density_thresh) if self.cuda_ray else self.density_thresh
+
+        max_dist = torch.as_tensor(max_dist, dtype=torch.float32, device=device).expand(N)
+
+        nears, fars = near_far_from_aabb(origins, dirs, self.aabb_infer, 0)
+        fars = torch.minimum(fars, max_dist)
+        deltas = (fars - nears).clamp(min=0) / num_steps # [N]
+
+        hit = torch.zeros(N, dtype=torch.bool, device=device)
+        dist = max_dist.clone()
+
+        # a point is solid if it is in an occupied cell and above the density threshold.
+        def solid(xyzs):
+            return self.query_occupancy(xyzs, thresh=thresh, chunk=chunk)
+
+        alive = (fars > nears).nonzero(as_tuple=True)[0] # [A]
+        step = 0
+        while step <= num_steps and alive.shape[0] > 0:
+            S = min(step_block, num_steps + 1 - step)
+            steps = torch.arange(step, step + S, dtype=torch.float32, device=device) # [S]
+            t = nears[alive, None] + deltas[alive, None] * steps # [A, S]
+            xyzs = origins[alive, None] + dirs[alive, None] * t.unsqueeze(-1) # [A, S, 3]
+
+            occ = solid(xyzs).view(-1, S) # [A, S]
+            found = occ.any(dim=-1) # [A]
+            first = occ.float().argmax(dim=-1) # [A], first occupied step of each ray
+
+            rays = alive[found]
+            t_hi = t[found].gather(1, first[found, None]).squeeze(1) # [H]
+            t_lo = (t_hi - deltas[rays]).clamp(min=0)
+            t_lo = torch.maximum(t_lo, nears[rays])
+
+            # bisection between the last empty and the first occupied sample.
+            for _ in range(bisect_steps):
+                t_mid = 0.5 * (t_lo + t_hi)
+                occ_mid = solid(origins[rays] + dirs[rays] * t_mid.unsqueeze(-1))
+                t_hi = torch.where(occ_mid, t_mid, t_hi)
+                t_lo = torch.where(occ_mid, t_lo, t_mid)
+
+            hit[rays] = True
+            dist[rays] = t_hi
+
+            alive = alive[~found]
+            step += S
+
+        points = origins + dirs * dist.unsqueeze(-1)
+
+        return {
+            'hit': hit,
+            'dist': dist,
+            'points': points,
+        }
+
+    def sample_bytes(self):
+        # rough peak bytes one point query costs at inference (float32 activations of encoders + MLPs).
+        # networks without these attributes (tcnn, tensoRF...) fall back to the default widths.
+        in_dim = getattr(self, 'in_dim', 32)
+        hidden_dim = getattr(self, 'hidden_dim', 64) * getattr(self, 'num_layers', 2)
+        geo_feat_dim = getattr(self, 'geo_feat_dim', 15)
+        in_dim_dir = getattr(self, 'in_dim_dir', 16)
+        hidden_dim_color = getattr(self, 'hidden_dim_color', 64) * getattr(self, 'num_layers_color', 3)
+        widths = 3 + in_dim + hidden_dim + 1 + geo_feat_dim + 3 + in_dim_dir + geo_feat_dim + hidden_dim_color + 3
+        # x2 for the temporaries (matmul outputs before activation, cat, masks) alive at the peak.
+        return 4 * 2 * widths
+
+    def ray_bytes(self, num_steps=128, upsample_steps=128):
+        # rough peak bytes one ray costs in a staged render, used to size chunks from a memory budget.
+        if self.cuda_ray:
+            # run_cuda compacts steps so that each marching iteration queries at most N samples (n_alive * n_step <= N),
+            # plus ~16 floats of per-ray state (rays_o/d, nears/fars, rays_t, rays_alive, weights_sum, depth, image).
+            return self.sample_bytes() + 4 * 16
+        # run keeps every sample of the ray alive: z_vals, xyzs, dirs, deltas, alphas, weights, rgbs, density outputs,
+        # and upsampling re-gathers (cat + sort) the coarse and fine samples.
+        geo_feat_dim = getattr(self, 'geo_feat_dim', 15)
+        per_sample = self.sample_bytes() + 4 * (24 + 2 * (1 + geo_feat_dim))
+        return (num_steps + upsample_steps) * per_sample + 4 * 16
+
+    def memory_ray_batch(self, render_budget, N, num_steps=128, upsample_steps=128):
+        # render_budget: target peak memory in MB for a staged render
+        # N: total rays of the frame, whose [B, N] outputs are counted against the budget too.
+        budget = render_budget * 1024 ** 2 - N * 4 * 4 # depth + image
+        if torch.cuda.is_available() and self.aabb_train.is_cuda:
+            budget -= torch.cuda.memory_allocated(self.aabb_train.device)
+        ray_batch = int(budget // self.ray_bytes(num_steps, upsample_steps))
+        # keep chunks a multiple of 128 rays, and never larger than what previously ran out of memory.
+        ray_batch = max(128, ray_batch // 128 * 128)
+        if self.oom_ray_batch is not None:
+            ray_batch = min(ray_batch, self.oom_ray_batch)
+        return ray_batch
+
+    def render(self, rays_o, rays_d, staged=False, max_ray_batch=4096, render_budget=0,
+               datatype='rgb', max_far=5, min_near=.2, depth_prior=None, **kwargs):
         # rays_o, rays_d: [B, N, 3], assumes B == 1
+        # depth_prior: [B, N], optional per ray depth prior (inf if unknown) to concentrate the samples around.
+        # render_budget: if > 0, target peak memory (MB) of a staged render; the ray batch is derived from it 
+        #                instead of max_ray_batch, halved on OOM, and run_cuda is staged as well.
         # return: pred_rgb: [B, N, 3]
 
         # if datatype != "viewer":
@@ -1186,8 +1410,12 @@ class NeRFRenderer(nn.Module):
         #print("CUDA RAY DEC")
         #print(self.cuda_ray)
 
-        # never stage when cuda_ray
-        if staged and not self.cuda_ray:
+        # never stage when cuda_ray (unless a memory budget is given, and only at inference)
+        use_budget = staged and render_budget > 0 and not (self.cuda_ray and self.training)
+        if use_budget:
+            max_ray_batch = self.memory_ray_batch(render_budget, B * N, kwargs.get('num_steps', 128), kwargs.get('upsample_steps', 128))
+
+        if staged and (not self.cuda_ray or use_budget):
             depth = torch.empty((B, N), device=device)
             image = torch.empty((B, N, 3), device=device)
 
@@ -1195,8 +1423,19 @@ class NeRFRenderer(nn.Module):
                 head = 0
                 while head < N:
                     tail = min(head + max_ray_batch, N)
-                    results_ = _run(rays_o[b:b+1, head:tail], rays_d[b:b+1, head:tail],
-                                    datatype=datatype, max_far=max_far, min_near=min_near, **kwargs)
+                    try:
+                        results_ = _run(rays_o[b:b+1, head:tail], rays_d[b:b+1, head:tail],
+                                        datatype=datatype, max_far=max_far, min_near=min_near,
+                                        depth_prior=None if depth_prior is None else depth_prior[b:b+1, head:tail], **kwargs)
+                    except RuntimeError as e:
+                        # back off and retry the same chunk with half the rays (torch.cuda.OutOfMemoryError is a RuntimeError).
+                        if not use_budget or not is_out_of_memory(e) or max_ray_batch <= 1:
+                            raise
+                        if torch.cuda.is_available():
+                            torch.cuda.empty_cache()
+                        max_ray_batch = max_ray_batch // 2
+                        self.oom_ray_batch = max_ray_batch
+                        continue
                     depth[b:b+1, head:tail] = results_['depth']
                     image[b:b+1, head:tail] = results_['image']
                     head += max_ray_batch
@@ -1207,6 +1446,6 @@ class NeRFRenderer(nn.Module):
 
         else:
             results = _run(rays_o, rays_d, datatype=datatype,
-                           max_far=max_far, min_near=min_near, **kwargs)
+                           max_far=max_far, min_near=min_near, depth_prior=depth_prior, **kwargs)
 
         return results
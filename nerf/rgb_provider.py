@@ -2,6 +2,7 @@ import os
 import cv2
 import glob
 import json
+from functools import partial
 from cv2 import transform
 import tqdm
 import numpy as np
@@ -12,7 +13,8 @@ import trimesh
 import torch
 from torch.utils.data import DataLoader
 
-from .utils import get_rays, srgb_to_linear, torch_vis_2d
+from .bounds import prior_at
+from .utils import image_size, to_device, ErrorMap, LazyFrames, PrefetchSampler, get_rays, srgb_to_linear, torch_vis_2d
 import matplotlib.pyplot as plt
 import pprint
 
@@ -128,6 +130,7 @@ class NeRFDataset:
         self.offset = opt.offset # camera offset
         self.bound = opt.bound # bounding box half length, also used as the radius to random sample poses.
         self.fp16 = opt.fp16 # if preload, load into fp16.
+        self.lazy = not self.preload and opt.cache_frames > 0 # decode frames on demand into a bounded cache.
         self.config = None
 
         self.training = self.type in ['train', 'all', 'trainval']
@@ -276,7 +279,12 @@ class NeRFDataset:
                 self.val_poses.append(pose)
                 pose = nerf_matrix_to_ngp(pose, scale=self.scale, offset=self.offset)
 
-                image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
+                if self.lazy:
+                    image = None
+                    shape = image_size(f_path) # header only, the frame is decoded when first sampled.
+                else:
+                    image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
+                    shape = image.shape
                 
                 # check if we have multiple cameras in use
                 if "cameras" in transform:
@@ -299,8 +307,8 @@ class NeRFDataset:
                         self.H.append(transform[f['camera']]["H"] // downscale)
                         self.W.append(transform[f['camera']]["W"] // downscale)
                     else:
-                        self.H.append(image.shape[0] // downscale)
-                        self.W.append(image.shape[1] // downscale)
+                        self.H.append(shape[0] // downscale)
+                        self.W.append(shape[1] // downscale)
 
                 # only one camera in use
                 else:
@@ -323,23 +331,17 @@ class NeRFDataset:
                         self.W.append(transform["W"] // downscale)
 
                     else: #self.H is None or self.W is None:
-                        self.H.append(image.shape[0] // downscale)
-                        self.W.append(image.shape[1] // downscale)
+                        self.H.append(shape[0] // downscale)
+                        self.W.append(shape[1] // downscale)
 
-                # add support for the alpha channel as a mask.
-                if image.shape[-1] == 3: 
-                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                self.poses.append(pose)
+                if self.lazy:
+                    self.images.append(partial(self.load_image, f_path, self.H[-1], self.W[-1]))
                 else:
-                    image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+                    self.images.append(self.load_image(f_path, self.H[-1], self.W[-1], image))
 
-                # check if image matches with expected dimensions, if not interpolate to make it fit
-                if image.shape[0] != self.H[-1] or image.shape[1] != self.W[-1]:
-                    image = cv2.resize(image, (self.W[-1], self.H[-1]), interpolation=cv2.INTER_AREA)
-                    
-                image = image.astype(np.float32) / 255 # [H, W, 3/4]
-
-                self.poses.append(pose)
-                self.images.append(torch.from_numpy(image))
+        if self.lazy and self.images is not None:
+            self.images = LazyFrames(self.images, capacity=opt.cache_frames)
 
         self.H = np.asarray(self.H)
         self.W = np.asarray(self.W)
@@ -354,10 +356,14 @@ class NeRFDataset:
 
         # initialize error_map
         if self.training and self.opt.error_map:
-            self.error_map = torch.ones([len(self.images), 128 * 128], dtype=torch.float) # [B, 128 * 128], flattened for easy indexing, fixed resolution...
+            self.error_map = ErrorMap(len(self.images), int(self.H.max()), int(self.W.max())) # importance sampling on a coarse grid, one per frame.
         else:
             self.error_map = None
 
+        # [F, Hc, Wc] per pixel depth prior, projected from the depth frames (set by main_nerf with --depth_guided).
+        self.depth_prior = None
+        self.prior_cell = 4
+
         # [debug] uncomment to view all training poses.
         visualize_poses(self.poses.numpy())
         
@@ -482,6 +488,25 @@ class NeRFDataset:
         print("intrinics: ", self.intrinsics.shape)
         print(self.intrinsics)
 
+    def load_image(self, f_path, H, W, image=None):
+        # decode one frame into a [H, W, 3/4] float tensor in [0, 1].
+        if image is None:
+            image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
+
+        # add support for the alpha channel as a mask.
+        if image.shape[-1] == 3: 
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        else:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+
+        # check if image matches with expected dimensions, if not interpolate to make it fit
+        if image.shape[0] != H or image.shape[1] != W:
+            image = cv2.resize(image, (W, H), interpolation=cv2.INTER_AREA)
+
+        image = image.astype(np.float32) / 255 # [H, W, 3/4]
+
+        return torch.from_numpy(image)
+
     def collate(self, index):
 
         B = len(index) # a list of length 1
@@ -509,7 +534,7 @@ class NeRFDataset:
                 'far': float(self.far[index])   
             }
 
-        poses = self.poses[index].to(self.device) # [B, 4, 4]
+        poses = to_device(self.poses[index], self.device) # [B, 4, 4]
 
         error_map = None if self.error_map is None else self.error_map[index]
         
@@ -526,12 +551,16 @@ class NeRFDataset:
         }
         
         if self.images is not None:
-            images = self.images[index].to(self.device) # [B, H, W, 3/4]
+            images = to_device(self.images[index], self.device) # [B, H, W, 3/4]
             if self.training:
                 C = images.shape[-1]
                 images = torch.gather(images.view(B, -1, C), 1, torch.stack(C * [rays['inds']], -1)) # [B, N, 3/4]
             results['images'] = images
         
+        if self.depth_prior is not None:
+            inds = rays['inds'] if 'inds' in rays else torch.arange(results['H'] * results['W'], device=self.device).unsqueeze(0)
+            results['depth_prior'] = to_device(prior_at(self.depth_prior, index, inds.cpu(), results['W'], self.prior_cell), self.device) # [B, N]
+
         # need inds to update error_map
         if error_map is not None:
             results['index'] = index
@@ -543,7 +572,8 @@ class NeRFDataset:
         size = len(self.poses)
         if self.training and self.rand_pose > 0:
             size += size // self.rand_pose # index >= size means we use random pose.
-        loader = DataLoader(list(range(size)), batch_size=1, collate_fn=self.collate, shuffle=self.training, num_workers=0)
+        sampler = PrefetchSampler(size, self.images, shuffle=self.training, depth=self.opt.prefetch_frames) if isinstance(self.images, LazyFrames) else None
+        loader = DataLoader(list(range(size)), batch_size=1, collate_fn=self.collate, shuffle=self.training and sampler is None, sampler=sampler, num_workers=0)
         loader._data = self # an ugly fix... we need to access error_map & poses in trainer.
         loader.has_gt = self.images is not None
         return loader
@@ -2,6 +2,7 @@ import os
 import cv2
 import glob
 import json
+from functools import partial
 from cv2 import transform
 import tqdm
 import numpy as np
@@ -12,7 +13,7 @@ import trimesh
 import torch
 from torch.utils.data import DataLoader
 
-from .utils import get_rays, srgb_to_linear, torch_vis_2d
+from .utils import image_size, to_device, LazyFrames, PrefetchSampler, get_rays, srgb_to_linear, torch_vis_2d
 import matplotlib.pyplot as plt
 import pprint
 
@@ -131,6 +132,7 @@ class NeRFTouchDataset:
         self.offset = opt.offset # camera offset
         self.bound = opt.bound # bounding box half length, also used as the radius to random sample poses.
         self.fp16 = opt.fp16 # if preload, load into fp16.
+        self.lazy = not self.preload and opt.cache_frames > 0 # decode frames on demand into a bounded cache.
         
         self.training = self.type in ['train', 'all', 'trainval']
         self.num_rays = self.opt.num_rays if self.training else -1
@@ -267,7 +269,12 @@ class NeRFTouchDataset:
                 pose[:3,3] = m2mm*pose[:3,3]
                 pose = nerf_matrix_to_ngp(pose, scale=self.scale, offset=self.offset)
 
-                image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
+                if self.lazy:
+                    image = None
+                    shape = image_size(f_path) # header only, the frame is decoded when first sampled.
+                else:
+                    image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
+                    shape = image.shape
                 
                 # check if we have multiple cameras in use
                 if "cameras" in transform:
@@ -290,8 +297,8 @@ class NeRFTouchDataset:
                         self.H.append(transform[f['camera']]["H"] // downscale)
                         self.W.append(transform[f['camera']]["W"] // downscale)
                     else:
-                        self.H.append(image.shape[0] // downscale)
-                        self.W.append(image.shape[1] // downscale)
+                        self.H.append(shape[0] // downscale)
+                        self.W.append(shape[1] // downscale)
 
                 # only one camera in use
                 else:
@@ -314,23 +321,22 @@ class NeRFTouchDataset:
                         self.W.append(transform["W"] // downscale)
 
                     else: #self.H is None or self.W is None:
-                        self.H.append(image.shape[0] // downscale)
-                        self.W.append(image.shape[1] // downscale)
-
-                # check if image matches with expected dimensions, if not interpolate to make it fit
-                if image.shape[0] != self.H[-1] or image.shape[1] != self.W[-1]:
-                    image = cv2.resize(image, (self.W[-1], self.H[-1]), interpolation=cv2.INTER_AREA)
+                        self.H.append(shape[0] // downscale)
+                        self.W.append(shape[1] // downscale)
 
-                # convert images into raw distance based on camera intrinics
-                image = image.astype(np.float32) / (255.)*(self.far[-1] - self.near[-1]) + self.near[-1] # [H, W, 3/4]
-                image = torch.unsqueeze(torch.from_numpy(image),dim=-1)
 
                 print(pose)
                 sys.exit()
                 self.poses.append(pose)
-                self.images.append(image)
+                if self.lazy:
+                    self.images.append(partial(self.load_image, f_path, self.H[-1], self.W[-1], self.near[-1], self.far[-1]))
+                else:
+                    self.images.append(self.load_image(f_path, self.H[-1], self.W[-1], self.near[-1], self.far[-1], image))
 
             
+        if self.lazy and self.images is not None:
+            self.images = LazyFrames(self.images, capacity=opt.cache_frames)
+
         self.H = np.asarray(self.H)
         self.W = np.asarray(self.W)
         self.near = np.asarray(self.near)
@@ -342,11 +348,8 @@ class NeRFTouchDataset:
         self.radius = self.poses[:, :3, 3].norm(dim=-1).mean(0).item()
         #print(f'[INFO] dataset camera poses: radius = {self.radius:.4f}, bound = {self.bound}')
 
-        # initialize error_map
-        if self.training and self.opt.error_map:
-            self.error_map = torch.ones([self.images.shape[0], 128 * 128], dtype=torch.float) # [B, 128 * 128], flattened for easy indexing, fixed resolution...
-        else:
-            self.error_map = None
+        # error_map is not used for touch: touch rays are sampled uniformly inside the fisheye fov (see get_rays).
+        self.error_map = None
 
         # [debug] uncomment to view all training poses.
         visualize_poses(self.poses.numpy())
@@ -477,6 +480,19 @@ class NeRFTouchDataset:
 
             self.intrinsics = np.tile(np.array([fl_x, fl_y, cx, cy, sensor_size]),(self.images.size[0],1))
 
+        # flat indices of the pixels inside the fisheye fov, shared by the frames with the same intrinsics.
+        # rays are only sampled among them, without scanning the fov mask at every step.
+        self.valid_inds = None
+        if self.images is not None:
+            fov_inds = {}
+            self.valid_inds = []
+            for i in range(len(self.images)):
+                key = (tuple(self.intrinsics[i]), int(self.H[i]), int(self.W[i]))
+                if key not in fov_inds:
+                    mask = get_rays(torch.eye(4).unsqueeze(0), self.intrinsics[i], int(self.H[i]), int(self.W[i]), -1, camera_model='touch')['mask'][0]
+                    fov_inds[key] = torch.nonzero(mask, as_tuple=True)[0].int().to(self.device if self.preload else 'cpu')
+                self.valid_inds.append(fov_inds[key])
+
         print("intrinics")
         print("W: ", self.W.shape)
         print("H: ", self.H.shape)
@@ -490,6 +506,19 @@ class NeRFTouchDataset:
 
 
 
+    def load_image(self, f_path, H, W, near, far, image=None):
+        # decode one frame into a [H, W, 1] float tensor of raw distances.
+        if image is None:
+            image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED)
+
+        # check if image matches with expected dimensions, if not interpolate to make it fit
+        if image.shape[0] != H or image.shape[1] != W:
+            image = cv2.resize(image, (W, H), interpolation=cv2.INTER_AREA)
+
+        # convert images into raw distance based on camera intrinics
+        image = image.astype(np.float32) / (255.)*(far - near) + near # [H, W, 3/4]
+        return torch.unsqueeze(torch.from_numpy(image),dim=-1)
+
     def collate(self, index):
         B = len(index) # a list of length 1
         
@@ -516,11 +545,12 @@ class NeRFTouchDataset:
                 'far': float(self.far[index])
             }
 
-        poses = self.poses[index].to(self.device) # [B, 4, 4]
+        poses = to_device(self.poses[index], self.device) # [B, 4, 4]
 
         error_map = None if self.error_map is None else self.error_map[index]
+        valid_inds = None if self.valid_inds is None else to_device(self.valid_inds[index], self.device)
         
-        rays = get_rays(torch.unsqueeze(poses,0), self.intrinsics[index], int(self.H[index]), int(self.W[index]), self.num_rays, error_map, 'touch')
+        rays = get_rays(torch.unsqueeze(poses,0), self.intrinsics[index], int(self.H[index]), int(self.W[index]), self.num_rays, error_map, 'touch', valid_inds=valid_inds)
         #rays = get_rays(torch.unsqueeze(poses,0), self.intrinsics[index], int(self.H[index]), int(self.W[index]), -1, error_map, 'touch')
         
         #print(rays)
@@ -570,7 +600,7 @@ class NeRFTouchDataset:
         }
 
         if self.images is not None:
-            images = self.images[index].to(self.device) # [B, H, W, 3/4]
+            images = to_device(self.images[index], self.device) # [B, H, W, 3/4]
             if self.training:
                 C = images.shape[-1]
                 images = torch.gather(images.view(B, -1, C), 1, torch.stack(C * [rays['inds']], -1)) # [B, N, 3/4]
@@ -587,7 +617,8 @@ class NeRFTouchDataset:
         size = len(self.poses)
         if self.training and self.rand_pose > 0:
             size += size // self.rand_pose # index >= size means we use random pose.
-        loader = DataLoader(list(range(size)), batch_size=1, collate_fn=self.collate, shuffle=self.training, num_workers=0)
+        sampler = PrefetchSampler(size, self.images, shuffle=self.training, depth=self.opt.prefetch_frames) if isinstance(self.images, LazyFrames) else None
+        loader = DataLoader(list(range(size)), batch_size=1, collate_fn=self.collate, shuffle=self.training and sampler is None, sampler=sampler, num_workers=0)
         loader._data = self # an ugly fix... we need to access error_map & poses in trainer.
         loader.has_gt = self.images is not None
         
@@ -15,13 +15,14 @@ from datetime import datetime
 
 import cv2
 import matplotlib.pyplot as plt
+from PIL import Image
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 import torch.distributed as dist
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 
 import trimesh
 import mcubes
@@ -31,6 +32,13 @@ from torch_ema import ExponentialMovingAverage
 from packaging import version as pver
 from itertools import cycle
 import json
+import copy
+import contextlib
+from functools import partial
+import threading
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 def custom_meshgrid(*args):
@@ -41,6 +49,62 @@ def custom_meshgrid(*args):
         return torch.meshgrid(*args, indexing='ij')
 
 
+def morton3D(coords):
+    # pure pytorch version of raymarching.morton3D, so the density grid can be read without the CUDA extension.
+    # coords: [N, 3], int in [0, 1024)
+    # return: [N], long
+    coords = coords.long()
+
+    def expand_bits(v):
+        v = (v * 0x00010001) & 0xFF0000FF
+        v = (v * 0x00000101) & 0x0F00F00F
+        v = (v * 0x00000011) & 0xC30C30C3
+        v = (v * 0x00000005) & 0x49249249
+        return v
+
+    return expand_bits(coords[:, 0]) | (expand_bits(coords[:, 1]) << 1) | (expand_bits(coords[:, 2]) << 2)
+
+
+@torch.no_grad()
+def grid_indices(xyzs, bound, cascade, grid_size=128):
+    # same cell lookup as the CUDA ray marcher (mip_from_pos + nearest cell), in pytorch.
+    # xyzs: [N, 3], in [-bound, bound]
+    # return: [N], long, flat index into density_grid.view(-1) (cascade-major, morton order inside a cascade).
+    xyzs = xyzs.clamp(-bound, bound)
+    mx = xyzs.abs().max(dim=-1)[0]
+    _, exponent = torch.frexp(mx) # [0, 0.5) --> -1, [0.5, 1) --> 0, [1, 2) --> 1, ...
+    level = exponent.clamp(0, cascade - 1) # [N]
+    mip_bound = torch.clamp(2.0 ** level.float(), max=bound).unsqueeze(-1) # [N, 1]
+    coords = (0.5 * (xyzs / mip_bound + 1) * grid_size).clamp(0, grid_size - 1).long() # [N, 3]
+    return level.long() * grid_size ** 3 + morton3D(coords) # [N]
+
+
+@torch.no_grad()
+def query_bitfield(bitfield, xyzs, bound, cascade, grid_size=128):
+    # bitfield: [CAS * H * H * H // 8], uint8
+    # xyzs: [N, 3], in [-bound, bound]
+    # return: [N], bool, True if the cell containing the point is occupied.
+    indices = grid_indices(xyzs, bound, cascade, grid_size)
+    bits = bitfield[indices // 8].long()
+    return ((bits >> (indices % 8)) & 1).bool()
+
+
+def near_far_from_aabb(rays_o, rays_d, aabb, min_near=0.05):
+    # slab test in pytorch (same convention as raymarching.near_far_from_aabb, but runs on CPU too)
+    # rays_o, rays_d: [N, 3]
+    # return: nears, fars: [N], rays missing the box get near = far = large value.
+    inv_d = 1 / torch.where(rays_d.abs() < 1e-15, torch.full_like(rays_d, 1e-15), rays_d)
+    t0 = (aabb[:3] - rays_o) * inv_d
+    t1 = (aabb[3:] - rays_o) * inv_d
+    nears = torch.minimum(t0, t1).max(dim=-1)[0]
+    fars = torch.maximum(t0, t1).min(dim=-1)[0]
+    miss = fars < nears
+    nears = torch.where(miss, torch.full_like(nears, 3.4e38), nears)
+    fars = torch.where(miss, torch.full_like(fars, 3.4e38), fars)
+    nears = nears.clamp(min=min_near)
+    return nears, fars
+
+
 @torch.jit.script
 def linear_to_srgb(x):
     return torch.where(x < 0.0031308, 12.92 * x, 1.055 * x ** 0.41666 - 0.055)
@@ -65,14 +129,111 @@ def get_gp(data):
     return model_gp
 
 
+class ErrorMap:
+    ''' per-frame training error on a coarse grid of cells, used to importance sample rays (--error_map).
+    The grid resolution follows the sensor aspect ratio with about max_cells cells per frame.
+    Sampling uses a two-level CDF (rows, then cells within a row), so drawing N rays is O(N log(cells)),
+    and an update only rebuilds the rows it touched.
+    update and sample may run on different threads and cuda streams (--prefetch_batches): they hold a lock, and each one
+    waits on an event recorded after the previous one, so a sample never reads a half rebuilt CDF.
+    '''
+    def __init__(self, num_frames, H, W, max_cells=128 * 128, device='cpu'):
+        # H, W: sensor resolution (max over the frames, cells are mapped by relative position).
+        self.cell = max(1, math.ceil(math.sqrt(H * W / max_cells))) # cell size in pixels
+        self.Hc = math.ceil(H / self.cell)
+        self.Wc = math.ceil(W / self.cell)
+
+        self.errors = torch.ones([num_frames, self.Hc, self.Wc], dtype=torch.float, device=device)
+        # keys[f, r, c] = r + (cumulative error of row r up to c) / (error of row r), increasing over the flattened grid.
+        self.keys = torch.zeros_like(self.errors, dtype=torch.double)
+        self.row_sums = torch.zeros([num_frames, self.Hc], dtype=torch.float, device=device)
+        self.row_cdf = torch.zeros_like(self.row_sums)
+
+        self.lock = threading.Lock()
+        self.event = None # recorded after the last update / sample on the gpu
+
+        rows = torch.arange(self.Hc, device=device)
+        for f in range(num_frames):
+            self.build(f, rows)
+
+    def __len__(self):
+        return self.errors.shape[0]
+
+    def __getitem__(self, index):
+        # sampler of one frame, as expected by get_rays.
+        return partial(self.sample, int(index))
+
+    def to(self, device):
+        for k in ['errors', 'keys', 'row_sums', 'row_cdf']:
+            setattr(self, k, getattr(self, k).to(device))
+        return self
+
+    def order(self):
+        # called under the lock: queue the next op after the previous one, on whichever stream it ran.
+        if self.event is not None:
+            torch.cuda.current_stream().wait_event(self.event)
+            self.event = None
+
+    def record(self):
+        if self.errors.is_cuda:
+            self.event = torch.cuda.Event()
+            self.event.record(torch.cuda.current_stream())
+
+    def build(self, index, rows):
+        # rebuild the CDFs of the given rows of one frame.
+        cdf = self.errors[index, rows].cumsum(-1) # [R, Wc]
+        sums = cdf[:, -1]
+        self.keys[index, rows] = rows.unsqueeze(-1) + (cdf / sums.clamp(min=1e-12).unsqueeze(-1)).double()
+        self.row_sums[index, rows] = sums
+        self.row_cdf[index] = self.row_sums[index].cumsum(0)
+
+    def sample(self, index, N, H, W, device):
+        # return: inds [N] pixel indices in [0, H*W), inds_coarse [N] cell indices in [0, Hc*Wc).
+        with self.lock:
+            self.order()
+            row_cdf = self.row_cdf[index]
+            total = row_cdf[-1]
+            if total <= 0:
+                inds_coarse = torch.randint(0, self.Hc * self.Wc, size=[N], device=self.errors.device)
+            else:
+                u = torch.rand(N, device=row_cdf.device) * total
+                rows = torch.searchsorted(row_cdf, u, right=True).clamp(max=self.Hc - 1)
+                frac = (u - (row_cdf[rows] - self.row_sums[index, rows])) / self.row_sums[index, rows].clamp(min=1e-12)
+                inds_coarse = torch.searchsorted(self.keys[index].view(-1), rows + frac.double().clamp(0, 1 - 1e-9), right=True)
+                inds_coarse = inds_coarse.clamp(max=self.Hc * self.Wc - 1)
+            self.record()
+
+        inds_coarse = inds_coarse.to(device)
+        # map to the original resolution with random perturb.
+        inds_x, inds_y = inds_coarse // self.Wc, inds_coarse % self.Wc
+        sx, sy = H / self.Hc, W / self.Wc
+        inds_x = ((inds_x + torch.rand(N, device=device)) * sx).long().clamp(max=H - 1)
+        inds_y = ((inds_y + torch.rand(N, device=device)) * sy).long().clamp(max=W - 1)
+        return inds_x * W + inds_y, inds_coarse
+
+    @torch.no_grad()
+    def update(self, index, inds_coarse, error):
+        # index: frame index, inds_coarse: [N] sampled cells, error: [N] training error of the sampled rays.
+        inds_coarse = inds_coarse.view(-1).to(self.errors.device)
+        error = error.view(-1).to(self.errors)
+        with self.lock:
+            self.order()
+            errors = self.errors[index].view(-1)
+            errors[inds_coarse] = 0.1 * errors[inds_coarse] + 0.9 * error # ema
+            self.build(index, torch.unique(inds_coarse // self.Wc))
+            self.record()
+
+
 @torch.cuda.amp.autocast(enabled=False)
-def get_rays(poses, intrinsics, H, W, N=-1, error_map=None, camera_model='pinhole', patch_size=1):
+def get_rays(poses, intrinsics, H, W, N=-1, error_map=None, camera_model='pinhole', patch_size=1, valid_inds=None):
     ''' get rays
     Args:
         poses: [B, 4, 4], cam2world
         intrinsics: [4]
         H, W, N: int
-        error_map: [B, 128 * 128], sample probability based on training error
+        error_map: sampler of one frame (ErrorMap[index]), importance sample rays based on training error
+        valid_inds: [M], flat indices of the pixels with valid supervision (depth > near, inside the touch fov),
+            if given (and no error_map), rays are only sampled among them.
     Returns:
         rays_o, rays_d: [B, N, 3]
         inds: [B, N]
@@ -85,10 +246,15 @@ def get_rays(poses, intrinsics, H, W, N=-1, error_map=None, camera_model='pinhol
     #fy = 8.838834762573242
     #sens_size = 25
 
+    if valid_inds is not None and valid_inds.shape[0] == 0:
+        valid_inds = None
+
     # generate pixel coordinates and make it so that rays shoot through center of pixel
-    i, j = custom_meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device)) # float
-    i = i.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
-    j = j.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
+    # (sampled rays only need the coordinates of the sampled pixels, computed from inds below)
+    if N <= 0 or (camera_model != 'pinhole' and valid_inds is None):
+        i, j = custom_meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device)) # float
+        i = i.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
+        j = j.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
 
     if camera_model == "touch":
         #print("USING THIS FX")
@@ -132,27 +298,24 @@ def get_rays(poses, intrinsics, H, W, N=-1, error_map=None, camera_model='pinhol
 
             #randomly select pixels for ray generation if we are not asking for an error map
             elif error_map is None:
-                inds = torch.randint(0, H*W, size=[N], device=device) # may duplicate
+                if valid_inds is not None:
+                    inds = valid_inds[torch.randint(0, valid_inds.shape[0], size=[N], device=device)].long() # may duplicate
+                else:
+                    inds = torch.randint(0, H*W, size=[N], device=device) # may duplicate
                 inds = inds.expand([B, N])
 
             # sample in a coarse grid pattern if we have an error map specified and not using patch sampling
             else:
 
-                # weighted sample on a low-reso grid
-                inds_coarse = torch.multinomial(error_map.to(device), N, replacement=False) # [B, N], but in [0, 128*128)
-
-                # map to the original resolution with random perturb.
-                inds_x, inds_y = inds_coarse // 128, inds_coarse % 128 # `//` will throw a warning in torch 1.10... anyway.
-                sx, sy = H / 128, W / 128
-                inds_x = (inds_x * sx + torch.rand(B, N, device=device) * sx).long().clamp(max=H - 1)
-                inds_y = (inds_y * sy + torch.rand(B, N, device=device) * sy).long().clamp(max=W - 1)
-                inds = inds_x * W + inds_y
+                # weighted sample on a coarse grid (may duplicate)
+                inds, inds_coarse = error_map(N, H, W, device) # [N]
+                inds = inds.expand([B, N])
 
-                results['inds_coarse'] = inds_coarse # need this when updating error_map
+                results['inds_coarse'] = inds_coarse.expand([B, N]) # need this when updating error_map
 
-            # collect all pixels with selected indices
-            i = torch.gather(i, -1, inds)
-            j = torch.gather(j, -1, inds)
+            # pixel centers of the selected indices
+            i = (inds % W).float() + 0.5
+            j = torch.div(inds, W, rounding_mode='floor').float() + 0.5
 
             results['inds'] = inds
         else:
@@ -166,6 +329,14 @@ def get_rays(poses, intrinsics, H, W, N=-1, error_map=None, camera_model='pinhol
         directions = directions / torch.norm(directions, dim=-1, keepdim=True)
 
     elif camera_model == "touch":
+        sampled = N > 0 and valid_inds is not None
+        if sampled:
+            # only the sampled pixels, drawn from the precomputed pixels inside the fov.
+            N = min(N, H*W)
+            inds = valid_inds[torch.randint(0, valid_inds.shape[0], size=[N], device=device)].long()
+            i = ((inds % W).float() + 0.5).expand([B, N])
+            j = (torch.div(inds, W, rounding_mode='floor').float() + 0.5).expand([B, N])
+
         u = i - cx
         v = j - cy
 
@@ -178,7 +349,10 @@ def get_rays(poses, intrinsics, H, W, N=-1, error_map=None, camera_model='pinhol
         mask = theta <= fovx/2
         
         # subsample from valid set
-        if N > 0:
+        if sampled:
+            results['inds'] = torch.unsqueeze(inds,0)
+            inds = torch.arange(N, device=device) # i, j are already the sampled pixels
+        elif N > 0:
             N = min(N, H*W)
             
             # don't want to grab batch index
@@ -611,6 +785,192 @@ def extract_geometry(bound_min, bound_max, resolution, threshold, query_func):
     return vertices, triangles
 
 
+def quantize_mlps(model, names=('sigma_net', 'color_net', 'bg_net')):
+    # return a copy of model whose nn.Linear stacks are int8 dynamically quantized (CPU only).
+    # weights are stored in int8, activations are quantized on the fly per batch; encoders are left untouched.
+    model = copy.deepcopy(model).cpu()
+    for name in names:
+        net = getattr(model, name, None)
+        if net is not None:
+            setattr(model, name, torch.quantization.quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8))
+    return model
+
+
+def image_size(path):
+    # [H, W] of an image file, read from its header without decoding the pixels.
+    with Image.open(path) as image:
+        return image.height, image.width
+
+
+class LazyFrames:
+    ''' frames decoded on demand into a bounded LRU cache, used as dataset.images when not preloading.
+    Only the per-frame loaders (file paths) are kept, so host memory is bounded by capacity frames whatever the dataset size.
+    prefetch() decodes frames on a background thread, ahead of the sampler.
+    '''
+    def __init__(self, loaders, capacity=16):
+        # loaders: list of callables, loaders[i]() returns the decoded frame i as a tensor.
+        # capacity: max number of decoded frames kept in host memory.
+        self.loaders = loaders
+        self.capacity = max(1, capacity)
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.ahead = set() # prefetched but not requested yet, never evicted.
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.loaders)
+
+    def __getitem__(self, index):
+        index = int(index)
+        with self.lock:
+            self.ahead.discard(index)
+            if index in self.cache:
+                self.cache.move_to_end(index)
+                self.hits += 1
+                return self.cache[index]
+            future = self.pending.get(index)
+            self.misses += 1
+
+        if future is not None:
+            return future.result() # being prefetched, wait for it instead of decoding twice.
+        return self.load(index)
+
+    def load(self, index):
+        frame = self.loaders[index]()
+        with self.lock:
+            self.cache[index] = frame
+            self.cache.move_to_end(index)
+            while len(self.cache) > self.capacity:
+                victim = next((i for i in self.cache if i not in self.ahead), None)
+                if victim is None:
+                    break
+                del self.cache[victim]
+            self.pending.pop(index, None)
+        return frame
+
+    def prefetch(self, indices):
+        # indices: frames that will be requested next, decoded in order on the background thread.
+        for index in indices[:self.capacity - 1]: # never prefetch more than the cache can hold alongside the current frame.
+            index = int(index)
+            with self.lock:
+                self.ahead.add(index)
+                if index in self.cache or index in self.pending:
+                    continue
+                self.pending[index] = self.pool.submit(self.load, index)
+
+    def release(self):
+        # unpin the prefetched frames that were never requested (their iterator ended or was dropped), so they can be evicted again.
+        with self.lock:
+            self.ahead.clear()
+
+
+class PrefetchSampler(Sampler):
+    ''' (shuffled) index sampler that tells LazyFrames which frames come next.
+    Indices >= len(frames) (random poses) are yielded but never prefetched.
+    '''
+    def __init__(self, size, frames, shuffle=True, depth=2):
+        # frames: LazyFrames, or a list of LazyFrames over the same frames (prefetched in order).
+        self.size = size
+        self.frames = [f for f in (frames if isinstance(frames, (list, tuple)) else [frames]) if isinstance(f, LazyFrames)]
+        self.shuffle = shuffle
+        self.depth = depth
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        order = torch.randperm(self.size).tolist() if self.shuffle else list(range(self.size))
+        # a new iterator replaces the previous one (e.g. train_gui stops after a few steps), whose prefetched frames are not coming.
+        for frames in self.frames:
+            frames.release()
+        try:
+            for k, index in enumerate(order):
+                if self.depth > 0:
+                    for frames in self.frames:
+                        frames.prefetch([i for i in order[k + 1:k + 1 + self.depth] if i < len(frames)])
+                yield index
+        finally:
+            for frames in self.frames:
+                frames.release()
+
+
+def to_device(x, device):
+    # host -> device copy through pinned memory, so it does not block the host (the pinned buffer is recycled by torch's caching host allocator).
+    if x.device.type == 'cpu' and torch.device(device).type == 'cuda':
+        return x.pin_memory().to(device, non_blocking=True)
+    return x.to(device)
+
+
+class BatchPrefetcher:
+    ''' prepares the next batches (collate: ray generation, pixel gathering, host -> device copies) on a side thread,
+    and on a side cuda stream, while the current step trains. Iterating yields the same items as the wrapped iterable.
+    wait: seconds the consumer waited for data at each step.
+    '''
+    def __init__(self, iterable, depth=2):
+        # depth: number of batches prepared ahead (queue size), 2 is double buffering.
+        self.iterable = iterable
+        self.depth = max(1, depth)
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.wait = []
+
+    @staticmethod
+    def put(q, stop, entry):
+        # blocks until the consumer takes the entry, or gives up once it stopped (it may never read again).
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(self, q, stop):
+        try:
+            with torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext():
+                for item in self.iterable:
+                    event = None
+                    if self.stream is not None:
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                    if not self.put(q, stop, (item, event)):
+                        return
+        except Exception as e:
+            self.put(q, stop, (e, None))
+            return
+        self.put(q, stop, (StopIteration, None))
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(q, stop), daemon=True)
+        thread.start()
+        self.wait = []
+        try:
+            while True:
+                t = time.time()
+                item, event = q.get()
+                if item is StopIteration:
+                    return
+                self.wait.append(time.time() - t)
+                if isinstance(item, Exception):
+                    raise item
+                if event is not None:
+                    stream = torch.cuda.current_stream()
+                    stream.wait_event(event)
+                    # tensors were allocated on the side stream, keep their memory alive until this stream is done with them.
+                    for d in (item if isinstance(item, (list, tuple)) else [item]):
+                        for v in (d.values() if isinstance(d, dict) else [d]):
+                            if torch.is_tensor(v) and v.is_cuda:
+                                v.record_stream(stream)
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
 class PSNRMeter:
     def __init__(self):
         self.V = 0
@@ -694,6 +1054,10 @@ class Trainer(object):
         self.scheduler_update_every_step = scheduler_update_every_step
         self.device = device if device is not None else torch.device(f'cuda:{local_rank}' if torch.cuda.is_available() else 'cpu')
         self.console = Console()
+        self.baked = None # optional BakedGrid, replaces the network in test_step when set.
+        self.error_map = {} # datatype -> ErrorMap of the training set, see train().
+        self.cpu_bf16 = False # bf16 autocast for inference on CPU, see set_cpu_precision.
+        self.quantized = None # optional int8 copy of the model, replaces the network in test_step when set.
 
         model.to(self.device)
         if self.world_size > 1:
@@ -878,7 +1242,7 @@ class Trainer(object):
 
         outputs = self.model.render(rays_o, rays_d, staged=False, bg_color=bg_color, 
                                         perturb=True, force_all_rays=False, datatype=data['type'],
-                                         max_far=data['far'], min_near=data['near'], **vars(self.opt))
+                                         max_far=data['far'], min_near=data['near'], depth_prior=data.get('depth_prior'), **vars(self.opt))
 
         if data['type'] == 'rgb':
             pred_rgb = outputs['image']
@@ -891,6 +1255,7 @@ class Trainer(object):
             #print(outputs['image'])
             #print("gt image")
             #print(gt_rgb)
+            error = ((pred_rgb - gt_rgb) ** 2).mean(-1) # [B, N], per ray for the error map
             loss = l2(pred_rgb, gt_rgb) #+ torch.max(torch.abs(pred_rgb-gt_rgb),dim=-1)[0].mean()#torch.log(1+torch.square(pred_rgb-gt_rgb)/gt_rgb).mean() + torch.max(torch.abs(pred_rgb-gt_rgb),dim=-1)[0].mean()#(2*torch.log(torch.square(pred_rgb-gt_rgb)+1e-12)).mean()
             #print("max diff")
             #print(torch.max(torch.abs(pred_rgb-gt_rgb)))
@@ -920,6 +1285,7 @@ class Trainer(object):
             l2 = torch.nn.MSELoss()
             l1 = torch.nn.L1Loss()
             loss = l1(gt_rgb[valid_ind], pred_depth[valid_ind])
+            error = (pred_depth - gt_rgb).abs() * valid_ind # [B, N], per ray for the error map
             #var = torch.mean(torch.abs(pred_depth-gt_rgb)/(torch.sqrt(outputs['depth_var']+1e-12)))
             #loss = torch.mean(torch.abs(gt_rgb[valid_ind] - pred_depth[valid_ind])/torch.sqrt(var))
             #print("GT")
@@ -970,29 +1336,19 @@ class Trainer(object):
         if len(loss.shape) == 3: # [K, B, N]
             loss = loss.mean(0)
 
-        # update error_map
-        if self.error_map[data['type']] is not None:
-            index = data['index'] # [B]
+        # update error_map (one per datatype, indexed by frame)
+        if self.error_map.get(data['type']) is not None and 'inds_coarse' in data:
+            index = data['index']
             inds = data['inds_coarse'] # [B, N]
 
-            # take out, this is an advanced indexing and the copy is unavoidable.
-            error_map = self.error_map[data['type']][index] # [B, H * W]
-
             # [debug] uncomment to save and visualize error map
             # if self.global_step % 1001 == 0:
-            #     tmp = error_map[0].view(128, 128).cpu().numpy()
+            #     tmp = self.error_map[data['type']].errors[index].cpu().numpy()
             #     print(f'[write error map] {tmp.shape} {tmp.min()} ~ {tmp.max()}')
             #     tmp = (tmp - tmp.min()) / (tmp.max() - tmp.min())
             #     cv2.imwrite(os.path.join(self.workspace, f'{self.global_step}.jpg'), (tmp * 255).astype(np.uint8))
 
-            error = loss.detach().to(error_map.device) # [B, N], already in [0, 1]
-            
-            # ema update
-            ema_error = 0.1 * error_map.gather(1, inds) + 0.9 * error
-            error_map.scatter_(1, inds, ema_error)
-
-            # put back
-            self.error_map[index] = error_map
+            self.error_map[data['type']].update(index, inds, error.detach())
 
         loss = loss.mean()
         #print(loss)
@@ -1018,7 +1374,8 @@ class Trainer(object):
             gt_rgb = images
         
         outputs = self.model.render(rays_o, rays_d, staged=True, bg_color=bg_color, perturb=False, 
-                                        datatype=data['type'], max_far=data['far'], min_near=data['near'], **vars(self.opt))
+                                        datatype=data['type'], max_far=data['far'], min_near=data['near'],
+                                        depth_prior=data.get('depth_prior'), **vars(self.opt))
         # if data['type'] == 'rgb':
         #     outputs = self.model.render(rays_o, rays_d, staged=True, bg_color=bg_color, perturb=False, 
         #                                 datatype=data['type'], max_depth=data['type'], **vars(self.opt))
@@ -1048,10 +1405,17 @@ class Trainer(object):
         if bg_color is not None:
             bg_color = bg_color.to(self.device)
 
+        # render from the baked sparse grid (or the quantized copy) instead of the network if one is loaded.
+        renderer = self.model
+        if self.baked is not None:
+            renderer = self.baked
+        elif self.quantized is not None:
+            renderer = self.quantized
+
         #print(data['type'])
-        outputs = self.model.render(rays_o, rays_d, staged=True, bg_color=bg_color, 
+        outputs = renderer.render(rays_o, rays_d, staged=True, bg_color=bg_color, 
                                         perturb=perturb, datatype=data['type'], 
-                                        max_far = data['far'], min_near = data['near'], **vars(self.opt))
+                                        max_far = data['far'], min_near = data['near'], depth_prior=data.get('depth_prior'), **vars(self.opt))
         # if data['type'] == 'rgb':
         #     outputs = self.model.render(rays_o, rays_d, staged=True, bg_color=bg_color, 
         #                                 perturb=perturb, datatype=data['type'], 
@@ -1097,8 +1461,217 @@ class Trainer(object):
 
         self.log(f"==> Finished saving mesh.")
 
+    def save_baked(self, save_path=None, resolution=256, block_size=8, sh_degree=2):
+        from .baking import bake_sparse_grid, save_baked_grid
+
+        if save_path is None:
+            save_path = os.path.join(self.workspace, 'baked', f'{self.name}_{self.epoch}.npz')
+
+        self.log(f"==> Baking sparse grid to {save_path}")
+
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+        self.model.eval()
+
+        if self.ema is not None:
+            self.ema.store()
+            self.ema.copy_to()
+
+        with torch.cuda.amp.autocast(enabled=self.fp16):
+            baked = bake_sparse_grid(self.model, resolution=resolution, block_size=block_size, sh_degree=sh_degree)
+
+        if self.ema is not None:
+            self.ema.restore()
+
+        save_baked_grid(save_path, baked)
+
+        self.log(f"==> Finished baking, {baked['block_coords'].shape[0]} blocks kept.")
+
+    def load_baked(self, path, device=None):
+        from .baking import BakedGrid
+
+        self.baked = BakedGrid(path, device=self.device if device is None else device)
+        self.log(f"[INFO] loaded baked grid {path}, {self.baked.num_blocks} stored blocks at resolution {self.baked.resolution}.")
+
+    def compact_encoders(self):
+        # names of the hash grid encoders of the model (GridEncoder or already compact ones).
+        return [name for name, module in self.model.named_children() if hasattr(module, 'offsets') and (hasattr(module, 'embeddings') or hasattr(module, 'bitmap'))]
+
+    def save_compact(self, mode='int8', save_path=None, threshold=1e-4):
+        from gridencoder.compact import compact_grid, compact_size, CompactGridEncoder
+
+        if save_path is None:
+            save_path = os.path.join(self.workspace, 'compact', f'{self.name}_{self.epoch}_{mode}.pth')
+
+        names = self.compact_encoders()
+        if len(names) == 0:
+            self.log(f"[WARN] no hash grid encoder to compact.")
+            return
+
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+        if self.ema is not None:
+            self.ema.store()
+            self.ema.copy_to()
+
+        model_state = self.model.state_dict()
+        state = {'model': {k: v for k, v in model_state.items() if not any(k.startswith(f'{name}.') for name in names)}, 'compact': {}}
+        for name in names:
+            encoder = getattr(self.model, name)
+            state['compact'][name] = encoder.state() if isinstance(encoder, CompactGridEncoder) else compact_grid(encoder, mode, threshold=threshold)
+
+        if self.ema is not None:
+            self.ema.restore()
+
+        if self.model.cuda_ray:
+            state['mean_count'] = self.model.mean_count
+            state['mean_density'] = self.model.mean_density
+
+        torch.save(state, save_path)
+
+        size = lambda tensors: sum(v.numel() * v.element_size() for v in tensors)
+        full, compact = size(model_state.values()), size(state['model'].values()) + sum(compact_size(s) for s in state['compact'].values())
+        self.log(f"==> Saved compact ({mode}) model to {save_path}: {compact / 2**20:.1f} MB instead of {full / 2**20:.1f} MB ({full / compact:.1f}x).")
+
+    def load_compact(self, path, decode=True):
+        # decode: serve the encoders from the compact tables (CompactGridEncoder), else decompress them into the dense GridEncoder.
+        from gridencoder.compact import CompactGridEncoder
+
+        state = torch.load(path, map_location=self.device)
+        missing_keys, unexpected_keys = self.model.load_state_dict(state['model'], strict=False)
+        missing_keys = [k for k in missing_keys if k.split('.')[0] not in state['compact']]
+        if len(missing_keys) > 0:
+            self.log(f"[WARN] missing keys: {missing_keys}")
+        if len(unexpected_keys) > 0:
+            self.log(f"[WARN] unexpected keys: {unexpected_keys}")
+
+        for name, compact in state['compact'].items():
+            encoder = CompactGridEncoder(compact).to(self.device)
+            if decode:
+                setattr(self.model, name, encoder)
+            else:
+                getattr(self.model, name).embeddings.data.copy_(encoder.decompress())
+
+        if self.model.cuda_ray:
+            if 'mean_count' in state:
+                self.model.mean_count = state['mean_count']
+            if 'mean_density' in state:
+                self.model.mean_density = state['mean_density']
+
+        self.log(f"[INFO] loaded compact model {path} ({', '.join(state['compact'].keys())}{' decoded from the compact tables' if decode else ' decompressed'}).")
+
     ### ------------------------------
 
+    def autocast(self):
+        # inference autocast: torch.cuda.amp.autocast is a no-op on CPU, so use bf16 there if requested.
+        if self.device.type == 'cpu':
+            return torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.cpu_bf16)
+        return torch.cuda.amp.autocast(enabled=self.fp16)
+
+    def set_cpu_precision(self, precision='fp32', use_ema=True):
+        # precision: fp32, bf16, int8 or bf16_int8, only used for inference (test / test_gui) on CPU.
+        # use_ema: quantize the EMA weights (False if they are already copied into the model).
+        assert precision in ['fp32', 'bf16', 'int8', 'bf16_int8'], f'unknown cpu precision {precision}'
+
+        if self.device.type != 'cpu':
+            self.log(f"[WARN] cpu precision {precision} ignored on {self.device}")
+            return
+
+        self.cpu_bf16 = 'bf16' in precision
+        self.quantized = None
+
+        if 'int8' in precision:
+            if self.ema is not None and use_ema:
+                self.ema.store()
+                self.ema.copy_to()
+
+            self.quantized = quantize_mlps(self.model).eval()
+
+            if self.ema is not None and use_ema:
+                self.ema.restore()
+
+        self.log(f"[INFO] cpu inference precision: {precision}")
+
+    def benchmark_cpu_inference(self, loader, precisions=('fp32', 'bf16', 'int8', 'bf16_int8'), max_frames=4, save_path=None):
+        # render up to max_frames test frames per loader at each precision, and report PSNR / mean depth error
+        # against the fp32 render together with throughput (rays/s), to choose a deployment point per scene.
+
+        if self.device.type != 'cpu':
+            self.log(f"[WARN] CPU inference benchmark skipped on {self.device}, the cpu precisions only apply on cpu")
+            return None
+
+        if save_path is None:
+            save_path = os.path.join(self.workspace, f'cpu_inference_{self.name}_ep{self.epoch:04d}.json')
+
+        self.log(f"==> Start CPU inference benchmark, save report to {save_path}")
+
+        frames = []
+        for l in loader:
+            for i, data in enumerate(l):
+                if i >= max_frames:
+                    break
+                frames.append(data)
+
+        self.model.eval()
+
+        precision = 'bf16_int8' if self.cpu_bf16 and self.quantized is not None else \
+                    'int8' if self.quantized is not None else 'bf16' if self.cpu_bf16 else 'fp32'
+
+        # every precision renders the EMA weights (the int8 copies are built from them), so the errors are quantization only.
+        if self.ema is not None:
+            self.ema.store()
+            self.ema.copy_to()
+
+        # a loaded baked grid would replace the network in test_step, measure the network.
+        baked, self.baked = self.baked, None
+
+        refs = []
+        report = {}
+
+        with torch.no_grad():
+            for p in ['fp32'] + [p for p in precisions if p != 'fp32']:
+                self.set_cpu_precision(p, use_ema=False)
+
+                num_rays = 0
+                t = time.time()
+                preds = []
+                for data in frames:
+                    with self.autocast():
+                        pred, pred_depth = self.test_step(data)
+                    preds.append((pred.float(), pred_depth.float()))
+                    num_rays += data['H'] * data['W']
+                t = time.time() - t
+
+                if p == 'fp32':
+                    refs = preds
+
+                psnr = np.mean([-10 * np.log10(max(torch.mean((pred - ref) ** 2).item(), 1e-10)) for (pred, _), (ref, _) in zip(preds, refs)])
+                depth_err = np.mean([torch.mean(torch.abs(pred_depth - ref_depth)).item() for (_, pred_depth), (_, ref_depth) in zip(preds, refs)])
+
+                report[p] = {
+                    'psnr': float(psnr),
+                    'depth_err': float(depth_err),
+                    'rays_per_sec': num_rays / t,
+                    'sec_per_frame': t / max(len(frames), 1),
+                }
+
+                self.log(f"[INFO] {p:>9s} | PSNR vs fp32 = {psnr:.2f} | depth err = {depth_err:.6f} | {num_rays / t:.0f} rays/s | {t / max(len(frames), 1):.3f} s/frame")
+
+        self.baked = baked
+
+        if self.ema is not None:
+            self.ema.restore()
+
+        # restore the precision in use before the benchmark.
+        self.set_cpu_precision(precision)
+
+        with open(save_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        self.log(f"==> Finished CPU inference benchmark.")
+
+        return report
+
     def train(self, train_loader, valid_loader, max_epochs):
         if self.use_tensorboardX and self.local_rank == 0:
             self.writer = tensorboardX.SummaryWriter(os.path.join(self.workspace, "run", self.name))
@@ -1164,7 +1737,7 @@ class Trainer(object):
             #for i, data in enumerate(loader):
                 
                 for d in data:
-                    with torch.cuda.amp.autocast(enabled=self.fp16):
+                    with self.autocast():
                         preds, preds_depth = self.test_step(d)                
                 
                     path = os.path.join(save_path, f'{name}_{i:04d}.png')
@@ -1213,6 +1786,9 @@ class Trainer(object):
             self.model.mark_untrained_grid(training_poses, training_intrinsics)
             #self.model.mark_untrained_grid(train_loader._data.poses, train_loader._data.intrinsics)
 
+        # get a ref to error_map
+        self.error_map = {train_loader[i]._data.datatype: train_loader[i]._data.error_map for i in range(len(train_loader))}
+
         for _ in range(step):
             
             # print(loader)
@@ -1316,7 +1892,7 @@ class Trainer(object):
             self.ema.copy_to()
 
         with torch.no_grad():
-            with torch.cuda.amp.autocast(enabled=self.fp16):
+            with self.autocast():
                 # here spp is used as perturb random seed!
                 preds, preds_depth = self.test_step(data, bg_color=bg_color, perturb=spp)
 
@@ -1369,7 +1945,10 @@ class Trainer(object):
         loader_lens = [len(loader[i]) for i in range(len(loader))]
         index = loader_lens.index(max(loader_lens))
         zipper = [loader[index]] + [cycle(loader[i]) for i in range(len(loader)) if i!=index]
-        for data in zip(*zipper):
+        batches = zip(*zipper)
+        if self.opt.prefetch_batches > 0:
+            batches = BatchPrefetcher(batches, depth=self.opt.prefetch_batches)
+        for data in batches:
             
             # update grid every 16 steps
             if self.model.cuda_ray and self.global_step % self.opt.update_extra_interval == 0:
@@ -1403,6 +1982,8 @@ class Trainer(object):
                     if self.use_tensorboardX:
                         self.writer.add_scalar("train/loss", loss_val, self.global_step)
                         self.writer.add_scalar("train/lr", self.optimizer.param_groups[0]['lr'], self.global_step)
+                        if isinstance(batches, BatchPrefetcher):
+                            self.writer.add_scalar("train/data_wait", batches.wait[-1], self.global_step)
 
                     for i in range(len(loader)):
                         if self.scheduler_update_every_step:
@@ -1417,6 +1998,17 @@ class Trainer(object):
         average_loss = total_loss / (len(data)*self.local_step)
         self.stats["loss"].append(average_loss)
 
+        if isinstance(batches, BatchPrefetcher):
+            data_wait = sum(batches.wait)
+            self.log(f"[INFO] waited {data_wait:.2f}s for data ({1000 * data_wait / max(1, len(batches.wait)):.2f}ms per step, prefetch depth {batches.depth})")
+
+        # hash grid occupancy / collisions so far (--grid_stats)
+        grid_stats = getattr(getattr(self.model, 'encoder', None), 'stats', None)
+        if grid_stats is not None and self.local_rank == 0:
+            self.log(f"[INFO] hash grid usage:\n{grid_stats.report()}")
+            if self.use_tensorboardX:
+                grid_stats.write(self.writer, self.epoch, prefix="train")
+
         if self.local_rank == 0:
             for i in range(len(loader)):
                 pbar[i].close()
@@ -1485,7 +2077,7 @@ class Trainer(object):
                     #print(d)
                     #stop
                     
-                    with torch.cuda.amp.autocast(enabled=self.fp16):
+                    with self.autocast():
                         preds, preds_depth, truths, loss = self.eval_step(d)
 
                     # all_gather/reduce the statistics (NCCL only support all_*)
@@ -0,0 +1,110 @@
+import math
+
+import torch
+from torch.optim import Optimizer
+
+
+# integer type as wide as a row, e.g. the 2 float channels of a hash grid entry are one int64.
+_row_words = {2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+def nonzero_rows(grad):
+    # [R] indices of the rows of grad ([T, C]) with any nonzero entry.
+    # when a row fits in one machine word, its bits are tested at once (a single pass without the per-channel reduction).
+    word = _row_words.get(grad.shape[1] * grad.element_size())
+    if word is not None and grad.is_contiguous():
+        return grad.view(-1).view(word).nonzero(as_tuple=True)[0]
+    return grad.ne(0).any(dim=1).nonzero(as_tuple=True)[0]
+
+
+class RowAdam(Optimizer):
+    ''' Adam with a row-wise sparse path for embedding tables (the hash grids).
+    Param groups with 'sparse': True only update the rows that received a gradient this step (nonzero rows of a dense
+    gradient, or the indices of a sparse one): their moments and values are gathered, updated and scattered back, the
+    other rows and their moments are left untouched. Each row counts its own steps for the bias correction (lazy Adam).
+    The other groups (the MLPs) get the usual dense Adam update.
+    '''
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, sparse=False)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if group['sparse']:
+                    self.sparse_step(p, group)
+                else:
+                    self.dense_step(p, group)
+
+        return loss
+
+    def dense_step(self, p, group):
+        beta1, beta2 = group['betas']
+        grad = p.grad
+        if grad.is_sparse:
+            grad = grad.to_dense()
+        if group['weight_decay'] != 0:
+            grad = grad.add(p, alpha=group['weight_decay'])
+
+        state = self.state[p]
+        if len(state) == 0:
+            state['step'] = 0
+            state['exp_avg'] = torch.zeros_like(p)
+            state['exp_avg_sq'] = torch.zeros_like(p)
+
+        state['step'] += 1
+        exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+        bias_correction1 = 1 - beta1 ** state['step']
+        bias_correction2 = 1 - beta2 ** state['step']
+        denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group['eps'])
+        p.addcdiv_(exp_avg, denom, value=-group['lr'] / bias_correction1)
+
+    def sparse_step(self, p, group):
+        beta1, beta2 = group['betas']
+        table = p.view(p.shape[0], -1) # [T, C]
+
+        # touched rows and their gradients
+        grad = p.grad
+        if grad.is_sparse:
+            grad = grad.coalesce()
+            rows = grad.indices()[0] # [R]
+            values = grad.values().view(rows.shape[0], -1) # [R, C]
+        else:
+            grad = grad.view(p.shape[0], -1)
+            rows = nonzero_rows(grad) # [R]
+            values = grad[rows]
+        if rows.shape[0] == 0:
+            return
+        if group['weight_decay'] != 0:
+            values = values + group['weight_decay'] * table[rows]
+
+        state = self.state[p]
+        if len(state) == 0:
+            state['step'] = torch.zeros(p.shape[0], dtype=torch.int32, device=p.device) # [T], steps per row
+            state['exp_avg'] = torch.zeros_like(table)
+            state['exp_avg_sq'] = torch.zeros_like(table)
+
+        step = state['step'][rows] + 1 # [R]
+        state['step'][rows] = step
+
+        exp_avg = state['exp_avg'][rows].mul_(beta1).add_(values, alpha=1 - beta1) # [R, C]
+        exp_avg_sq = state['exp_avg_sq'][rows].mul_(beta2).addcmul_(values, values, value=1 - beta2)
+        state['exp_avg'][rows] = exp_avg
+        state['exp_avg_sq'][rows] = exp_avg_sq
+
+        step = step.to(table.dtype).unsqueeze(-1) # [R, 1]
+        bias_correction1 = 1 - beta1 ** step
+        bias_correction2 = 1 - beta2 ** step
+        denom = (exp_avg_sq / bias_correction2).sqrt_().add_(group['eps'])
+        table.index_add_(0, rows, exp_avg / denom * (-group['lr'] / bias_correction1))
@@ -3,75 +3,110 @@
 import argparse
 import os
 from pathlib import Path
-import csv
 import numpy as np
-import cvxpy as cp 
+import pandas as pd
 import json
 import re
-import imageio
 import cv2
 from scipy.spatial.transform import Rotation as R
-import scipy
-#import procrustes
-#from procrustes import generic
-from scipy import linalg
+from scipy.spatial.transform import Slerp
+
+from scripts.undistort import undistort_images
 
 # helper function that allows sorting of data files by names
 def file_sort(name):
     return int(re.findall(r'\d+', name)[0])
 
+# helper function that reads a csv file into a [rows, cols] float64 array (columnar, no per-row python)
+# a non-numeric first row is treated as a header and skipped.
+def read_csv(fname):
+    with open(fname) as f:
+        first = f.readline().strip().split(',')
+    try:
+        [float(v) for v in first]
+        header = None
+    except ValueError:
+        header = 0
+    return pd.read_csv(fname, header=header).to_numpy(dtype=np.float64)
+
+# helper function that merges (seconds, nanoseconds) columns into int64 nanosecond timestamps
+def to_nanoseconds(sec, nsec):
+    return sec.astype(np.int64) * 1000000000 + nsec.astype(np.int64)
+
 # helper function that converts quaternion vectors into rotation matrices
+# quaternions: [..., 4] (x, y, z, w), translation: [..., 3], return: [..., 4, 4]
 def tf_from_vect(quaternions, translation):
-    tf = np.zeros((4,4))
+    quaternions = np.asarray(quaternions, dtype=np.float64)
+    translation = np.asarray(translation, dtype=np.float64)
+    prefix = quaternions.shape[:-1]
 
-    tf[:3,:3] = R.from_quat(quaternions).as_matrix()
-    tf[:3,3] = translation
-    tf[3,3] = 1
+    tf = np.zeros(prefix + (4, 4))
+    tf[..., :3, :3] = R.from_quat(quaternions.reshape(-1, 4)).as_matrix().reshape(prefix + (3, 3))
+    tf[..., :3, 3] = translation
+    tf[..., 3, 3] = 1
     return tf
 
 def create_calibration_tf(fname):
 
-    with open(fname) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        line_count = 0
-        tfs_apr_mocap = []
-        tfs_cam_mocap  = []
-        tfs_cam_april = []
-        tfs_cam_mocap_tilda = []
-        for row in csv_reader:
-            if line_count != 0:
-                count, time_sec, time_nano = row[0], row[1], row[2]
-                tf_apr_mocap = row[3:10]
-                tf_cam_mocap = row[10:17]
-                tf_cam_april = row[24:]
-
-                TF_apr_mocap = tf_from_vect(tf_apr_mocap[3:],tf_apr_mocap[:3])
-                TF_cam_mocap = tf_from_vect(tf_cam_mocap[3:],tf_cam_mocap[:3])
-                TF_cam_april = tf_from_vect(tf_cam_april[3:],tf_cam_mocap[:3])
-
-                tf_cam_mocap_tilda =  TF_apr_mocap@np.linalg.inv(TF_cam_april)
-                
-                tfs_apr_mocap.append(TF_apr_mocap)
-                tfs_cam_mocap.append(TF_cam_mocap)
-                tfs_cam_april.append(TF_cam_april)
-                tfs_cam_mocap_tilda.append(tf_cam_mocap_tilda)
-                
-            line_count += 1
-            
-        tfs_apr_mocap = np.asarray(tfs_apr_mocap)
-        tfs_cam_mocap = np.asarray(tfs_cam_mocap)
-        tfs_cam_april = np.asarray(tfs_cam_april)
-        tfs_cam_mocap_tilda = np.asarray(tfs_cam_mocap_tilda)
-        
-        trans = np.mean(tfs_cam_mocap_tilda[:,:3,3] - tfs_cam_mocap[:,:3,3],axis=0)
-        rot = []
-        for i in range(tfs_cam_mocap.shape[0]):
-            result = linalg.orthogonal_procrustes(tfs_cam_mocap[i,:3,:3], tfs_cam_mocap_tilda[i,:3,:3])[0]
-            rot.append(result)
-        rot = np.asarray(rot)
-        rot = np.mean(rot,axis=0)
-        
-        return rot, trans
+    # columns: count, time_sec, time_nano, apr_mocap (7), cam_mocap (7), ..., cam_april (7)
+    rows = read_csv(fname)
+    tf_apr_mocap = rows[:, 3:10]
+    tf_cam_mocap = rows[:, 10:17]
+    tf_cam_april = rows[:, 24:31]
+
+    tfs_apr_mocap = tf_from_vect(tf_apr_mocap[:, 3:], tf_apr_mocap[:, :3])
+    tfs_cam_mocap = tf_from_vect(tf_cam_mocap[:, 3:], tf_cam_mocap[:, :3])
+    tfs_cam_april = tf_from_vect(tf_cam_april[:, 3:], tf_cam_mocap[:, :3]) # translation taken from cam_mocap, as before
+
+    tfs_cam_mocap_tilda = tfs_apr_mocap @ np.linalg.inv(tfs_cam_april)
+
+    trans = np.mean(tfs_cam_mocap_tilda[:,:3,3] - tfs_cam_mocap[:,:3,3],axis=0)
+
+    # batched orthogonal procrustes: argmin_O ||A O - B|| = U V^T with U S V^T = svd(A^T B)
+    A = tfs_cam_mocap[:, :3, :3]
+    B = tfs_cam_mocap_tilda[:, :3, :3]
+    u, _, vt = np.linalg.svd(A.transpose(0, 2, 1) @ B)
+    rot = np.mean(u @ vt, axis=0)
+
+    return rot, trans
+
+# look up poses at the given timestamps from time-sorted mocap samples.
+# mocap_ns: [M] int64, mocap_t: [M, 3], mocap_q: [M, 4] (x, y, z, w), frame_ns: [N] int64
+# mode: 'nearest' picks the closest sample, 'linear' interpolates translation and slerps rotation.
+# return: translations [N, 3], quaternions [N, 4], and the time gap (ns) to the closest sample [N]
+def align_poses(mocap_ns, mocap_t, mocap_q, frame_ns, mode='linear'):
+    order = np.argsort(mocap_ns, kind='stable')
+    mocap_ns, mocap_t, mocap_q = mocap_ns[order], mocap_t[order], mocap_q[order]
+
+    M = mocap_ns.shape[0]
+    if M == 0:
+        raise ValueError('no mocap samples to align the frames to')
+    if M == 1:
+        # a single sample: every frame gets its pose.
+        N = frame_ns.shape[0]
+        return np.repeat(mocap_t, N, axis=0), np.repeat(mocap_q, N, axis=0), np.abs(frame_ns - mocap_ns[0])
+
+    hi = np.clip(np.searchsorted(mocap_ns, frame_ns), 1, M - 1)
+    lo = hi - 1
+    gap = np.minimum(np.abs(frame_ns - mocap_ns[lo]), np.abs(mocap_ns[hi] - frame_ns))
+
+    if mode == 'nearest':
+        inds = np.where(np.abs(frame_ns - mocap_ns[lo]) <= np.abs(mocap_ns[hi] - frame_ns), lo, hi)
+        return mocap_t[inds], mocap_q[inds], gap
+
+    # relative times stay exact in float64 for captures far longer than an hour.
+    times = (mocap_ns - mocap_ns[0]).astype(np.float64)
+    query = np.clip((frame_ns - mocap_ns[0]).astype(np.float64), times[0], times[-1])
+
+    span = np.maximum(times[hi] - times[lo], 1)
+    w = np.clip((query - times[lo]) / span, 0, 1)[:, None]
+    translations = (1 - w) * mocap_t[lo] + w * mocap_t[hi]
+
+    # keep samples with duplicated timestamps out of slerp, it needs strictly increasing times.
+    keep = np.concatenate([[True], np.diff(times) > 0])
+    quaternions = Slerp(times[keep], R.from_quat(mocap_q[keep]))(query).as_quat()
+
+    return translations, quaternions, gap
 
 trans_t = lambda t : torch.Tensor([
     [1,0,0,0],
@@ -104,7 +139,7 @@ def construct_json(args):
     
     print(args)
     
-    calib_rot, calib_trans = create_calibration_tf('tfs.csv')
+    calib_rot, calib_trans = create_calibration_tf(args.calibration)
     
     filenames = ['color_pose.csv','depth_pose.csv', 'touch_pose.csv']
     foldernames = ['color','depth','touch']
@@ -162,14 +197,15 @@ def construct_json(args):
                     }
     
 
+    # optional raw mocap stream: count, time_sec, time_nano, tx, ty, tz, qx, qy, qz, qw
+    if args.mocap:
+        mocap = read_csv(args.mocap)
+        mocap_ns = to_nanoseconds(mocap[:, 1], mocap[:, 2])
+        mocap_t, mocap_q = mocap[:, 3:6], mocap[:, 6:10]
+        print(f"[INFO] loaded {mocap.shape[0]} mocap samples from {args.mocap}")
+
     all_poses = []
     for i in range(len(filenames)):
-        print(os.path.join(args.data_path, foldernames[i], filenames[i]))
-        tf_fn = os.path.join(args.data_path, foldernames[i], filenames[i])
-    
-        fd = open(tf_fn)
-        csvreader = csv.reader(fd)
-        poses = np.genfromtxt(tf_fn, delimiter=',')
         
         img_dir = os.path.join(args.data_path, foldernames[i], 'images')
         img_names = []
@@ -177,69 +213,70 @@ def construct_json(args):
             img_names = files
             break
         img_names.sort(key=file_sort)
-        imgs = [imageio.imread(os.path.join(img_dir,img_name)) for img_name in img_names]
-        
-        tfs = []
-        for j in range(poses.shape[0]):
-            pose_row = poses[j,:]
-            indx = pose_row[0]
-            time = pose_row[1]
-     
-            translation, quaternion = pose_row[2:5], pose_row[5:]
-            tf = tf_from_vect(quaternion, translation)
-            
-            tf[:3,3] = tf[:3,3] + offset[i]
-            tf[:3,:3] = calib_rot@tf[:3,:3]
-            tf[:3,3] = tf[:3,3] + calib_trans
-            tf = tf @ rot_phi(-np.pi/2)
-            tf = tf @ rot_psi(np.pi)
-            u, s, v = np.linalg.svd(tf[:3,:3])
-            R = u@np.eye(3)@v
-            tf[:3,:3] = R
-            tfs.append(tf)
+
+        # undistort once and write pinhole intrinsics, so the pinhole get_rays is exact up to the frame edges.
+        params = file_params[foldernames[i]]
+        img_folder = 'images'
+        if not args.no_undistort and any([params['k1'], params['k2'], params['p1'], params['p2']]):
+            K = np.array([[params['fl_x'], 0, params['cx']], [0, params['fl_y'], params['cy']], [0, 0, 1]])
+            dist = np.array([params['k1'], params['k2'], params['p1'], params['p2']])
+            img_folder = 'images_undistorted'
+            K = undistort_images(img_dir, os.path.join(args.data_path, foldernames[i], img_folder), img_names, K, dist, params['w'], params['h'], args.workers)
+            params['fl_x'], params['fl_y'], params['cx'], params['cy'] = K[0, 0], K[1, 1], K[0, 2], K[1, 2]
+            params['k1'] = params['k2'] = params['p1'] = params['p2'] = 0
+            params['camera_angle_x'] = 2 * np.arctan(params['w'] / (2 * params['fl_x']))
+            params['camera_angle_y'] = 2 * np.arctan(params['h'] / (2 * params['fl_y']))
+
+        # align each frame to the mocap stream by its timestamp: index, time_sec, time_nano
+        if args.mocap:
+            times_fn = os.path.join(args.data_path, foldernames[i], args.frame_times)
+            print(times_fn)
+            frame_times = read_csv(times_fn)
+            frame_ns = to_nanoseconds(frame_times[:, 1], frame_times[:, 2])
+            translations, quaternions, gap = align_poses(mocap_ns, mocap_t, mocap_q, frame_ns, args.align)
+            print(f"[INFO] {foldernames[i]}: aligned {frame_ns.shape[0]} frames, max gap to a mocap sample = {gap.max() / 1e6:.3f} ms")
         
+        # or use the per-frame poses already exported: index, time, tx, ty, tz, qx, qy, qz, qw
+        else:
+            tf_fn = os.path.join(args.data_path, foldernames[i], filenames[i])
+            print(tf_fn)
+            poses = read_csv(tf_fn)
+            translations, quaternions = poses[:, 2:5], poses[:, 5:9]
+
+        tfs = tf_from_vect(quaternions, translations) # [N, 4, 4]
         
-        tfs = np.array(tfs)
+        tfs[:,:3,3] = tfs[:,:3,3] + offset[i]
+        tfs[:,:3,:3] = calib_rot@tfs[:,:3,:3]
+        tfs[:,:3,3] = tfs[:,:3,3] + calib_trans
+        tfs = tfs @ rot_phi(-np.pi/2) @ rot_psi(np.pi)
+        u, s, v = np.linalg.svd(tfs[:,:3,:3])
+        tfs[:,:3,:3] = u@v
         
         mean = np.mean(tfs[:,:3,3],axis=0)
-        for j in range(tfs.shape[0]):
-             tfs[j,:3,3] = tfs[j,:3,3] - mean
+        tfs[:,:3,3] = tfs[:,:3,3] - mean
                 
-#         print(np.max(tfs[:,3,2]))
-#         print(np.min(tfs[:,3,2]))  
         shift = (np.max(tfs[:,:3,3],axis=0) + np.min(tfs[:,:3,3],axis=0))/2
-        for j in range(tfs.shape[0]):
-            tfs[j,:3,3] = tfs[j,:3,3] - shift
+        tfs[:,:3,3] = tfs[:,:3,3] - shift
             
         shift_z = - np.min(tfs[:,2,3],axis=0) #np.max(tfs[:,2,3],axis=0) - np.min(tfs[:,2,3],axis=0)
-        print("z-shift")
-        print(shift_z)
-        print(tfs[:,2,3])
-        #print(tfs3,3])
-        for j in range(tfs.shape[0]):
-            tfs[j,2,3] = tfs[j,2,3] + shift_z
+        tfs[:,2,3] = tfs[:,2,3] + shift_z
             
-        print("")
-        print("result")
-        print(tfs[:,2,3])
-        print(np.max(tfs[:,2,3]))
-        print(np.min(tfs[:,2,3])) 
-        print(tfs[0,:,:])
-#         stop
+        print(f"[INFO] {foldernames[i]}: z-shift = {shift_z}, z range = [{np.min(tfs[:,2,3])}, {np.max(tfs[:,2,3])}]")
+
         frames = []
         for j in range(tfs.shape[0]):
             frame = {}
-            frame['file_path'] = os.path.join(args.data_path, foldernames[i], 'images', img_names[j])
-            sharpness = cv2.Laplacian(cv2.imread(os.path.join(img_dir,img_names[i])), cv2.CV_64F).var()
-            frame['sharpness'] = sharpness
-            tf_list = tfs[j].tolist() 
-            frame['transform_matrix'] = tf_list #tfs[i].tolist()
+            frame['file_path'] = os.path.join(args.data_path, foldernames[i], img_folder, img_names[j])
+            if args.sharpness:
+                frame['sharpness'] = cv2.Laplacian(cv2.imread(os.path.join(img_dir,img_names[j])), cv2.CV_64F).var()
+            frame['transform_matrix'] = tfs[j].tolist()
             frames.append(frame)
     
         file_params[foldernames[i]]['frames'] = frames
         json_object = json.dumps(file_params[foldernames[i]], indent = 2)
     
-        destination = os.path.join(args.data_path, foldernames[i], 'transforms.json')
+        destination = os.path.join(args.data_path, foldernames[i], 'transforms_train.json')
+        print(f"[INFO] writing {len(frames)} frames to {destination}")
         with open(destination, "w") as outfile:
             outfile.write(json_object)
        
@@ -400,6 +437,21 @@ if __name__ == '__main__':
     #parser.add_argument('--fov_y', required=False,
     #                    help='camera field of view in x direction (assumed to be in degrees)')
 
+    parser.add_argument('--calibration', default='tfs.csv',
+                        help='mocap / april tag calibration csv')
+    parser.add_argument('--mocap', default='',
+                        help='raw mocap csv (count, sec, nanosec, tx, ty, tz, qx, qy, qz, qw); if given, every frame is aligned to it by timestamp')
+    parser.add_argument('--frame_times', default='frame_times.csv',
+                        help='per-modality csv of frame timestamps (index, sec, nanosec), used with --mocap')
+    parser.add_argument('--align', default='linear', choices=['nearest', 'linear'],
+                        help='pose lookup between mocap samples, used with --mocap')
+    parser.add_argument('--sharpness', action='store_true',
+                        help='also store the sharpness of every image (reads all images)')
+    parser.add_argument('--no_undistort', action='store_true',
+                        help='keep the distorted images and write the distortion coefficients instead of undistorting once with pinhole intrinsics')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='threads used to undistort images, 0 means one per cpu')
+
     args = parser.parse_args() 
     construct_json(args)
     
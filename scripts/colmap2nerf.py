@@ -19,6 +19,9 @@ import math
 import cv2
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from undistort import undistort_images
 
 def parse_args():
     parser = argparse.ArgumentParser(description="convert a text colmap export to nerf format transforms.json; optionally convert video to images, and optionally run colmap in the first place")
@@ -32,6 +35,7 @@ def parse_args():
     parser.add_argument('--hold', type=int, default=8, help="hold out for validation every $ images")
 
     parser.add_argument("--video_fps", default=3)
+    parser.add_argument("--ffmpeg", action="store_true", help="dump frames at a fixed fps with ffmpeg instead of the streaming ingest that keeps the sharpest frame per 1 / video_fps window")
     parser.add_argument("--time_slice", default="", help="time (in seconds) in the format t1,t2 within which the images should be generated from the video. eg: \"--time_slice '10,300'\" will generate images only from 10th second to 300th second of the video")
 
     parser.add_argument("--colmap_matcher", default="exhaustive", choices=["exhaustive","sequential","spatial","transitive","vocab_tree"], help="select which matcher colmap should use. sequential for videos, exhaustive for adhoc images")
@@ -40,6 +44,11 @@ def parse_args():
     parser.add_argument("--colmap_text", default="colmap_text", help="input path to the colmap text files (set automatically if run_colmap is used)")
     parser.add_argument("--colmap_db", default="colmap.db", help="colmap database filename")
 
+    parser.add_argument("--workers", type=int, default=0, help="processes (sharpness) / threads (undistortion) used per image, 0 means one per cpu")
+    parser.add_argument("--sharpness_cache", default="sharpness.json", help="per-image sharpness cache (relative to the data root), so reprocessing only scores new images")
+    parser.add_argument("--max_pairs", type=int, default=2**24, help="max camera pairs used to find the center of attention, a random subset is used beyond that")
+    parser.add_argument("--no_undistort", action="store_true", help="keep the distorted images and write the distortion coefficients instead of undistorting once with pinhole intrinsics")
+
     args = parser.parse_args()
     return args
 
@@ -74,6 +83,88 @@ def run_ffmpeg(args):
 
     do_system(f"ffmpeg -i {video} -qscale:v 1 -qmin 1 -vf \"fps={fps}{time_slice_value}\" {images}/%04d.jpg")
 
+def run_video_ingest(args, cache_path):
+    # decode the video once and keep the best frame of every 1 / video_fps window, written straight to the images folder.
+    # frames are ranked by sharpness (variance of laplacian) divided by (1 + motion), motion being the mean absolute
+    # difference to the previous frame at 1/8 resolution. no intermediate frame dump is ever written to disk.
+    # the sharpness of kept frames is stored in the sharpness cache, so it is not recomputed later.
+    video = args.video
+    images = args.images
+    fps = float(args.video_fps) or 1.0
+
+    print(f"ingesting video file={video}, output image folder={images}, fps={fps}.")
+    if (input(f"warning! folder '{images}' will be deleted/replaced. continue? (Y/n)").lower().strip()+"y")[:1] != "y":
+        sys.exit(1)
+
+    try:
+        shutil.rmtree(images)
+    except:
+        pass
+
+    os.makedirs(images)
+
+    start, end = 0, float("inf")
+    if args.time_slice:
+        start, end = map(float, args.time_slice.split(","))
+
+    cap = cv2.VideoCapture(video)
+    if not cap.isOpened():
+        print(f"FATAL: cannot open video {video}")
+        sys.exit(1)
+    video_fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    frame_id = int(start * video_fps)
+    if frame_id > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_id)
+
+    cache = {}
+    kept = []
+
+    def write(best):
+        name = f"{len(kept) + 1:04d}.jpg"
+        path = os.path.join(images, name)
+        ok, buf = cv2.imencode(".jpg", best[1], [cv2.IMWRITE_JPEG_QUALITY, 95])
+        buf.tofile(path)
+        # score the encoded image, so the cache matches sharpness(path)
+        b = variance_of_laplacian(cv2.cvtColor(cv2.imdecode(buf, cv2.IMREAD_COLOR), cv2.COLOR_BGR2GRAY))
+        st = os.stat(path)
+        cache[name] = {"mtime": st.st_mtime, "size": st.st_size, "sharpness": b}
+        kept.append(name)
+
+    window = None
+    best = None # (score, frame)
+    prev = None
+    while True:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        t = frame_id / video_fps
+        frame_id += 1
+        if t >= end:
+            break
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, None, fx=0.125, fy=0.125, interpolation=cv2.INTER_AREA).astype(np.float32)
+        motion = 0 if prev is None else np.mean(np.abs(small - prev))
+        prev = small
+        score = variance_of_laplacian(gray) / (1 + motion)
+
+        w = int((t - start) * fps)
+        if w != window:
+            if best is not None:
+                write(best)
+            window, best = w, None
+        if best is None or score > best[0]:
+            best = (score, frame)
+
+    if best is not None:
+        write(best)
+    cap.release()
+
+    with open(cache_path, "w") as f:
+        json.dump(cache, f, indent=2)
+
+    print(f"kept {len(kept)} frames out of {frame_id - int(start * video_fps)}.")
+
 def run_colmap(args):
     db = args.colmap_db
     images = args.images
@@ -113,22 +204,52 @@ def sharpness(imagePath):
     fm = variance_of_laplacian(gray)
     return fm
 
+def sharpness_all(image_dir, names, cache_path, workers=0):
+    # sharpness of every image, scored in a process pool.
+    # scores are cached per image name (invalidated by mtime / size), so reprocessing a capture is incremental.
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+
+    stats = [os.stat(os.path.join(image_dir, name)) for name in names]
+    todo = [i for i, (name, st) in enumerate(zip(names, stats)) 
+            if name not in cache or cache[name]["mtime"] != st.st_mtime or cache[name]["size"] != st.st_size]
+
+    print(f"[INFO] scoring sharpness of {len(todo)} images ({len(names) - len(todo)} cached)...")
+
+    if len(todo) > 0:
+        workers = workers or os.cpu_count() or 1
+        paths = [os.path.join(image_dir, names[i]) for i in todo]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            scores = list(pool.map(sharpness, paths, chunksize=max(1, len(paths) // (4 * workers))))
+
+        for i, b in zip(todo, scores):
+            cache[names[i]] = {"mtime": stats[i].st_mtime, "size": stats[i].st_size, "sharpness": b}
+
+        with open(cache_path, "w") as f:
+            json.dump(cache, f, indent=2)
+
+    return np.array([cache[name]["sharpness"] for name in names])
+
 def qvec2rotmat(qvec):
-    return np.array([
-        [
-            1 - 2 * qvec[2]**2 - 2 * qvec[3]**2,
-            2 * qvec[1] * qvec[2] - 2 * qvec[0] * qvec[3],
-            2 * qvec[3] * qvec[1] + 2 * qvec[0] * qvec[2]
-        ], [
-            2 * qvec[1] * qvec[2] + 2 * qvec[0] * qvec[3],
-            1 - 2 * qvec[1]**2 - 2 * qvec[3]**2,
-            2 * qvec[2] * qvec[3] - 2 * qvec[0] * qvec[1]
-        ], [
-            2 * qvec[3] * qvec[1] - 2 * qvec[0] * qvec[2],
-            2 * qvec[2] * qvec[3] + 2 * qvec[0] * qvec[1],
-            1 - 2 * qvec[1]**2 - 2 * qvec[2]**2
-        ]
-    ])
+    # qvec: [..., 4] as (w, x, y, z), return: [..., 3, 3]
+    w, x, y, z = qvec[..., 0], qvec[..., 1], qvec[..., 2], qvec[..., 3]
+    return np.stack([
+        np.stack([
+            1 - 2 * y**2 - 2 * z**2,
+            2 * x * y - 2 * w * z,
+            2 * z * x + 2 * w * y
+        ], -1), np.stack([
+            2 * x * y + 2 * w * z,
+            1 - 2 * x**2 - 2 * z**2,
+            2 * y * z - 2 * w * x
+        ], -1), np.stack([
+            2 * z * x - 2 * w * y,
+            2 * y * z + 2 * w * x,
+            1 - 2 * x**2 - 2 * y**2
+        ], -1)
+    ], -2)
 
 def rotmat(a, b):
 	a, b = a / np.linalg.norm(a), b / np.linalg.norm(b)
@@ -142,18 +263,53 @@ def rotmat(a, b):
 	return np.eye(3) + kmat + kmat.dot(kmat) * ((1 - c) / (s ** 2 + 1e-10))
 
 def closest_point_2_lines(oa, da, ob, db): # returns point closest to both rays of form o+t*d, and a weight factor that goes to 0 if the lines are parallel
-    da = da / np.linalg.norm(da)
-    db = db / np.linalg.norm(db)
+    # batched: all inputs are [..., 3], returns [..., 3] and [...]
+    da = da / np.linalg.norm(da, axis=-1, keepdims=True)
+    db = db / np.linalg.norm(db, axis=-1, keepdims=True)
     c = np.cross(da, db)
-    denom = np.linalg.norm(c)**2
+    denom = np.sum(c ** 2, axis=-1)
     t = ob - oa
-    ta = np.linalg.det([t, db, c]) / (denom + 1e-10)
-    tb = np.linalg.det([t, da, c]) / (denom + 1e-10)
-    if ta > 0:
-        ta = 0
-    if tb > 0:
-        tb = 0
-    return (oa+ta*da+ob+tb*db) * 0.5, denom
+    ta = np.sum(t * np.cross(db, c), axis=-1) / (denom + 1e-10) # det([t, db, c])
+    tb = np.sum(t * np.cross(da, c), axis=-1) / (denom + 1e-10) # det([t, da, c])
+    ta = np.minimum(ta, 0)
+    tb = np.minimum(tb, 0)
+    return (oa + ta[..., None] * da + ob + tb[..., None] * db) * 0.5, denom
+
+def center_of_attention(origins, dirs, max_pairs=2**24, chunk=2**20, seed=0):
+    # weighted mean of the closest points between the optical axes of all camera pairs (pairs with weight <= 0.01 are ignored).
+    # origins, dirs: [N, 3]. beyond max_pairs pairs, a random subset of max_pairs pairs is used.
+    N = origins.shape[0]
+    num_pairs = N * N
+    if num_pairs > max_pairs:
+        print(f"[INFO] using {max_pairs} random pairs out of {num_pairs}")
+        rng = np.random.default_rng(seed)
+        num_pairs = max_pairs
+
+    totw = 0.0
+    totp = np.zeros(3)
+    for head in range(0, num_pairs, chunk):
+        if num_pairs < N * N:
+            ia = rng.integers(0, N, min(chunk, num_pairs - head))
+            ib = rng.integers(0, N, min(chunk, num_pairs - head))
+        else:
+            k = np.arange(head, min(head + chunk, num_pairs))
+            ia, ib = k // N, k % N
+        p, weight = closest_point_2_lines(origins[ia], dirs[ia], origins[ib], dirs[ib])
+        weight = np.where(weight > 0.01, weight, 0)
+        totp += np.sum(p * weight[:, None], axis=0)
+        totw += np.sum(weight)
+    return totp / totw
+
+def read_images_txt(path, skip_early=0):
+    # every image takes two lines in images.txt: the pose, then its 2D points.
+    # return: names, qvecs [N, 4], tvecs [N, 3]
+    with open(path, "r") as f:
+        lines = [line.strip() for line in f if line[0] != "#"]
+    lines = lines[0::2][skip_early:]
+    elems = [line.split(" ") for line in lines] # 1-4 is quat, 5-7 is trans, 9ff is filename (9, if filename contains no spaces)
+    names = ['_'.join(e[9:]) for e in elems]
+    params = np.array([e[1:8] for e in elems], dtype=np.float64).reshape(-1, 7)
+    return names, params[:, :4], params[:, 4:]
 
 if __name__ == "__main__":
     args = parse_args()
@@ -161,7 +317,10 @@ if __name__ == "__main__":
     if args.video != "":
         root_dir = os.path.dirname(args.video)
         args.images = os.path.join(root_dir, "images") # override args.images
-        run_ffmpeg(args)
+        if args.ffmpeg:
+            run_ffmpeg(args)
+        else:
+            run_video_ingest(args, os.path.join(root_dir, args.sharpness_cache))
     else:
         args.images = args.images[:-1] if args.images[-1] == '/' else args.images # remove trailing / (./a/b/ --> ./a/b)
         root_dir = os.path.dirname(args.images)
@@ -228,58 +387,37 @@ if __name__ == "__main__":
 
     print(f"camera:\n\tres={w,h}\n\tcenter={cx,cy}\n\tfocal={fl_x,fl_y}\n\tfov={fovx,fovy}\n\tk={k1,k2} p={p1,p2} ")
 
-    with open(os.path.join(TEXT_FOLDER, "images.txt"), "r") as f:
-        i = 0
-
-        bottom = np.array([0.0, 0.0, 0.0, 1.0]).reshape([1, 4])
-
-        frames = []
-
-        up = np.zeros(3)
-        for line in f:
-            line = line.strip()
-
-            if line[0] == "#":
-                continue
-
-            i = i + 1
-            if i < SKIP_EARLY*2:
-                continue
-
-            if i % 2 == 1:
-                elems = line.split(" ") # 1-4 is quat, 5-7 is trans, 9ff is filename (9, if filename contains no spaces)
-
-                name = '_'.join(elems[9:])
-                full_name = os.path.join(args.images, name)
-                rel_name = full_name[len(root_dir) + 1:]
-
-                b = sharpness(full_name)
-                # print(name, "sharpness =",b)
-
-                image_id = int(elems[0])
-                qvec = np.array(tuple(map(float, elems[1:5])))
-                tvec = np.array(tuple(map(float, elems[5:8])))
-                R = qvec2rotmat(-qvec)
-                t = tvec.reshape([3, 1])
-                m = np.concatenate([np.concatenate([R, t], 1), bottom], 0)
-                c2w = np.linalg.inv(m)
-                
-                c2w[0:3, 2] *= -1 # flip the y and z axis
-                c2w[0:3, 1] *= -1
-                c2w = c2w[[1, 0, 2, 3],:] # swap y and z
-                c2w[2, :] *= -1 # flip whole world upside down
-
-                up += c2w[0:3, 1]
-
-                frame = {
-                    "file_path": rel_name, 
-                    "sharpness": b, 
-                    "transform_matrix": c2w
-                }
-
-                frames.append(frame)
-
-    N = len(frames)
+    names, qvecs, tvecs = read_images_txt(os.path.join(TEXT_FOLDER, "images.txt"), SKIP_EARLY)
+    N = len(names)
+
+    sharpness_cache = os.path.join(root_dir, args.sharpness_cache)
+    sharps = sharpness_all(args.images, names, sharpness_cache, args.workers)
+
+    # undistort once, so the pinhole get_rays is exact up to the frame edges.
+    image_dir = args.images
+    if not args.no_undistort and any([k1, k2, p1, p2]):
+        image_dir = args.images + "_undistorted"
+        K = np.array([[fl_x, 0, cx], [0, fl_y, cy], [0, 0, 1]])
+        K = undistort_images(args.images, image_dir, names, K, np.array([k1, k2, p1, p2]), int(w), int(h), args.workers)
+        fl_x, fl_y, cx, cy = K[0, 0], K[1, 1], K[0, 2], K[1, 2]
+        k1 = k2 = p1 = p2 = 0
+        angle_x = math.atan(w / (fl_x * 2)) * 2
+        angle_y = math.atan(h / (fl_y * 2)) * 2
+        print(f"[INFO] pinhole camera after undistortion: center={cx,cy} focal={fl_x,fl_y}")
+
+    # world-to-camera --> camera-to-world, all frames at once
+    m = np.zeros([N, 4, 4])
+    m[:, 0:3, 0:3] = qvec2rotmat(-qvecs)
+    m[:, 0:3, 3] = tvecs
+    m[:, 3, 3] = 1
+    c2w = np.linalg.inv(m)
+
+    c2w[:, 0:3, 2] *= -1 # flip the y and z axis
+    c2w[:, 0:3, 1] *= -1
+    c2w = c2w[:, [1, 0, 2, 3], :] # swap y and z
+    c2w[:, 2, :] *= -1 # flip whole world upside down
+
+    up = np.sum(c2w[:, 0:3, 1], axis=0)
     up = up / np.linalg.norm(up)
 
     print("[INFO] up vector was", up)
@@ -288,31 +426,29 @@ if __name__ == "__main__":
     R = np.pad(R, [0, 1])
     R[-1, -1] = 1
 
-    for f in frames:
-        f["transform_matrix"] = np.matmul(R, f["transform_matrix"]) # rotate up to be the z axis
+    c2w = np.matmul(R, c2w) # rotate up to be the z axis
 
     # find a central point they are all looking at
     print("[INFO] computing center of attention...")
-    totw = 0.0
-    totp = np.array([0.0, 0.0, 0.0])
-    for f in frames:
-        mf = f["transform_matrix"][0:3,:]
-        for g in frames:
-            mg = g["transform_matrix"][0:3,:]
-            p, weight = closest_point_2_lines(mf[:,3], mf[:,2], mg[:,3], mg[:,2])
-            if weight > 0.01:
-                totp += p * weight
-                totw += weight
-    totp /= totw
-    for f in frames:
-        f["transform_matrix"][0:3,3] -= totp
-    avglen = 0.
-    for f in frames:
-        avglen += np.linalg.norm(f["transform_matrix"][0:3,3])
-    avglen /= N
+    totp = center_of_attention(c2w[:, 0:3, 3], c2w[:, 0:3, 2], args.max_pairs)
+    c2w[:, 0:3, 3] -= totp
+
+    avglen = np.mean(np.linalg.norm(c2w[:, 0:3, 3], axis=-1))
     print("[INFO] avg camera distance from origin", avglen)
-    for f in frames:
-        f["transform_matrix"][0:3,3] *= 4.0 / avglen # scale to "nerf sized"
+    c2w[:, 0:3, 3] *= 4.0 / avglen # scale to "nerf sized"
+
+    frames = []
+    for name, b, pose in zip(names, sharps, c2w):
+        full_name = os.path.join(image_dir, name)
+        rel_name = full_name[len(root_dir) + 1:]
+
+        frame = {
+            "file_path": rel_name, 
+            "sharpness": b, 
+            "transform_matrix": pose
+        }
+
+        frames.append(frame)
 
     # sort frames by id
     frames.sort(key=lambda d: d['file_path'])
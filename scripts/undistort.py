@@ -0,0 +1,28 @@
+# image undistortion shared by the dataset converters (colmap2nerf.py, scripts/colmap2nerf.py, optitrack2nerf.py).
+import os
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+
+def undistort_images(src_dir, dst_dir, names, K, dist, w, h, workers=0):
+    # undistort every image once, so training only needs the pinhole model.
+    # the remap table is built once for the camera and shared by a thread pool (cv2 releases the GIL, so this stays I/O bound).
+    # images already undistorted (newer than their source) are skipped.
+    # return: [3, 3] pinhole camera matrix of the undistorted images.
+    newK, _ = cv2.getOptimalNewCameraMatrix(K, dist, (w, h), 0, (w, h))
+    map1, map2 = cv2.initUndistortRectifyMap(K, dist, None, newK, (w, h), cv2.CV_16SC2)
+
+    def undistort(name):
+        src = os.path.join(src_dir, name)
+        dst = os.path.join(dst_dir, name)
+        if os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+            return
+        image = cv2.imread(src, cv2.IMREAD_UNCHANGED)
+        cv2.imwrite(dst, cv2.remap(image, map1, map2, cv2.INTER_LINEAR))
+
+    os.makedirs(dst_dir, exist_ok=True)
+    print(f"[INFO] undistorting {len(names)} images to {dst_dir}")
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        list(pool.map(undistort, names))
+
+    return newK
@@ -0,0 +1,60 @@
+import torch
+
+
+class AABBTree:
+    ''' bounding volume hierarchy over axis aligned boxes, e.g. the world boxes of the objects of a composed scene.
+    Built by median splits of the box centers along the longest axis, one box per leaf.
+    query(x) routes the points down the tree, a subtree only sees the points inside its bounds,
+    so each point ends at the few boxes that contain it instead of being tested against all of them.
+    '''
+    def __init__(self, boxes, ids=None):
+        # boxes: [O, 6], (min, max) of each box
+        # ids: [O], what query returns for each box (default: its index)
+        boxes = boxes.detach().float()
+        ids = list(range(boxes.shape[0])) if ids is None else list(ids)
+
+        self.nodes = [] # [M], (left child, right child, id) with children -1 at the leaves
+        bounds = []
+        self.build(boxes.cpu(), ids, bounds)
+        self.bounds = torch.stack(bounds, dim=0).to(boxes.device) # [M, 6]
+
+    def build(self, boxes, ids, bounds):
+        node = len(self.nodes)
+        self.nodes.append(None)
+        bounds.append(torch.cat([boxes[:, :3].amin(0), boxes[:, 3:].amax(0)]))
+
+        if len(ids) == 1:
+            self.nodes[node] = (-1, -1, ids[0])
+        else:
+            centers = (boxes[:, :3] + boxes[:, 3:]) / 2 # [O, 3]
+            axis = (centers.amax(0) - centers.amin(0)).argmax()
+            order = centers[:, axis].argsort().tolist()
+            half = len(order) // 2
+            left = self.build(boxes[order[:half]], [ids[i] for i in order[:half]], bounds)
+            right = self.build(boxes[order[half:]], [ids[i] for i in order[half:]], bounds)
+            self.nodes[node] = (left, right, None)
+
+        return node
+
+    def query(self, x):
+        # x: [N, 3]
+        # return: list of (id, inds), the points x[inds] ([M] int64) inside box id, for the boxes hit by any point.
+        results = []
+        stack = [(0, None)]
+        while len(stack) > 0:
+            node, inds = stack.pop()
+            points = x if inds is None else x[inds]
+            bound = self.bounds[node]
+            inside = ((points >= bound[:3]) & (points <= bound[3:])).all(dim=-1)
+            inds = inside.nonzero(as_tuple=True)[0] if inds is None else inds[inside]
+            if inds.shape[0] == 0:
+                continue
+
+            left, right, id = self.nodes[node]
+            if left < 0:
+                results.append((id, inds))
+            else:
+                stack.append((right, inds))
+                stack.append((left, inds))
+
+        return results
@@ -0,0 +1,58 @@
+import numpy as np
+
+import torch
+
+
+class RankLOD:
+    ''' level of detail for a (single object) CCNeRF: how many of its rank groups are evaluated at inference.
+    mode 'footprint': per sample, from the width of a pixel at its distance to the camera compared to the voxel size,
+                      all groups while a pixel covers at most bias voxels, one less per doubling of the footprint (NeRFNetwork.lod_levels).
+    mode 'latency': per frame, the largest K whose expected frame time fits target_ms. Frame times are measured per K (moving average),
+                    an unmeasured K is extrapolated from the closest measured one by the number of ranks it evaluates.
+    Call begin(data) before rendering a frame and end(ms) after it (the tensoRF Trainer does both when trainer.lod is set).
+    '''
+    def __init__(self, model, mode='footprint', bias=1.0, target_ms=33.0, momentum=0.5):
+        assert mode in ['footprint', 'latency'], f'unknown lod mode {mode}'
+        assert len(model.K) == 1, 'level of detail needs a single object model'
+
+        self.model = model
+        self.mode = mode
+        self.bias = bias
+        self.target_ms = target_ms
+        self.momentum = momentum
+
+        # ranks evaluated by the first k groups (density + color, lines + planes), the cost model of the latency mode.
+        ranks = [np.asarray(r[0]) for r in [model.rank_vec_density, model.rank_mat_density, model.rank_vec, model.rank_mat]]
+        self.ranks = np.sum(ranks, axis=0).astype(np.float64) # [K], cumulative
+
+        self.times = {} # K -> ms
+        self.K = model.K[0]
+
+    def expected_ms(self, K):
+        if K in self.times:
+            return self.times[K]
+        if len(self.times) == 0:
+            return 0
+        ref = min(self.times.keys(), key=lambda k: abs(k - K))
+        return self.times[ref] * self.ranks[K - 1] / self.ranks[ref - 1]
+
+    def begin(self, data):
+        # data: a test / eval batch, with rays_o, rays_d of the full frame ([B, H * W, 3]) and H, W (or images).
+        if self.mode == 'footprint':
+            rays_o = data['rays_o'].reshape(-1, 3)
+            rays_d = data['rays_d'].reshape(-1, 3)
+            H, W = (data['H'], data['W']) if 'H' in data else data['images'].shape[1:3]
+            center = (H // 2) * W + W // 2
+            pixel = torch.norm(rays_d[center + 1] - rays_d[center]) / torch.norm(rays_d[center]) # angular width of a pixel
+            self.model.lod = {'origin': rays_o[center], 'pixel': pixel.item(), 'bias': self.bias}
+        else:
+            fits = [k for k in range(1, self.model.K[0] + 1) if self.expected_ms(k) <= self.target_ms]
+            self.K = max(fits) if len(fits) > 0 else 1
+            self.model.lod = self.K
+
+    def end(self, ms):
+        if self.mode == 'latency':
+            self.times[self.K] = ms if self.K not in self.times else self.momentum * self.times[self.K] + (1 - self.momentum) * ms
+
+    def release(self):
+        self.model.lod = None
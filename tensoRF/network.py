@@ -10,6 +10,24 @@ from nerf.renderer import NeRFRenderer
 import raymarching
 
 
+@torch.no_grad()
+def resample_param(params, i, fn, optimizer=None):
+    # params[i] <- fn(params[i]) (an interpolation or a slice), also swapped into optimizer in place,
+    # with its per-element state (Adam moments) resampled by the same fn, so training continues where it was.
+    old = params[i]
+    new = nn.Parameter(fn(old.data).contiguous())
+    params[i] = new
+
+    if optimizer is not None:
+        for group in optimizer.param_groups:
+            group['params'] = [new if p is old else p for p in group['params']]
+        state = optimizer.state.pop(old, None)
+        if state is not None:
+            optimizer.state[new] = {k: fn(v).contiguous() if torch.is_tensor(v) and v.shape == old.shape else v for k, v in state.items()}
+
+    return new
+
+
 class NeRFNetwork(NeRFRenderer):
     def __init__(self,
                  resolution=[128] * 3,
@@ -264,24 +282,26 @@ class NeRFNetwork(NeRFRenderer):
     
     # upsample utils
     @torch.no_grad()
-    def upsample_params(self, mat, vec, resolution):
+    def upsample_params(self, mat, vec, resolution, optimizer=None):
 
         for i in range(len(self.vec_ids)):
             vec_id = self.vec_ids[i]
             mat_id_0, mat_id_1 = self.mat_ids[i]
-            mat[i] = nn.Parameter(F.interpolate(mat[i].data, size=(resolution[mat_id_1], resolution[mat_id_0]), mode='bilinear', align_corners=True))
-            vec[i] = nn.Parameter(F.interpolate(vec[i].data, size=(resolution[vec_id], 1), mode='bilinear', align_corners=True))
+            resample_param(mat, i, lambda x: F.interpolate(x, size=(resolution[mat_id_1], resolution[mat_id_0]), mode='bilinear', align_corners=True), optimizer)
+            resample_param(vec, i, lambda x: F.interpolate(x, size=(resolution[vec_id], 1), mode='bilinear', align_corners=True), optimizer)
 
 
     @torch.no_grad()
-    def upsample_model(self, resolution):
-        self.upsample_params(self.sigma_mat, self.sigma_vec, resolution)
-        self.upsample_params(self.color_mat, self.color_vec, resolution)
+    def upsample_model(self, resolution, optimizer=None):
+        # optimizer: if given, the new parameters replace the old ones in it, with their Adam moments upsampled alike.
+        self.upsample_params(self.sigma_mat, self.sigma_vec, resolution, optimizer)
+        self.upsample_params(self.color_mat, self.color_vec, resolution, optimizer)
         self.resolution = resolution
 
     @torch.no_grad()
-    def shrink_model(self):
+    def shrink_model(self, optimizer=None):
         # shrink aabb_train and the model so it only represents the space inside aabb_train.
+        # optimizer: if given, the cropped parameters replace the old ones in it, with their Adam moments cropped alike.
 
         half_grid_size = self.bound / self.grid_size
         thresh = min(self.density_thresh, self.mean_density)
@@ -306,11 +326,14 @@ class NeRFNetwork(NeRFRenderer):
             vec_id = self.vec_ids[i]
             mat_id_0, mat_id_1 = self.mat_ids[i]
 
-            self.sigma_vec[i] = nn.Parameter(self.sigma_vec[i].data[..., tl[vec_id]:br[vec_id], :])
-            self.color_vec[i] = nn.Parameter(self.color_vec[i].data[..., tl[vec_id]:br[vec_id], :])
+            crop_vec = lambda x: x[..., tl[vec_id]:br[vec_id], :]
+            crop_mat = lambda x: x[..., tl[mat_id_1]:br[mat_id_1], tl[mat_id_0]:br[mat_id_0]]
+
+            resample_param(self.sigma_vec, i, crop_vec, optimizer)
+            resample_param(self.color_vec, i, crop_vec, optimizer)
 
-            self.sigma_mat[i] = nn.Parameter(self.sigma_mat[i].data[..., tl[mat_id_1]:br[mat_id_1], tl[mat_id_0]:br[mat_id_0]])
-            self.color_mat[i] = nn.Parameter(self.color_mat[i].data[..., tl[mat_id_1]:br[mat_id_1], tl[mat_id_0]:br[mat_id_0]])
+            resample_param(self.sigma_mat, i, crop_mat, optimizer)
+            resample_param(self.color_mat, i, crop_mat, optimizer)
         
         self.aabb_train = torch.cat([min_pos, max_pos], dim=0) # [6]
 
@@ -7,6 +7,8 @@ import numpy as np
 from encoding import get_encoder
 from activation import trunc_exp
 from nerf.renderer import NeRFRenderer
+from tensoRF.network import resample_param
+from tensoRF.bvh import AABBTree
 import raymarching
 
 
@@ -113,6 +115,15 @@ class NeRFNetwork(NeRFRenderer):
         # flag
         self.finalized = False if self.K[0] != 1 else True
 
+        # composed objects: culling margin (in the normalized box) and world box of each, and a BVH over the boxes.
+        self.margins = [None]
+        self.boxes = [None]
+        self.bvh = None
+
+        # level of detail at inference (single object): None (all rank groups), an int K for every sample,
+        # or a dict(origin, pixel, bias) to pick K per sample from its pixel footprint (see lod_levels, tensoRF/lod.py).
+        self.lod = None
+
         # background model
         if self.bg_radius > 0:
             
@@ -250,6 +261,73 @@ class NeRFNetwork(NeRFRenderer):
         return outputs
 
 
+    def compute_features_lod(self, x, K, density=True):
+        # x: [N, 3], in [-1, 1]
+        # K: [N], number of rank groups of each sample (single object)
+        # return: [N, out_dim], sum of the first K[n] groups for sample n, each group evaluated on the samples that use it only.
+
+        if density:
+            U_vec, S_vec, U_mat, S_mat = self.U_vec_density, self.S_vec_density, self.U_mat_density, self.S_mat_density
+            group_vec, group_mat = self.group_vec_density[0], self.group_mat_density[0]
+        else:
+            U_vec, S_vec, U_mat, S_mat = self.U_vec, self.S_vec, self.U_mat, self.S_mat
+            group_vec, group_mat = self.group_vec[0], self.group_mat[0]
+
+        N = x.shape[0]
+
+        vec_coord = torch.stack((x[..., self.vec_ids[0]], x[..., self.vec_ids[1]], x[..., self.vec_ids[2]]))
+        vec_coord = torch.stack((torch.zeros_like(vec_coord), vec_coord), dim=-1).view(3, -1, 1, 2)
+
+        mat_coord = torch.stack((x[..., self.mat_ids[0]], x[..., self.mat_ids[1]], x[..., self.mat_ids[2]])).view(3, -1, 1, 2) # [3, N, 1, 2]
+
+        y = None
+
+        offset_vec = 0
+        offset_mat = 0
+
+        for k in range(min(int(K.max()), self.K[0]) if N > 0 else 0):
+
+            inds = (K > k).nonzero(as_tuple=True)[0] # [M]
+            M = inds.shape[0]
+
+            if group_vec[k]:
+                coord = vec_coord[:, inds]
+                vec_feat = F.grid_sample(U_vec[3 * offset_vec + 0], coord[[0]], align_corners=False).view(-1, M) * \
+                           F.grid_sample(U_vec[3 * offset_vec + 1], coord[[1]], align_corners=False).view(-1, M) * \
+                           F.grid_sample(U_vec[3 * offset_vec + 2], coord[[2]], align_corners=False).view(-1, M) # [r, M]
+                part = S_vec[offset_vec] @ vec_feat # [out_dim, M]
+                y = part.new_zeros(part.shape[0], N) if y is None else y
+                y = y.index_add(1, inds, part.to(y.dtype)) # [out_dim, N]
+
+                offset_vec += 1
+
+            if group_mat[k]:
+                coord = mat_coord[:, inds]
+                mat_feat = F.grid_sample(U_mat[3 * offset_mat + 0], coord[[0]], align_corners=False).view(-1, M) * \
+                           F.grid_sample(U_mat[3 * offset_mat + 1], coord[[1]], align_corners=False).view(-1, M) * \
+                           F.grid_sample(U_mat[3 * offset_mat + 2], coord[[2]], align_corners=False).view(-1, M) # [r, M]
+                part = S_mat[offset_mat] @ mat_feat # [out_dim, M]
+                y = part.new_zeros(part.shape[0], N) if y is None else y
+                y = y.index_add(1, inds, part.to(y.dtype)) # [out_dim, N]
+
+                offset_mat += 1
+
+        if y is None:
+            y = x.new_zeros(S_vec[0].shape[0], N)
+
+        return y.permute(1, 0).contiguous() # [out_dim, N] --> [N, out_dim]
+
+
+    def lod_levels(self, x):
+        # x: [N, 3], in [-bound, bound]
+        # return: [N], rank groups to evaluate per sample from its pixel footprint (self.lod = dict(origin, pixel, bias)):
+        #         all of them while a pixel covers at most bias voxels there, one less per doubling of the footprint beyond that.
+        footprint = (x - self.lod['origin']).norm(dim=-1) * self.lod['pixel'] # [N], width of a pixel at the sample
+        voxel = ((self.aabb_train[3:] - self.aabb_train[:3]) / torch.tensor(self.resolution, dtype=torch.float32, device=x.device)).min()
+        drop = torch.floor(torch.log2((footprint / (voxel * self.lod['bias'])).clamp(min=1)))
+        return (self.K[0] - drop).clamp(min=1).long()
+
+
     def normalize_coord(self, x, oid=0):
         
         if oid == 0:
@@ -264,6 +342,20 @@ class NeRFNetwork(NeRFRenderer):
         return 2 * (x - aabb[:3]) / (aabb[3:] - aabb[:3]) - 1 # [-1, 1] in bbox
             
 
+    def query_objects(self, x):
+        # x: [N, 3], in [-bound, bound]
+        # return: list of (oid, inds, x_model) for the composed objects whose features are nonzero somewhere in x:
+        #         the samples inds ([M]) and their coords in the object's box, x_model ([M, 3] in [-1, 1] up to half a texel).
+        objects = []
+        for oid, inds in self.bvh.query(x):
+            x_model = self.normalize_coord(x[inds], oid=oid)
+            # the world box bounds the rotated object box, keep what the grid_sample of the object can reach (align_corners=False)
+            inside = (x_model.abs() <= 1 + self.margins[oid]).all(dim=-1)
+            if inside.any():
+                objects.append((oid, inds[inside], x_model[inside]))
+        return objects
+
+
     def normalize_dir(self, d, oid=0):
         if oid != 0:
             tr = getattr(self, f'R_{oid}') # [3, 3] rotation matrix
@@ -280,14 +372,30 @@ class NeRFNetwork(NeRFRenderer):
         # single object
         if len(self.K) == 1:
 
+            if not self.training and self.lod is not None and not torch.is_tensor(K) and K <= 0:
+                K = self.lod if isinstance(self.lod, int) else self.lod_levels(x)
+
             x_model = self.normalize_coord(x)
+
+            # per sample number of rank groups
+            if torch.is_tensor(K):
+                sigma = trunc_exp(self.compute_features_lod(x_model, K, density=True)).squeeze(-1) # [N]
+
+                enc_d = self.encoder_dir(d) # [N, C]
+
+                h = self.compute_features_lod(x_model, K, density=False) # [N, 3C]
+                h = h.view(N, 3, self.degree ** 2)
+                h = (h * enc_d.unsqueeze(1)).sum(-1) # [N, 3]
+
+                return sigma, torch.sigmoid(h)
+
             feats_density = self.compute_features_density(x_model, K, residual=self.training) # [K, N, 1]
             sigma = trunc_exp(feats_density).squeeze(-1) # [K, N]
 
             enc_d = self.encoder_dir(d) # [N, C]
 
             h = self.compute_features(x_model, K, residual=self.training) # [K, N, 3C]
-            h = h.view(K, N, 3, self.degree ** 2) # [K, N, 3, C]
+            h = h.view(-1, N, 3, self.degree ** 2) # [K, N, 3, C]
             h = (h * enc_d.unsqueeze(1)).sum(-1) # [K, N, 3]
 
             rgb = torch.sigmoid(h) # [K, N, 3] 
@@ -296,40 +404,49 @@ class NeRFNetwork(NeRFRenderer):
 
         # multi-object (composed scene), do not support rank-residual training for now.
         else:
-            
-            sigma_list = []
-            h_list = []
-
-            sigma_all = 0
-            rgb_all = 0
-
 
-            for oid in range(1, len(self.K)):
-                x_model = self.normalize_coord(x, oid=oid)
+            # each object only evaluates the samples inside its box, the others get what it would give them:
+            # zero features, i.e. sigma = trunc_exp(0) = 1 and no color.
+            O = len(self.K) - 1
 
-                feats_density = self.compute_features_density(x_model, -1, residual=False, oid=oid) # [N, 1]
+            sigma_list = []
+            h_list = []
+            inds_list = []
 
-                sigma = trunc_exp(feats_density).squeeze(-1) # [N]
-                sigma_list.append(sigma.detach().clone())
+            for oid, inds, x_model in self.query_objects(x):
 
-                sigma_all += sigma
+                feats_density = self.compute_features_density(x_model, -1, residual=False, oid=oid) # [M, 1]
+                sigma = trunc_exp(feats_density).squeeze(-1) # [M]
+                sigma_list.append(sigma)
 
-                d_model = self.normalize_dir(d, oid=oid)
-                enc_d = self.encoder_dir(d_model) # [N, C]
+                d_model = self.normalize_dir(d[inds], oid=oid)
+                enc_d = self.encoder_dir(d_model) # [M, C]
 
-                h = self.compute_features(x_model, -1, residual=False, oid=oid) # [N, 3C]
-                h = h.view(N, 3, self.degree ** 2)
-                h = (h * enc_d.unsqueeze(1)).sum(-1) # [N, 3]
+                h = self.compute_features(x_model, -1, residual=False, oid=oid) # [M, 3C]
+                h = h.view(-1, 3, self.degree ** 2)
+                h = (h * enc_d.unsqueeze(1)).sum(-1) # [M, 3]
 
                 h_list.append(h)
+                inds_list.append(inds)
+
+            sigma_all = x.new_full([N], float(O))
+            if len(inds_list) == 0:
+                return sigma_all, torch.full_like(x, 0.5) # sigmoid(0)
 
+            inds = torch.cat(inds_list, dim=0) # [H], sample of each hit
+            sigma = torch.cat(sigma_list, dim=0) # [H]
+            h = torch.cat(h_list, dim=0) # [H, 3]
 
-            ws = torch.stack(sigma_list, dim=0) # [O, N]
-            ws = F.softmax(ws, dim=0)
+            sigma_all = sigma_all.index_add(0, inds, sigma - 1)
 
-            for oid in range(1, len(self.K)):
-                rgb_all += h_list[oid - 1] * ws[oid - 1].unsqueeze(-1)
+            # softmax of the (detached) sigmas over all objects, the missed ones at sigma = 1
+            ws = sigma.detach()
+            ws_max = x.new_ones(N).scatter_reduce(0, inds, ws, reduce='amax') # [N], >= every sigma of the sample
+            ws = torch.exp(ws - ws_max[inds]) # [H]
+            hits = torch.bincount(inds, minlength=N).to(x.dtype) # [N]
+            ws_sum = (O - hits) * torch.exp(1 - ws_max) + x.new_zeros(N).index_add(0, inds, ws) # [N]
 
+            rgb_all = x.new_zeros(N, 3).index_add(0, inds, h * (ws / ws_sum[inds]).unsqueeze(-1))
             rgb_all = torch.sigmoid(rgb_all)
 
             return sigma_all, rgb_all
@@ -350,12 +467,12 @@ class NeRFNetwork(NeRFRenderer):
 
         else:
 
-            sigma_all = 0
-            for oid in range(1, len(self.K)):
-                x_model = self.normalize_coord(x, oid=oid)
-                feats_density = self.compute_features_density(x_model, -1, residual=False, oid=oid) # [N, 1]
-                sigma = trunc_exp(feats_density).squeeze(-1) # [N]
-                sigma_all += sigma
+            # objects missing a sample add trunc_exp(0) = 1 there
+            sigma_all = x.new_full([x.shape[0]], float(len(self.K) - 1))
+            for oid, inds, x_model in self.query_objects(x):
+                feats_density = self.compute_features_density(x_model, -1, residual=False, oid=oid) # [M, 1]
+                sigma = trunc_exp(feats_density).squeeze(-1) # [M]
+                sigma_all = sigma_all.index_add(0, inds, sigma - 1)
 
             return {
                 'sigma': sigma_all,
@@ -392,31 +509,33 @@ class NeRFNetwork(NeRFRenderer):
 
     # upsample utils
     @torch.no_grad()
-    def upsample_model(self, resolution):
+    def upsample_model(self, resolution, optimizer=None):
+        # optimizer: if given, the new parameters replace the old ones in it, with their Adam moments upsampled alike.
 
         for i in range(len(self.U_vec_density)):
             vec_id = self.vec_ids[i % 3]
-            self.U_vec_density[i] = nn.Parameter(F.interpolate(self.U_vec_density[i].data, size=(resolution[vec_id], 1), mode='bilinear', align_corners=False))
+            resample_param(self.U_vec_density, i, lambda x: F.interpolate(x, size=(resolution[vec_id], 1), mode='bilinear', align_corners=False), optimizer)
 
         for i in range(len(self.U_mat_density)):
             mat_id_0, mat_id_1 = self.mat_ids[i % 3]
-            self.U_mat_density[i] = nn.Parameter(F.interpolate(self.U_mat_density[i].data, size=(resolution[mat_id_1], resolution[mat_id_0]), mode='bilinear', align_corners=False))
+            resample_param(self.U_mat_density, i, lambda x: F.interpolate(x, size=(resolution[mat_id_1], resolution[mat_id_0]), mode='bilinear', align_corners=False), optimizer)
 
         for i in range(len(self.U_vec)):
             vec_id = self.vec_ids[i % 3]
-            self.U_vec[i] = nn.Parameter(F.interpolate(self.U_vec[i].data, size=(resolution[vec_id], 1), mode='bilinear', align_corners=False))
+            resample_param(self.U_vec, i, lambda x: F.interpolate(x, size=(resolution[vec_id], 1), mode='bilinear', align_corners=False), optimizer)
 
         for i in range(len(self.U_mat)):
             mat_id_0, mat_id_1 = self.mat_ids[i % 3]
-            self.U_mat[i] = nn.Parameter(F.interpolate(self.U_mat[i].data, size=(resolution[mat_id_1], resolution[mat_id_0]), mode='bilinear', align_corners=False))
+            resample_param(self.U_mat, i, lambda x: F.interpolate(x, size=(resolution[mat_id_1], resolution[mat_id_0]), mode='bilinear', align_corners=False), optimizer)
 
         self.resolution = resolution
 
         print(f'[INFO] upsampled to {resolution}')
 
     @torch.no_grad()
-    def shrink_model(self):
+    def shrink_model(self, optimizer=None):
         # shrink aabb_train and the model so it only represents the space inside aabb_train.
+        # optimizer: if given, the cropped parameters replace the old ones in it, with their Adam moments cropped alike.
 
         half_grid_size = self.bound / self.grid_size
         thresh = min(self.density_thresh, self.mean_density)
@@ -439,19 +558,19 @@ class NeRFNetwork(NeRFRenderer):
         
         for i in range(len(self.U_vec_density)):
             vec_id = self.vec_ids[i % 3]
-            self.U_vec_density[i] = nn.Parameter(self.U_vec_density[i].data[..., tl[vec_id]:br[vec_id], :])
+            resample_param(self.U_vec_density, i, lambda x: x[..., tl[vec_id]:br[vec_id], :], optimizer)
         
         for i in range(len(self.U_mat_density)):
             mat_id_0, mat_id_1 = self.mat_ids[i % 3]
-            self.U_mat_density[i] = nn.Parameter(self.U_mat_density[i].data[..., tl[mat_id_1]:br[mat_id_1], tl[mat_id_0]:br[mat_id_0]])
+            resample_param(self.U_mat_density, i, lambda x: x[..., tl[mat_id_1]:br[mat_id_1], tl[mat_id_0]:br[mat_id_0]], optimizer)
         
         for i in range(len(self.U_vec)):
             vec_id = self.vec_ids[i % 3]
-            self.U_vec[i] = nn.Parameter(self.U_vec[i].data[..., tl[vec_id]:br[vec_id], :])
+            resample_param(self.U_vec, i, lambda x: x[..., tl[vec_id]:br[vec_id], :], optimizer)
         
         for i in range(len(self.U_mat)):
             mat_id_0, mat_id_1 = self.mat_ids[i % 3]
-            self.U_mat[i] = nn.Parameter(self.U_mat[i].data[..., tl[mat_id_1]:br[mat_id_1], tl[mat_id_0]:br[mat_id_0]])
+            resample_param(self.U_mat, i, lambda x: x[..., tl[mat_id_1]:br[mat_id_1], tl[mat_id_0]:br[mat_id_0]], optimizer)
         
         self.aabb_train = torch.cat([min_pos, max_pos], dim=0) # [6]
 
@@ -617,6 +736,16 @@ class NeRFNetwork(NeRFRenderer):
         self.register_buffer(f'T_{oid}', T)
         self.register_buffer(f'R_{oid}', R)
         self.register_buffer(f'aabb_{oid}', other.aabb_train)
+
+        # world box of the object (its aabb, grown by the half texel grid_sample still reads, through the model matrix)
+        margin = 1 / min(other.resolution)
+        aabb = other.aabb_train.float()
+        center, half = (aabb[:3] + aabb[3:]) / 2, (aabb[3:] - aabb[:3]) / 2 * (1 + margin)
+        corners = torch.tensor([[(i >> d) & 1 for d in range(3)] for i in range(8)], dtype=torch.float32, device=aabb.device) * 2 - 1 # [8, 3]
+        corners = torch.cat([center + corners * half, torch.ones_like(corners[:, :1])], dim=1) @ torch.inverse(T).T # [8, 4], object --> world
+        self.margins.append(margin)
+        self.boxes.append(torch.cat([corners[:, :3].amin(0), corners[:, :3].amax(0)]))
+        self.bvh = AABBTree(torch.stack(self.boxes[1:], dim=0), ids=range(1, oid + 1))
         
         # update density grid multiple times to make sure it is accurate
         # TODO: 3 is very empirical...
@@ -7,6 +7,7 @@ import numpy as np
 from encoding import get_encoder
 from activation import trunc_exp
 from nerf.renderer import NeRFRenderer
+from tensoRF.network import resample_param
 
 import raymarching
 
@@ -198,21 +199,23 @@ class NeRFNetwork(NeRFRenderer):
     
     # upsample utils
     @torch.no_grad()
-    def upsample_params(self, vec, resolution):
+    def upsample_params(self, vec, resolution, optimizer=None):
 
         for i in range(len(self.vec_ids)):
             vec_id = self.vec_ids[i]
-            vec[i] = torch.nn.Parameter(F.interpolate(vec[i].data, size=(resolution[vec_id], 1), mode='bilinear', align_corners=True))
+            resample_param(vec, i, lambda x: F.interpolate(x, size=(resolution[vec_id], 1), mode='bilinear', align_corners=True), optimizer)
 
 
     @torch.no_grad()
-    def upsample_model(self, resolution):
-        self.upsample_params(self.sigma_vec, resolution)
-        self.upsample_params(self.color_vec, resolution)
+    def upsample_model(self, resolution, optimizer=None):
+        # optimizer: if given, the new parameters replace the old ones in it, with their Adam moments upsampled alike.
+        self.upsample_params(self.sigma_vec, resolution, optimizer)
+        self.upsample_params(self.color_vec, resolution, optimizer)
         self.resolution = resolution
 
     @torch.no_grad()
-    def shrink_model(self):
+    def shrink_model(self, optimizer=None):
+        # optimizer: if given, the cropped parameters replace the old ones in it, with their Adam moments cropped alike.
 
         half_grid_size = self.bound / self.grid_size
         thresh = min(self.density_thresh, self.mean_density)
@@ -237,8 +240,10 @@ class NeRFNetwork(NeRFRenderer):
         for i in range(len(self.vec_ids)):
             vec_id = self.vec_ids[i]
 
-            self.sigma_vec[i] = nn.Parameter(self.sigma_vec[i].data[..., tl[vec_id]:br[vec_id], :])
-            self.color_vec[i] = nn.Parameter(self.color_vec[i].data[..., tl[vec_id]:br[vec_id], :])
+            crop_vec = lambda x: x[..., tl[vec_id]:br[vec_id], :]
+
+            resample_param(self.sigma_vec, i, crop_vec, optimizer)
+            resample_param(self.color_vec, i, crop_vec, optimizer)
         
         self.aabb_train = torch.cat([min_pos, max_pos], dim=0) # [6]
 
@@ -33,6 +33,7 @@ class Trainer(_Trainer):
 
         self.optimizer_fn = optimizer
         self.lr_scheduler_fn = lr_scheduler
+        self.lod = None # optional RankLOD, picks the rank groups of a CCNeRF in test_step / eval_step when set.
 
         super().__init__(name, opt, model, criterion, optimizer, ema_decay, lr_scheduler, metrics, local_rank, world_size, device, mute, fp16, eval_interval, max_keep_ckpt, workspace, best_mode, use_loss_as_metric, report_metric_at_train, use_checkpoint, use_tensorboardX, scheduler_update_every_step)
         
@@ -48,6 +49,29 @@ class Trainer(_Trainer):
         return pred_rgb, gt_rgb, loss
 
 
+    def render_lod(self, step, data, *args, **kwargs):
+        # step (test_step / eval_step) of a frame with the level of detail of self.lod, and its time for the latency mode.
+        self.lod.begin(data)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t = time.time()
+        outputs = step(data, *args, **kwargs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.lod.end((time.time() - t) * 1000)
+        return outputs
+
+    def test_step(self, data, bg_color=None, perturb=False):
+        if self.lod is None:
+            return super().test_step(data, bg_color=bg_color, perturb=perturb)
+        return self.render_lod(super().test_step, data, bg_color=bg_color, perturb=perturb)
+
+    def eval_step(self, data):
+        if self.lod is None:
+            return super().eval_step(data)
+        return self.render_lod(super().eval_step, data)
+
+
     def train_one_epoch(self, loader):
         self.log(f"==> Start Training Epoch {self.epoch}, lr={self.optimizer.param_groups[0]['lr']:.6f} ...")
 
@@ -111,9 +135,11 @@ class Trainer(_Trainer):
             # Different from _Trainer!
             if self.global_step in self.opt.upsample_model_steps:
 
+                # the parameters are swapped in place in the optimizer, with their Adam moments resampled alike, so the lr schedule just continues.
+
                 # shrink
                 if self.model.cuda_ray: # and self.global_step == self.opt.upsample_model_steps[0]: 
-                    self.model.shrink_model()
+                    self.model.shrink_model(self.optimizer)
 
                 # adaptive voxel size from aabb_train
                 n_vox = self.upsample_resolutions.pop(0) ** 3 # n_voxels
@@ -122,11 +148,7 @@ class Trainer(_Trainer):
                 reso = ((aabb[3:] - aabb[:3]) / vox_size).astype(np.int32).tolist()
                 
                 self.log(f"[INFO] upsample model at step {self.global_step} from {self.model.resolution} to {reso}")
-                self.model.upsample_model(reso)
-
-                # reset optimizer since params changed.
-                self.optimizer = self.optimizer_fn(self.model)
-                self.lr_scheduler = self.lr_scheduler_fn(self.optimizer)                
+                self.model.upsample_model(reso, self.optimizer)
 
         if self.ema is not None:
             self.ema.update()
@@ -199,9 +221,11 @@ class Trainer(_Trainer):
             # Different from _Trainer!
             if self.global_step in self.opt.upsample_model_steps:
 
+                # the parameters are swapped in place in the optimizer, with their Adam moments resampled alike, so the lr schedule just continues.
+
                 # shrink
                 if self.model.cuda_ray: 
-                    self.model.shrink_model()
+                    self.model.shrink_model(self.optimizer)
 
                 # adaptive voxel size from aabb_train
                 n_vox = self.upsample_resolutions.pop(0) ** 3 # n_voxels
@@ -210,11 +234,7 @@ class Trainer(_Trainer):
                 reso = ((aabb[3:] - aabb[:3]) / vox_size).astype(np.int32).tolist()
                 
                 self.log(f"[INFO] upsample model at step {self.global_step} from {self.model.resolution} to {reso}")
-                self.model.upsample_model(reso)
-
-                # reset optimizer since params changed.
-                self.optimizer = self.optimizer_fn(self.model)
-                self.lr_scheduler = self.lr_scheduler_fn(self.optimizer)       
+                self.model.upsample_model(reso, self.optimizer)
 
         if self.ema is not None:
             self.ema.update()
@@ -235,6 +255,75 @@ class Trainer(_Trainer):
         return outputs
 
 
+    def benchmark_lod(self, loader, max_frames=4, biases=(1, 2, 4), target_ms=None, save_path=None):
+        # render up to max_frames test frames with the first K rank groups for every K, and with the footprint
+        # (and latency, if target_ms) level of detail, report PSNR (vs the full model, and vs the images if any) and time per frame.
+        from .lod import RankLOD
+
+        if save_path is None:
+            save_path = os.path.join(self.workspace, f'lod_{self.name}_ep{self.epoch:04d}.json')
+
+        self.log(f"==> Start LOD benchmark, save report to {save_path}")
+
+        frames = []
+        for i, data in enumerate(loader):
+            if i >= max_frames:
+                break
+            frames.append(data)
+
+        self.model.eval()
+        lod, self.lod = self.lod, None
+
+        K = self.model.K[0]
+        configs = [(f'K={k}', k, None) for k in range(K, 0, -1)]
+        configs += [(f'footprint (bias {b})', None, RankLOD(self.model, 'footprint', bias=b)) for b in biases]
+        if target_ms is not None:
+            configs.append((f'latency ({target_ms} ms)', None, RankLOD(self.model, 'latency', target_ms=target_ms)))
+
+        psnr = lambda a, b: -10 * np.log10(max(torch.mean((a - b) ** 2).item(), 1e-10))
+
+        refs = []
+        report = {}
+
+        with torch.no_grad():
+            for name, k, controller in configs:
+                self.model.lod = k
+                self.lod = controller
+
+                preds = []
+                t = time.time()
+                for data in frames:
+                    with torch.cuda.amp.autocast(enabled=self.fp16):
+                        pred, _ = self.test_step(data)
+                    preds.append(pred.float())
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                t = (time.time() - t) / max(len(frames), 1)
+
+                if k == K:
+                    refs = preds
+
+                report[name] = {
+                    'psnr_full': float(np.mean([psnr(pred, ref) for pred, ref in zip(preds, refs)])),
+                    'sec_per_frame': t,
+                }
+
+                line = f"[INFO] {name:>20s} | PSNR vs full = {report[name]['psnr_full']:.2f}"
+                if len(frames) > 0 and 'images' in frames[0]:
+                    gts = [data['images'][..., :3] * data['images'][..., 3:] + (1 - data['images'][..., 3:]) if data['images'].shape[-1] == 4 else data['images'] for data in frames]
+                    report[name]['psnr'] = float(np.mean([psnr(pred, gt) for pred, gt in zip(preds, gts)]))
+                    line += f" | PSNR = {report[name]['psnr']:.2f}"
+                self.log(f"{line} | {t:.3f} s/frame")
+
+        self.model.lod = None
+        self.lod = lod
+
+        with open(save_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        self.log(f"==> Finished LOD benchmark.")
+
+
     def save_checkpoint(self, name=None, full=False, best=False, remove_old=True):
 
         if name is None:
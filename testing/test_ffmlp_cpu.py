@@ -0,0 +1,85 @@
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from ffmlp import FFMLP
+from ffmlp.ffmlp import split_weights
+
+# cpu backend of FFMLP vs the nn.Linear stacks of nerf/network.py (sigma_net / color_net).
+
+class MLP(nn.Module):
+    def __init__(self, input_dim, output_dim, hidden_dim, num_layers):
+        super().__init__()
+
+        self.num_layers = num_layers
+
+        net = []
+        for l in range(num_layers):
+            in_dim = input_dim if l == 0 else hidden_dim
+            out_dim = output_dim if l == num_layers - 1 else hidden_dim
+            net.append(nn.Linear(in_dim, out_dim, bias=False))
+
+        self.net = nn.ModuleList(net)
+
+    def load_packed(self, ffmlp):
+        # same weights as a FFMLP (whose num_layers counts the hidden layers, so it has one more matmul)
+        w_first, w_hidden, w_last = split_weights(ffmlp.weights.data, ffmlp.input_dim, ffmlp.padded_output_dim, ffmlp.hidden_dim, ffmlp.num_layers)
+        weights = [w_first] + list(w_hidden) + [w_last[:ffmlp.output_dim]]
+        for l, w in zip(self.net, weights):
+            l.weight.data.copy_(w)
+
+    def forward(self, x):
+        for l in range(self.num_layers):
+            x = self.net[l](x)
+            if l != self.num_layers - 1:
+                x = F.relu(x, inplace=True)
+        return x
+
+
+def timeit(fn, repeat=10):
+    for _ in range(2): # warm up
+        fn()
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1000
+
+
+BATCH_SIZE = 2**16
+INPUT_DIM = 32
+OUTPUT_DIM = 16
+NUM_LAYERS = 2
+
+print(f'[INFO] batch = {BATCH_SIZE}, threads = {torch.get_num_threads()}')
+
+for HIDDEN_DIM in [16, 32, 64, 128, 256]:
+
+    net0 = FFMLP(INPUT_DIM, OUTPUT_DIM, HIDDEN_DIM, NUM_LAYERS)
+    net1 = MLP(INPUT_DIM, OUTPUT_DIM, HIDDEN_DIM, NUM_LAYERS + 1)
+    net1.load_packed(net0)
+
+    x = torch.rand(BATCH_SIZE, INPUT_DIM) * 2 - 1
+
+    # same outputs and gradients
+    y0, y1 = net0(x), net1(x)
+    y0.sum().backward(); y1.sum().backward()
+    grad1 = torch.cat([l.weight.grad.view(-1) for l in net1.net])
+    g_first, g_hidden, g_last = split_weights(net0.weights.grad, INPUT_DIM, net0.padded_output_dim, HIDDEN_DIM, NUM_LAYERS)
+    grad0 = torch.cat([g_first.reshape(-1), g_hidden.reshape(-1), g_last[:OUTPUT_DIM].reshape(-1)])
+    print(f'hidden = {HIDDEN_DIM}: max |y0 - y1| = {(y0 - y1).abs().max().item():.2e}, max |g0 - g1| = {(grad0 - grad1).abs().max().item():.2e}')
+
+    def train0():
+        net0.weights.grad = None
+        net0(x).sum().backward()
+
+    def train1():
+        net1.zero_grad(set_to_none=True)
+        net1(x).sum().backward()
+
+    with torch.no_grad():
+        t0, t1 = timeit(lambda: net0(x)), timeit(lambda: net1(x))
+    print(f'    infer: FFMLP (cpu) = {t0:.2f} ms, pytorch MLP = {t1:.2f} ms')
+
+    t0, t1 = timeit(train0), timeit(train1)
+    print(f'    train: FFMLP (cpu) = {t0:.2f} ms, pytorch MLP = {t1:.2f} ms')